@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import multiprocessing
+from distutils.spawn import find_executable
+
+
+def parse_cpulist(text):
+    """
+    CPU indices in a Linux cpulist string, such as ``0-3,8,10-11``.
+    """
+    cpus = set()
+    for part in str(text).replace(' ', '').split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def format_cpulist(cpus):
+    """
+    Inverse of `parse_cpulist`.
+    """
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '{}-{}'.format(a, b) for (a, b) in ranges)
+
+
+def _read_cpulist(path):
+    try:
+        with open(path) as f:
+            return parse_cpulist(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def available_cpus():
+    return (_read_cpulist('/sys/devices/system/cpu/online')
+            or list(range(multiprocessing.cpu_count())))
+
+
+def node_cpus(node):
+    """
+    CPUs of NUMA node `node`, or None if unknown.
+    """
+    return _read_cpulist('/sys/devices/system/node/node{}/cpulist'.format(int(node)))
+
+
+def launch_prefix(affinity=None, numa_node=None):
+    """
+    Command prefix that runs a process bound to the `affinity` CPU
+    list and/or NUMA node `numa_node` (CPUs and memory). Binding
+    tools missing from this machine are skipped.
+
+    Returns
+    -------
+    prefix : list of str
+    """
+    prefix = []
+    if numa_node is not None and find_executable('numactl'):
+        prefix += ['numactl', '--cpunodebind={}'.format(numa_node),
+                   '--membind={}'.format(numa_node)]
+    if affinity and find_executable('taskset'):
+        prefix += ['taskset', '-c', format_cpulist(parse_cpulist(affinity))]
+    return prefix
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+import time
+import shutil
+import subprocess
+from threading import Lock
+from distutils.spawn import find_executable
+import Tkinter as tk
+import ttk
+from tkFileDialog import askopenfilenames, askdirectory
+import yaml
+# Own
+from jobs import Job, JobScheduler
+
+# md_input keys that may point to files needed by the run
+INPUT_FILES = ('topology', 'positions', 'charmm_parameters', 'velocities',
+               'box_vectors', 'checkpoint')
+
+STATES = ('queued', 'running', 'done', 'failed', 'cancelled', 'unknown')
+
+
+class BatchBackend(object):
+
+    """
+    Runs prepared OMMProtocol inputs on some batch system.
+
+    Every input is staged in its own directory under `workdir`, with
+    copies of the files it references and its output redirected to an
+    ``output`` subdirectory, so the whole directory can be moved to
+    wherever the run happens. Subclasses implement `submit` and
+    `status`.
+
+    Parameters
+    ----------
+    workdir : str
+        Directory where runs are staged
+    """
+
+    name = 'batch'
+
+    def __init__(self, workdir):
+        self.workdir = os.path.abspath(workdir)
+        self.runs = []
+        self._lock = Lock()
+
+    def stage(self, inputfile):
+        """
+        Copy `inputfile` and the files it references to a new staging
+        directory, rewriting paths to be relative to it. Different files
+        with the same name are renamed so they do not overwrite each other.
+
+        Returns
+        -------
+        run : dict
+            input (original), staged (staged YAML), directory, outputpath
+            (original output directory) and state
+        """
+        with open(inputfile) as f:
+            cfg = yaml.safe_load(f)
+        base = os.path.dirname(os.path.abspath(inputfile))
+        name = os.path.splitext(os.path.basename(inputfile))[0]
+        directory = prefix = os.path.join(self.workdir, '{}_{}'.format(
+                                          name, time.strftime('%Y%m%d-%H%M%S')))
+        suffix = 1
+        while os.path.exists(directory):
+            directory = '{}_{}'.format(prefix, suffix)
+            suffix += 1
+        os.makedirs(os.path.join(directory, 'output'))
+
+        copied = {}
+        taken = set([os.path.basename(inputfile), 'output', 'run.sbatch'])
+
+        def copy(path):
+            source = path if os.path.isabs(path) else os.path.join(base, path)
+            if not os.path.isfile(source):  # e.g. force fields shipped with OpenMM
+                return path
+            source = os.path.abspath(source)
+            if source not in copied:
+                stem, ext = os.path.splitext(os.path.basename(source))
+                name, n = stem + ext, 1
+                while name in taken:
+                    name, n = '{}_{}{}'.format(stem, n, ext), n + 1
+                shutil.copy2(source, os.path.join(directory, name))
+                copied[source] = name
+                taken.add(name)
+            return copied[source]
+
+        for key in INPUT_FILES:
+            if cfg.get(key):
+                cfg[key] = copy(cfg[key])
+        if cfg.get('forcefield'):
+            cfg['forcefield'] = [copy(path) for path in cfg['forcefield']]
+        outputpath = cfg.get('outputpath') or '.'
+        if not os.path.isabs(outputpath):
+            outputpath = os.path.join(base, outputpath)
+        cfg['outputpath'] = 'output'
+        staged = os.path.join(directory, os.path.basename(inputfile))
+        with open(staged, 'w') as f:
+            f.write('# Yaml input for OpenMM MD\n')
+            f.write('# Staged from {} for {}\n\n'.format(os.path.abspath(inputfile), self.name))
+            yaml.safe_dump(cfg, f, default_flow_style=False)
+        run = {'input': os.path.abspath(inputfile), 'staged': staged, 'directory': directory,
+               'outputpath': outputpath, 'state': 'staged', 'id': None}
+        self.runs.append(run)
+        return run
+
+    def submit(self, run):
+        """
+        Submit a staged run and return its batch system id.
+        """
+        raise NotImplementedError
+
+    def status(self, run):
+        """
+        Current state of `run`, one of STATES.
+        """
+        raise NotImplementedError
+
+    def submit_many(self, inputfiles):
+        """
+        Stage and submit several inputs in one go.
+        """
+        runs = []
+        for inputfile in inputfiles:
+            run = self.stage(inputfile)
+            run['id'] = self.submit(run)
+            run['state'] = 'queued' if run['id'] is not None else 'staged'
+            runs.append(run)
+        self.write_manifest()
+        return runs
+
+    def poll(self):
+        for run in self.runs:
+            if run['id'] is not None and run['state'] not in ('done', 'failed', 'cancelled'):
+                run['state'] = self.status(run)
+        self.write_manifest()
+        return self.runs
+
+    def collect(self, run, destination=None):
+        """
+        Copy the outputs of a finished run back to `destination`,
+        by default the output directory of the original input.
+        """
+        destination = destination or run['outputpath']
+        if not os.path.isdir(destination):
+            os.makedirs(destination)
+        collected = []
+        output = os.path.join(run['directory'], 'output')
+        for name in os.listdir(output):
+            shutil.copy2(os.path.join(output, name), destination)
+            collected.append(os.path.join(destination, name))
+        run['collected'] = destination
+        self.write_manifest()
+        return collected
+
+    def write_manifest(self):
+        with self._lock:
+            if not os.path.isdir(self.workdir):
+                os.makedirs(self.workdir)
+            with open(os.path.join(self.workdir, 'batch_manifest.yaml'), 'w') as f:
+                f.write('# MMSetup batch manifest ({})\n'.format(self.name))
+                yaml.safe_dump({'backend': self.name, 'runs': self.runs}, f,
+                               default_flow_style=False)
+
+
+class SlurmBackend(BatchBackend):
+
+    """
+    Writes an sbatch script next to every staged input and, if SLURM
+    is available here, submits it and tracks it with squeue/sacct.
+    Otherwise the staged directories are ready to be copied to the
+    cluster and submitted with ``sbatch run.sbatch``.
+    """
+
+    name = 'SLURM'
+    SLURM_STATES = {'PENDING': 'queued', 'CONFIGURING': 'queued', 'REQUEUED': 'queued',
+                    'RUNNING': 'running', 'COMPLETING': 'running', 'SUSPENDED': 'running',
+                    'COMPLETED': 'done', 'CANCELLED': 'cancelled', 'FAILED': 'failed',
+                    'TIMEOUT': 'failed', 'NODE_FAIL': 'failed', 'OUT_OF_MEMORY': 'failed',
+                    'PREEMPTED': 'failed', 'BOOT_FAIL': 'failed'}
+
+    def __init__(self, workdir, partition=None, walltime='24:00:00', cpus=1, gpus=0,
+                 account=None, setup=()):
+        super(SlurmBackend, self).__init__(workdir)
+        self.partition = partition
+        self.walltime = walltime
+        self.cpus = cpus
+        self.gpus = gpus
+        self.account = account
+        self.setup = list(setup)  # e.g. module load / conda activate lines
+
+    def script(self, run):
+        name = os.path.splitext(os.path.basename(run['staged']))[0]
+        lines = ['#!/bin/bash',
+                 '#SBATCH --job-name={}'.format(name),
+                 '#SBATCH --output=output/slurm-%j.out',
+                 '#SBATCH --time={}'.format(self.walltime),
+                 '#SBATCH --ntasks=1',
+                 '#SBATCH --cpus-per-task={}'.format(self.cpus)]
+        if self.partition:
+            lines.append('#SBATCH --partition={}'.format(self.partition))
+        if self.account:
+            lines.append('#SBATCH --account={}'.format(self.account))
+        if self.gpus:
+            lines.append('#SBATCH --gres=gpu:{}'.format(self.gpus))
+        lines += ['', 'cd "$SLURM_SUBMIT_DIR"',
+                  'export OPENMM_CPU_THREADS=${SLURM_CPUS_PER_TASK:-1}'] + self.setup
+        lines += ['ommprotocol {}'.format(os.path.basename(run['staged'])), '']
+        return '\n'.join(lines)
+
+    def write_script(self, run):
+        path = os.path.join(run['directory'], 'run.sbatch')
+        with open(path, 'w') as f:
+            f.write(self.script(run))
+        run['script'] = path
+        return path
+
+    def submit(self, run):
+        script = self.write_script(run)
+        if not find_executable('sbatch'):
+            return None  # staged only
+        output = subprocess.check_output(['sbatch', '--parsable', os.path.basename(script)],
+                                         cwd=run['directory'])
+        return output.decode('latin-1').strip().split(';')[0]
+
+    def status(self, run):
+        if run['id'] is None:
+            return run['state']
+        try:
+            state = subprocess.check_output(['squeue', '-h', '-j', run['id'], '-o', '%T'],
+                                            stderr=subprocess.STDOUT).decode('latin-1').strip()
+            if not state:
+                state = subprocess.check_output(['sacct', '-n', '-X', '-P', '-j', run['id'],
+                                                 '-o', 'State']).decode('latin-1').strip()
+        except (OSError, subprocess.CalledProcessError):
+            return 'unknown'
+        state = state.split()[0].rstrip('+') if state else ''
+        return self.SLURM_STATES.get(state, 'unknown')
+
+
+class LocalBackend(BatchBackend):
+
+    """
+    Stand-in batch system that runs staged inputs on this machine
+    with queue semantics (queued, running, done...), through its own
+    JobScheduler. Handy to try a batch before sending it to a cluster.
+    """
+
+    name = 'local'
+
+    def __init__(self, workdir, max_threads=None, threads=1):
+        super(LocalBackend, self).__init__(workdir)
+        self.scheduler = JobScheduler(max_threads=max_threads)
+        self.threads = threads
+        self.jobs = {}
+
+    def submit(self, run):
+        # Relative paths in the staged input are resolved from its directory
+        job = Job(run['staged'], threads=self.threads,
+                  name=os.path.basename(run['directory']), cwd=run['directory'])
+        job.add_done_callback(lambda job: self.poll())
+        self.jobs[job.id] = job
+        self.scheduler.submit(job)
+        return job.id
+
+    def status(self, run):
+        job = self.jobs.get(run['id'])
+        return job.state if job is not None else 'unknown'
+
+
+BACKENDS = (('Local', LocalBackend), ('SLURM', SlurmBackend))
+
+
+class BatchWindow(object):
+
+    """
+    Stages a list of inputs, submits them to a batch backend in one
+    action and follows their state. The backend and its staging
+    directory are kept for the window once the first batch is sent.
+    """
+
+    def __init__(self, inputfiles=(), title='MMSetup Batch Submission', refresh=5000):
+        self.backend = None
+        self.refresh = refresh
+        self.window = tk.Toplevel()
+        self.window.title(title)
+        self.var_backend = tk.StringVar()
+        self.var_backend.set('Local')
+        self.var_workdir = tk.StringVar()
+        self.var_workdir.set(os.path.join(os.getcwd(), 'batch'))
+        self.var_partition = tk.StringVar()
+        self.var_walltime = tk.StringVar()
+        self.var_walltime.set('24:00:00')
+        self.var_cpus = tk.IntVar()
+        self.var_cpus.set(1)
+        self.var_gpus = tk.IntVar()
+
+        frame = tk.LabelFrame(self.window, text='Inputs')
+        frame.pack(expand=True, fill='both', padx=5, pady=5)
+        self.ui_inputs_listbox = tk.Listbox(frame, width=80, height=6)
+        self.ui_inputs_listbox.grid(row=0, column=0, columnspan=3, sticky='news')
+        for path in inputfiles:
+            self.ui_inputs_listbox.insert('end', path)
+        tk.Button(frame, text='Add...', command=self._add).grid(row=1, column=0)
+        tk.Button(frame, text='Remove', command=lambda: [
+            self.ui_inputs_listbox.delete(i) for i in reversed(self.ui_inputs_listbox.curselection())]
+            ).grid(row=1, column=1)
+
+        options = tk.LabelFrame(self.window, text='Backend')
+        options.pack(expand=True, fill='both', padx=5, pady=5)
+        self.ui_backend_combo = ttk.Combobox(options, textvariable=self.var_backend,
+                                             state='readonly',
+                                             values=[name for (name, _) in BACKENDS])
+        self.ui_backend_combo.grid(row=0, column=1, sticky='we')
+        tk.Label(options, text='Backend').grid(row=0, column=0, sticky='w')
+        tk.Label(options, text='Staging directory').grid(row=1, column=0, sticky='w')
+        self.ui_workdir_entry = tk.Entry(options, textvariable=self.var_workdir, width=40)
+        self.ui_workdir_entry.grid(row=1, column=1)
+        self.ui_workdir_button = tk.Button(options, text='...', command=lambda:
+            self.var_workdir.set(askdirectory(parent=self.window) or self.var_workdir.get()))
+        self.ui_workdir_button.grid(row=1, column=2)
+        for row, (label, var) in enumerate([('Partition', self.var_partition),
+                                            ('Wall time', self.var_walltime),
+                                            ('CPUs per run', self.var_cpus),
+                                            ('GPUs per run (SLURM)', self.var_gpus)], 2):
+            tk.Label(options, text=label).grid(row=row, column=0, sticky='w')
+            tk.Entry(options, textvariable=var).grid(row=row, column=1, sticky='we')
+        tk.Button(options, text='Submit all', command=self._submit).grid(row=6, column=1)
+
+        status = tk.LabelFrame(self.window, text='Runs')
+        status.pack(expand=True, fill='both', padx=5, pady=5)
+        self.ui_runs_listbox = tk.Listbox(status, width=80, height=8, font='TkFixedFont')
+        self.ui_runs_listbox.grid(row=0, column=0, columnspan=2, sticky='news')
+        tk.Button(status, text='Collect outputs', command=self._collect).grid(row=1, column=0)
+        tk.Button(status, text='Refresh', command=self._update).grid(row=1, column=1)
+
+    def _add(self):
+        for path in askopenfilenames(parent=self.window, filetypes=[('YAML', '*.yaml')]):
+            self.ui_inputs_listbox.insert('end', path)
+
+    def _make_backend(self):
+        workdir = self.var_workdir.get()
+        if self.var_backend.get() == 'SLURM':
+            return SlurmBackend(workdir)
+        return LocalBackend(workdir)
+
+    def _configure(self, backend):
+        """
+        Apply the per-run options, which may change between batches
+        """
+        if isinstance(backend, SlurmBackend):
+            backend.partition = self.var_partition.get() or None
+            backend.walltime = self.var_walltime.get()
+            backend.cpus = self.var_cpus.get()
+            backend.gpus = self.var_gpus.get()
+        else:
+            backend.threads = self.var_cpus.get()
+
+    def _submit(self):
+        inputs = self.ui_inputs_listbox.get(0, 'end')
+        if not inputs:
+            return
+        first = self.backend is None
+        if first:
+            self.backend = self._make_backend()
+            for widget in (self.ui_backend_combo, self.ui_workdir_entry, self.ui_workdir_button):
+                widget.configure(state='disabled')
+        self._configure(self.backend)
+        self.backend.submit_many(inputs)
+        if first:
+            self._tick()
+        else:
+            self._update()
+
+    def _collect(self):
+        if self.backend is None:
+            return
+        for i in self.ui_runs_listbox.curselection():
+            run = self.backend.runs[int(i)]
+            if run['state'] == 'done':
+                self.backend.collect(run)
+        self._update()
+
+    def _update(self):
+        if self.backend is None:
+            return
+        self.ui_runs_listbox.delete(0, 'end')
+        for run in self.backend.poll():
+            self.ui_runs_listbox.insert('end', '{:<10} {!s:<10} {:<10} {}'.format(
+                run['state'], run['id'], 'collected' if run.get('collected') else '',
+                os.path.basename(run['directory'])))
+
+    def _tick(self):
+        try:
+            self._update()
+            self.window.after(self.refresh, self._tick)
+        except tk.TclError:  # window closed
+            pass
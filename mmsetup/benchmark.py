@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+import math
+import time
+import socket
+import multiprocessing
+import yaml
+# OpenMM package
+from simtk import openmm
+# Own
+from system import load_topology, build_system, build_integrator
+from utils import user_data_dir
+
+PRECISIONS = ('single', 'mixed', 'double')
+# Reference is orders of magnitude slower; a few steps are enough
+REFERENCE_STEPS = 10
+
+
+def candidates(max_threads=None):
+    """
+    Platform name and properties of every configuration worth timing
+    on this machine: all precisions on GPU platforms, a few thread
+    counts on CPU and Reference as a last resort.
+    """
+    cores = max_threads or multiprocessing.cpu_count()
+    for i in range(openmm.Platform.getNumPlatforms()):
+        name = openmm.Platform.getPlatform(i).getName()
+        if name in ('CUDA', 'OpenCL'):
+            for precision in PRECISIONS:
+                yield name, {'Precision': precision}
+        elif name == 'CPU':
+            threads = sorted(set([cores, max(1, cores // 2), max(1, cores // 4)]), reverse=True)
+            for n in threads:
+                yield name, {'Threads': str(n)}
+        else:
+            yield name, {}
+
+
+def time_platform(system, positions, md_conditions, platform, properties,
+                  steps=200, warmup=20):
+    """
+    ns/day reached by `platform` on `system` after a short warm-up.
+    If `platform` is None, OpenMM picks one. Reference is timed for at
+    most REFERENCE_STEPS steps, without minimization nor warm-up.
+    """
+    minimize = True
+    if platform == 'Reference':
+        steps, warmup, minimize = min(steps, REFERENCE_STEPS), 0, False
+    integrator = build_integrator(md_conditions)
+    if platform is None:
+        context = openmm.Context(system, integrator)
+    else:
+        context = openmm.Context(system, integrator, openmm.Platform.getPlatformByName(platform),
+                                 properties or {})
+    try:
+        context.setPositions(positions)
+        if minimize:
+            openmm.LocalEnergyMinimizer.minimize(context, 10.0, 50)
+        if warmup:
+            integrator.step(warmup)
+        context.getState(getEnergy=True)  # wait for the device
+        t0 = time.time()
+        integrator.step(steps)
+        context.getState(getEnergy=True)
+        elapsed = time.time() - t0
+    finally:
+        del context, integrator
+    timestep = float(md_conditions.get('timestep', 1))  # fs
+    return steps * timestep * 1e-6 / (elapsed / 86400.)
+
+
+def run(system, positions, md_conditions, steps=200, max_threads=None):
+    """
+    Time every candidate configuration.
+
+    Returns
+    -------
+    results : list of dict
+        platform, properties and ns_per_day, fastest first. Configurations
+        that failed to run are left out.
+    """
+    results = []
+    for platform, properties in candidates(max_threads):
+        try:
+            speed = time_platform(system, positions, md_conditions, platform, properties,
+                                  steps=steps)
+        except Exception:  # not usable on this machine
+            continue
+        results.append({'platform': platform, 'properties': properties, 'ns_per_day': speed})
+    results.sort(key=lambda r: r['ns_per_day'], reverse=True)
+    return results
+
+
+def cache_key(natoms, md_systemoptions):
+    """
+    Results are reused on the same machine for systems of similar size
+    (same power of two) and nonbonded method.
+    """
+    bucket = 2 ** int(round(math.log(max(natoms, 1), 2)))
+    return '{}|{}|{}|{}'.format(socket.gethostname(), openmm.Platform.getOpenMMVersion(),
+                                bucket, md_systemoptions.get('nonbondedMethod', 'NoCutoff'))
+
+
+def cache_path():
+    return os.path.join(user_data_dir(), 'benchmarks.yaml')
+
+
+def load_cache():
+    try:
+        with open(cache_path()) as f:
+            return yaml.safe_load(f) or {}
+    except (IOError, OSError, yaml.YAMLError):
+        return {}
+
+
+def save_cache(cache):
+    path = cache_path()
+    with open(path + '.tmp', 'w') as f:
+        yaml.safe_dump(cache, f, default_flow_style=False)
+    os.rename(path + '.tmp', path)
+
+
+def fastest_platform(md_input, md_systemoptions, md_conditions, steps=200,
+                     max_threads=None, refresh=False):
+    """
+    Fastest platform for this system on this machine, benchmarking
+    the actual system only if no cached result applies.
+
+    Returns
+    -------
+    best : dict or None
+        platform, properties and ns_per_day of the winner
+    """
+    _, topology, _ = load_topology(md_input)
+    key = cache_key(topology.getNumAtoms(), md_systemoptions)
+    cache = load_cache()
+    if key in cache and not refresh:
+        return cache[key]
+    system, _, positions = build_system(md_input, md_systemoptions)
+    results = run(system, positions, md_conditions, steps=steps, max_threads=max_threads)
+    if not results:
+        return None
+    best = results[0]
+    best['date'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    cache[key] = best
+    save_cache(cache)
+    return best
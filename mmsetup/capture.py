@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+from collections import deque
+import numpy as np
+
+
+class RMSDJumpRule(object):
+
+    """
+    Fires when the RMSD between consecutive frames exceeds `threshold`
+    (same units as the coordinates, Å for the live stream).
+    """
+
+    def __init__(self, threshold):
+        self.threshold = float(threshold)
+        self._previous = None
+
+    def __call__(self, steps, coordinates, monitors):
+        previous, self._previous = self._previous, coordinates
+        if previous is None:
+            return False
+        d = coordinates - previous
+        rmsd = np.sqrt(np.einsum('ij,ij->', d, d) / len(d))
+        return rmsd > self.threshold
+
+    def __str__(self):
+        return 'RMSD jump > {}'.format(self.threshold)
+
+
+class CrossingRule(object):
+
+    """
+    Fires when the monitor `name` crosses `value`. `direction` can be
+    'up', 'down' or 'any'.
+    """
+
+    def __init__(self, name, value, direction='any'):
+        if direction not in ('up', 'down', 'any'):
+            raise ValueError('Unknown direction {}'.format(direction))
+        self.name = name
+        self.value = float(value)
+        self.direction = direction
+        self._previous = None
+
+    def __call__(self, steps, coordinates, monitors):
+        current = monitors[self.name]
+        previous, self._previous = self._previous, current
+        if previous is None:
+            return False
+        if self.direction in ('up', 'any') and previous <= self.value < current:
+            return True
+        if self.direction in ('down', 'any') and previous >= self.value > current:
+            return True
+        return False
+
+    def __str__(self):
+        return '{} crosses {} ({})'.format(self.name, self.value, self.direction)
+
+
+class ContactBreakRule(CrossingRule):
+
+    """
+    Fires when the distance monitor `name` grows beyond `cutoff`.
+    """
+
+    def __init__(self, name, cutoff=4.0):
+        super(ContactBreakRule, self).__init__(name, cutoff, direction='up')
+
+    def __str__(self):
+        return 'contact {} breaks (> {})'.format(self.name, self.value)
+
+
+class FrameCapture(object):
+
+    """
+    Keeps full-resolution frames around structural events.
+
+    Every incoming frame is fed, in order, before the live stream is
+    thinned. Only the last `window` frames are held in memory until a
+    rule fires; then those frames, the triggering one and the next
+    `window` frames are stored in `captured`.
+    """
+
+    def __init__(self, rules=(), window=5):
+        self.rules = list(rules)
+        self.window = int(window)
+        self.captured = []
+        self.events = []
+        self._recent = deque(maxlen=self.window)
+        self._pending = 0
+
+    def __len__(self):
+        return len(self.captured)
+
+    def feed(self, steps, coordinates, monitors=None):
+        """
+        Evaluate all rules on one frame. `monitors` maps monitor names
+        to their current values. Returns the rules that fired.
+        """
+        if not self.rules:
+            return []
+        frame = steps, np.asarray(coordinates, dtype='float32')
+        fired = [rule for rule in self.rules if rule(steps, coordinates, monitors or {})]
+        if fired:
+            self.events.append((steps, [str(rule) for rule in fired]))
+            self.captured.extend(self._recent)
+            self._recent.clear()
+            self.captured.append(frame)
+            self._pending = self.window
+        elif self._pending:
+            self.captured.append(frame)
+            self._pending -= 1
+        else:
+            self._recent.append(frame)
+        return fired
+
+    def save(self, path):
+        """
+        Write captured frames and events to a compressed NumPy archive.
+        """
+        steps = np.array([s for (s, _) in self.captured])
+        coordinates = np.array([c for (_, c) in self.captured], dtype='float32')
+        events = np.array(['{}: {}'.format(s, ', '.join(r)) for (s, r) in self.events])
+        np.savez_compressed(path, steps=steps, coordinates=coordinates, events=events)
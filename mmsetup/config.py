@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Headless MMSetup configuration.
+
+`Configuration` holds everything an OMMProtocol input is made of, with
+typed values and no Tk involved, so setups can be built, validated and
+written programmatically. The dialog's Model only binds its variables
+to one of these.
+
+    config = Configuration(topology='sys.prmtop', positions='sys.inpcrd',
+                           timestep=2, temperature=300)
+    config.add_stage('production', steps=50000)
+    config.write('production.yaml')
+"""
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+from copy import deepcopy
+import yaml
+# Own
+from inputs import write_input
+
+SECTIONS = ('md_input', 'md_output', 'md_hardware', 'md_conditions', 'md_systemoptions')
+
+# (section, key, type, default)
+FIELDS = (
+    ('md_input', 'topology', str, None),
+    ('md_input', 'positions', str, None),
+    ('md_input', 'forcefield', list, None),
+    ('md_input', 'charmm_parameters', str, None),
+    ('md_input', 'velocities', str, None),
+    ('md_input', 'box_vectors', str, None),
+    ('md_input', 'checkpoint', str, None),
+    ('md_output', 'project_name', str, None),
+    ('md_output', 'restart', str, None),
+    ('md_output', 'outputpath', str, None),
+    ('md_output', 'report', bool, True),
+    ('md_output', 'report_every', int, None),
+    ('md_output', 'trajectory', str, None),
+    ('md_output', 'trajectory_every', int, None),
+    ('md_output', 'trajectory_new_every', int, None),
+    ('md_output', 'trajectory_atom_subset', str, None),
+    ('md_output', 'restart_every', int, None),
+    ('md_hardware', 'platform', str, None),
+    ('md_hardware', 'precision', str, None),
+    ('md_hardware', 'platform_properties', dict, None),
+    ('md_conditions', 'timestep', float, None),
+    ('md_conditions', 'integrator', str, None),
+    ('md_conditions', 'barostat', bool, False),
+    ('md_conditions', 'temperature', float, None),
+    ('md_conditions', 'friction', float, None),
+    ('md_conditions', 'pressure', float, None),
+    ('md_conditions', 'barostat_interval', int, None),
+    ('md_systemoptions', 'nonbondedMethod', str, None),
+    ('md_systemoptions', 'nonbondedCutoff', float, None),
+    ('md_systemoptions', 'ewaldErrorTolerance', float, None),
+    ('md_systemoptions', 'constraints', str, None),
+    ('md_systemoptions', 'rigidWater', bool, False),
+    ('md_systemoptions', 'hydrogenMass', float, None))
+
+FIELD_SECTION = dict((key, section) for (section, key, _, _) in FIELDS)
+FIELD_TYPE = dict((key, kind) for (_, key, kind, _) in FIELDS)
+
+# Constraints that allow timesteps above 2 fs
+STRICT_CONSTRAINTS = ('HBonds', 'AllBonds', 'HAngles')
+
+
+def coerce(kind, value):
+    """
+    Convert `value`, possibly a string coming from a Tk variable, to
+    `kind`. Empty values and ``'None'`` become None.
+    """
+    if value is None or value == 'None':
+        return None
+    if kind is bool:
+        if isinstance(value, basestring):
+            return value.strip().lower() == 'true'
+        return bool(value)
+    if isinstance(value, basestring):
+        value = value.strip()
+        if not value:
+            return None
+    if kind is int:
+        return int(float(value))
+    if kind is float:
+        return float(value)
+    if kind is str:
+        return value if isinstance(value, basestring) else str(value)
+    if kind is list:
+        return [value] if isinstance(value, basestring) else list(value)
+    return kind(value)
+
+
+class Configuration(object):
+
+    """
+    Typed settings of an OMMProtocol run, grouped in the sections of
+    the input (md_input, md_output...) plus the list of stages.
+
+    Values are set with `set` (or as keyword arguments) and converted
+    to the type declared in FIELDS. A section only holds the keys with
+    a value: unset, empty and zero values are left out, so the input
+    falls back to OMMProtocol's defaults. Booleans are always kept.
+    """
+
+    def __init__(self, stages=None, **values):
+        for section in SECTIONS:
+            setattr(self, section, {})
+        for section, key, kind, default in FIELDS:
+            self.set(key, default)
+        for key, value in values.items():
+            self.set(key, value)
+        self.stages = [dict(stage) for stage in stages or ()]
+
+    def __repr__(self):
+        return '<Configuration {} ({} stages)>'.format(
+            self.md_output.get('project_name', 'sys'), len(self.stages))
+
+    def set(self, key, value):
+        if key not in FIELD_SECTION:
+            raise ValueError('Unknown setting {}'.format(key))
+        section = getattr(self, FIELD_SECTION[key])
+        try:
+            value = coerce(FIELD_TYPE[key], value)
+        except (TypeError, ValueError):
+            raise ValueError('Wrong value for {}: {!r}'.format(key, value))
+        if isinstance(value, bool) or value:
+            section[key] = value
+        else:
+            section.pop(key, None)
+
+    def get(self, key, default=None):
+        if key not in FIELD_SECTION:
+            raise ValueError('Unknown setting {}'.format(key))
+        return getattr(self, FIELD_SECTION[key]).get(key, default)
+
+    def update(self, **values):
+        for key, value in values.items():
+            self.set(key, value)
+
+    def add_stage(self, name, steps, **options):
+        """
+        Append a stage. `options` are written as they are.
+        """
+        stage = dict(options, name=name, steps=int(steps))
+        self.stages.append(dict((k, v) for (k, v) in stage.items()
+                                if v not in (None, 'None')))
+        return stage
+
+    @property
+    def sections(self):
+        return [getattr(self, section) for section in SECTIONS]
+
+    @property
+    def total_steps(self):
+        return sum(int(stage['steps']) for stage in self.stages)
+
+    def validate(self):
+        """
+        Raise ValueError if this cannot make a valid input. Returns the
+        warnings about settings that are valid but likely unstable.
+        """
+        if not self.md_input.get('topology'):
+            raise ValueError('A topology is needed')
+        if not self.stages:
+            raise ValueError('Add at least one stage')
+        hydrogen_mass = self.md_systemoptions.get('hydrogenMass')
+        if hydrogen_mass is not None and hydrogen_mass <= 1.008:
+            raise ValueError('Hydrogen mass must be above 1.008 amu to repartition it')
+        warnings = []
+        names = set()
+        for stage in self.stages:
+            if not stage.get('name'):
+                raise ValueError('Every stage needs a name')
+            try:
+                int(stage['steps'])
+            except (KeyError, TypeError, ValueError):
+                raise ValueError('Stage {} needs a number of steps'.format(stage['name']))
+            if stage['name'] in names:
+                raise ValueError('Stage names must be unique: {}'.format(stage['name']))
+            if stage.get('parent') and stage['parent'] not in names:
+                raise ValueError('Stage {} forks from {}, which is not an earlier '
+                                 'stage'.format(stage['name'], stage['parent']))
+            names.add(stage['name'])
+            # Stages may override both, and OMMProtocol drops the
+            # constraints of stages with constrained atoms
+            timestep = stage.get('timestep', self.md_conditions.get('timestep'))
+            if not int(stage['steps']) or not timestep or float(timestep) <= 2:
+                continue
+            constraints = stage.get('constraints', self.md_systemoptions.get('constraints'))
+            if stage.get('constrained_atoms') or constraints not in STRICT_CONSTRAINTS:
+                raise ValueError('Stage {} uses {} fs timesteps, which need HBonds '
+                                 'constraints or stricter'.format(stage['name'], timestep))
+            if hydrogen_mass is None:
+                warnings.append('Stage {} uses {} fs timesteps without hydrogen mass '
+                                'repartitioning; a hydrogen mass of 3-4 amu makes it '
+                                'stabler'.format(stage['name'], timestep))
+        return warnings
+
+    def copy(self, **values):
+        """
+        Deep copy, with some settings changed
+        """
+        clone = deepcopy(self)
+        clone.update(**values)
+        return clone
+
+    def to_dict(self):
+        data = dict((section, deepcopy(getattr(self, section))) for section in SECTIONS)
+        data['stages'] = deepcopy(self.stages)
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        config = cls(stages=data.get('stages'))
+        for section in SECTIONS:
+            for key, value in (data.get(section) or {}).items():
+                config.set(key, value)
+        return config
+
+    def save(self, path):
+        """
+        Store as YAML, to be read back with `load`. This is not an
+        OMMProtocol input: use `write` for that.
+        """
+        with open(path, 'w') as f:
+            f.write('# MMSetup configuration\n')
+            yaml.safe_dump(self.to_dict(), f, default_flow_style=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(yaml.safe_load(f) or {})
+
+    def write(self, path, header=()):
+        """
+        Write the OMMProtocol input
+        """
+        self.validate()
+        write_input(path, *self.sections, stages=self.stages, header=header)
+        return path
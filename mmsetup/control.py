@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import signal
+import Tkinter as tk
+
+
+class ControlChannel(object):
+
+    """
+    Controls a running OMMProtocol slave with the signals it understands.
+
+    The slave does not read commands while it runs, so its report rates
+    cannot be changed. It can be paused and resumed with SIGSTOP and
+    SIGCONT, which `process.send_signal` delivers to its whole process
+    group if it runs detached. On SIGINT it asks whether to save the
+    current state, reading the answer from stdin, then writes
+    ``<project>_<NN>_<stage>_emergency.state`` and exits. `stop`
+    answers first and interrupts it next.
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self.paused = False
+
+    def _signal(self, sig):
+        try:
+            self.process.send_signal(sig)
+        except (IOError, OSError, ValueError):
+            # Slave already exited
+            return False
+        return True
+
+    def pause(self):
+        if not self.paused and self._signal(signal.SIGSTOP):
+            self.paused = True
+            return True
+        return False
+
+    def resume(self):
+        if self.paused and self._signal(signal.SIGCONT):
+            self.paused = False
+            return True
+        return False
+
+    def stop(self):
+        stdin = getattr(self.process, 'stdin', None)
+        try:
+            if stdin is not None:
+                stdin.write(b'y\n')
+                stdin.flush()
+            self.process.send_signal(signal.SIGINT)
+        except (IOError, OSError, ValueError):
+            # Slave already exited or closed its stdin
+            return False
+        if self.paused:  # a stopped slave only sees SIGINT once resumed
+            self._signal(signal.SIGCONT)
+            self.paused = False
+        return True
+
+
+class RunControlWindow(object):
+
+    """
+    Small panel to pause, resume or stop a running simulation through
+    its Controller.
+    """
+
+    def __init__(self, controller, title='MMSetup Run Control'):
+        self.controller = controller
+        self.window = tk.Toplevel()
+        self.window.title(title)
+
+        frame = tk.LabelFrame(self.window, text='Running simulation')
+        frame.pack(expand=True, fill='both', padx=5, pady=5)
+        self.ui_pause = tk.Button(frame, text='Pause', command=self._pause)
+        self.ui_pause.pack(expand=True, fill='x', padx=2, pady=2)
+        self.ui_stop = tk.Button(frame, text='Stop & Save', command=self._stop)
+        self.ui_stop.pack(expand=True, fill='x', padx=2, pady=2)
+
+    def _pause(self):
+        if self.controller.paused:
+            if self.controller.resume():
+                self.ui_pause.configure(text='Pause')
+        elif self.controller.pause():
+            self.ui_pause.configure(text='Resume')
+
+    def _stop(self):
+        if self.controller.stop():
+            self.ui_pause.configure(state='disabled')
+            self.ui_stop.configure(state='disabled')
+
+    def destroy(self):
+        try:
+            self.window.destroy()
+        except tk.TclError:
+            pass
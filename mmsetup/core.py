@@ -6,28 +6,61 @@ from __future__ import print_function, division
 # Python
 import os
 import sys
+import time
 from threading import Thread
-from Queue import LifoQueue, Empty
+from Queue import Queue, Empty
 from tkFileDialog import asksaveasfilename
-import pickle
 import numpy as np
 import yaml
 import chimera
+import chimera.tkgui
 from chimera.SubprocessMonitor import Popen, PIPE, SubprocessTask
 from chimera.tasks import Task
 from Movie.gui import MovieDialog
-
-
-def enqueue_output(out, queue):
-    while True:
-        line = out.readline()
-        if line == b'STARTOFCHUNK\n':
-            lines = []
-            for line in iter(out.readline, b'ENDOFCHUNK\n'):
-                lines.append(line)
-            queue.put(b''.join(lines))
-        elif line == b'':
-            break
+# Own
+from monitors import MonitorRegistry, MonitorPlot
+from capture import FrameCapture, RMSDJumpRule, CrossingRule, ContactBreakRule
+from control import ControlChannel, RunControlWindow
+from recovery import write_stop_record, plan_recovery, write_continuation
+from forces import ForceHotspots
+from slave import slave_command
+from stream import enqueue_output, iter_chunks, decode_chunk
+from jobs import Job, JobsWindow, get_scheduler
+from config import Configuration, FIELDS, coerce
+from sweep import SweepWindow
+from workers import WorkerPool
+from detach import (launch_detached, save_record, discard_stream, stream_files,
+                    DetachedProcess, DetachedJobsWindow)
+from benchmark import fastest_platform
+from affinity import launch_prefix, parse_cpulist, node_cpus, available_cpus
+from preflight import PreflightWindow
+from estimate import footprint, format_footprint, summarize_footprint, check_space
+from system import load_topology, subset_size, system_cache_prefix
+from history import get_history, measured, HistoryWindow
+from server import get_client, ServerProcess
+from backends import BatchWindow
+from replicas import write_replicas, launch_replicas, clone_models, ReplicaMonitor
+import memo
+from stagetree import StageTree, submit_tree
+from exports import export_pdb
+from ligands import resolve_ligands, cache_ligands, format_report
+
+
+def _forward_progress(process):
+    # Warm workers are spawned before the run they will serve is known
+    return process.progress_callback(process)
+
+
+_pool = None
+def get_worker_pool():
+    """
+    Warm workers for live and queued runs, shared by all MMSetup dialogs
+    """
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool(size=0, popen=Popen, progressCB=_forward_progress)
+        get_scheduler().pool = _pool
+    return _pool
 
 
 class Controller(object):
@@ -43,76 +76,620 @@ class Controller(object):
         self.ensemble = None
         self.movie_dialog = None
         self.molecule = None
+        self.monitors = MonitorRegistry()
+        self.monitor_plot = None
+        self.capture = FrameCapture()
+        self.channel = None
+        self.control_window = None
+        self.hotspots = None
+        self.jobs_window = None
+        self.record = None
+        self.footprint = None
+        self.stages = None
+        self.branches = None
+        self._run_input = None
+        self._run_started = None
+        self.replicas = None
+        self._first_report = self._last_report = None
+        self._paused_at = None
+        self._stopping = False
         self._last_steps = 0
+        self._step_offset = 0
+        self._retries = 0
+        self._record_saved = 0
+        self._reserved = 0
+        try:
+            self.warm_up()
+        except OSError as e:  # runs just start cold
+            chimera.statusline.show_message('Could not start warm workers: {}'.format(e))
+
+    def warm_up(self):
+        """
+        Get the shared warm workers ready while the dialog is filled in,
+        with its force fields preloaded. Runs that need other values of
+        the variables OpenMM reads on import get a fresh worker instead.
+        """
+        pool = get_worker_pool()
+        pool.size = self.model.warm_workers
+        pool.set_env(self.model.openmm_env)
+        pool.set_forcefields([f for f in self.model.forcefield if f.endswith('.xml')])
+        pool.fill()
+        return pool
 
     def set_mvc(self):
         self.gui.buttonWidgets['Save Input'].configure(command=self.saveinput)
+        self.gui.buttonWidgets['Pre-flight'].configure(command=self.preflight)
+        self.gui.buttonWidgets['Queue'].configure(command=self.enqueue)
+        self.gui.buttonWidgets['Sweep'].configure(command=self.sweep)
         self.gui.buttonWidgets['Run'].configure(command=self.run)
+        self.gui.buttonWidgets['Batch'].configure(command=self.batch)
+        self.gui.buttonWidgets['Attach'].configure(command=self.show_detached)
+        self.gui.buttonWidgets['History'].configure(command=self.show_history)
+        self.gui.buttonWidgets['Benchmark'].configure(command=self.benchmark)
+
+    def benchmark(self):
+        """
+        Time the current system on every platform of this machine in
+        the background, then select the fastest one in the dialog.
+        Results are cached per machine and system size.
+        """
+        self.model.parse()
+        settings = (dict(self.model.md_input), dict(self.model.md_systemoptions),
+                    dict(self.model.md_conditions))
+        results = []
+
+        def run():
+            try:
+                results.append(fastest_platform(*settings))
+            except Exception as e:
+                results.append(e)
+
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self.gui.buttonWidgets['Benchmark'].configure(state='disabled')
+        self.gui.status('Benchmarking platforms...', color='blue')
+        chimera.tkgui.app.after(500, self._benchmark_done, thread, results)
+
+    def _benchmark_done(self, thread, results):
+        if thread.is_alive():
+            return chimera.tkgui.app.after(500, self._benchmark_done, thread, results)
+        try:
+            self.gui.buttonWidgets['Benchmark'].configure(state='normal')
+        except Exception:  # dialog closed meanwhile
+            return
+        best = results[0] if results else None
+        if isinstance(best, Exception) or not best:
+            self.gui.status('Platform benchmark failed: {}'.format(best or 'no platform ran'),
+                            color='red')
+            return
+        self.model.apply_benchmark(best)
+        self.gui.status('Selected {} ({:.1f} ns/day)'.format(best['platform'],
+                        best['ns_per_day']), color='blue', blankAfter=4)
+
+    def preflight(self):
+        """
+        Time a few steps of the current system to project how long
+        each stage will take and how much trajectory it will write
+        """
+        self.model.parse()
+        PreflightWindow(self.model, title='Pre-flight for {}'.format(
+                        self.model.md_output['project_name']))
+
+    def enqueue(self):
+        """
+        Save the input and submit it to the session job scheduler,
+        which runs it in the background once enough CPU slots are free.
+        """
+        if not self.saveinput():
+            return
+        if self.branches:
+            return self.enqueue_branches()
+        natoms = self.footprint['natoms'] if self.footprint else None
+        if self.model.use_server:
+            job_id = get_client().submit(self.filename, threads=self.model.threads,
+                                         total_steps=self.model.total_steps,
+                                         timestep=self.model.md_conditions.get('timestep'),
+                                         affinity=self.model.affinity,
+                                         numa_node=self.model.numa_node, record=True,
+                                         env=self.model.system_env, natoms=natoms,
+                                         memoize=self.model.memoize)
+            self.gui.status('Queued on the job server as job #{}'.format(job_id),
+                            color='blue', blankAfter=4)
+            return job_id
+        scheduler = get_scheduler()
+        job = scheduler.submit(Job(self.filename, threads=self.model.threads,
+                                   total_steps=self.model.total_steps,
+                                   timestep=self.model.md_conditions.get('timestep'),
+                                   env=self.model.system_env, prefix=self.model.prefix))
+        job.add_done_callback(lambda job: get_history().record_job(job, natoms=natoms))
+        if self.model.memoize:
+            job.add_done_callback(memo.store_job)
+        self.gui.status('Queued as job #{}'.format(job.id), color='blue', blankAfter=4)
+        self.show_jobs()
+        return job
+
+    def enqueue_branches(self):
+        """
+        Queue the shared stages once and, as soon as they are done,
+        every branch that forks from them, in parallel
+        """
+        scheduler = get_scheduler()
+        reports = Queue()  # filled from the scheduler threads
+        submit_tree(scheduler, self.branches, threads=self.model.threads,
+                    timestep=self.model.md_conditions.get('timestep'),
+                    env=self.model.system_env, prefix=self.model.prefix,
+                    callback=lambda job: job.add_done_callback(
+                        lambda job: get_history().record_job(job)),
+                    report=reports.put)
+        self.gui.status('Queued {} branched inputs'.format(len(self.branches)),
+                        color='blue', blankAfter=4)
+        self.show_jobs()
+        chimera.tkgui.app.after(1000, self._show_reports, reports)
+
+    def _show_reports(self, reports):
+        while True:
+            try:
+                self.gui.status(reports.get_nowait(), color='red')
+            except Empty:
+                break
+        if any(job.state in ('queued', 'running') for job in get_scheduler().jobs):
+            chimera.tkgui.app.after(1000, self._show_reports, reports)
+
+    def sweep(self):
+        """
+        Expand the current settings over several parameter values
+        and queue all the resulting runs
+        """
+        self.model.parse()
+        if not StageTree(self.model.stages).is_linear:
+            raise ValueError('Sweeps need a linear protocol, without forked stages')
+        SweepWindow(self, title='Sweep for {}'.format(self.model.md_output['project_name']))
+
+    def batch(self):
+        """
+        Stage the current input, and any other prepared ones, and
+        submit them all to a batch system
+        """
+        inputs = [self.filename] if self.saveinput() else []
+        BatchWindow(inputs)
+
+    def show_jobs(self):
+        if self.jobs_window is None or not self.jobs_window.exists():
+            self.jobs_window = JobsWindow(get_scheduler())
 
     def run(self):
         if not self.saveinput():
             return
-        env = os.environ.copy()
-        env['OMMPROTOCOL_SLAVE'] = '1'
-        env['PYTHONIOENCODING'] = 'latin-1'
+        if self.branches:  # several runs, followed from the jobs window
+            return self.enqueue_branches()
+        if self.model.replicas > 1:
+            return self.run_replicas()
+        self._retries = 0
+        self._step_offset = 0
+        if not self.model.use_server:  # the server does its own accounting
+            self.reserve_threads(self.model.threads)
+        self._run_input, self._run_started = self.filename, time.time()
+        self._first_report = self._last_report = None
+        try:
+            process = self.launch(self.filename)
+        except Exception:
+            self.release_threads()
+            raise
+        self.monitor(process, self.gui.ui_chimera_models.getvalue(), self.stages,
+                     forces=bool(self.model.forces_every))
+        self.gui.Close()
+
+    def run_replicas(self):
+        """
+        Launch one copy of the protocol per replica and follow all of
+        them live from a single dialog
+        """
+        threads = self.model.threads
+        if not self.gui.var_advopt_threads.get():  # all cores, shared by the replicas
+            threads = max(1, threads // self.model.replicas)
+        inputs = write_replicas(self.model, self.filename, self.model.replicas, threads)
+        molecules = clone_models(self.gui.ui_chimera_models.getvalue(),
+                                 self.model.md_input['topology'], len(inputs))
+        self.reserve_threads(threads * len(inputs))
+        try:
+            processes = launch_replicas(inputs, self.model.prefix,
+                                        env=dict(self.model.system_env,
+                                                 OPENMM_CPU_THREADS=str(threads)))
+        except Exception:
+            self.release_threads()
+            raise
+        self.replicas = ReplicaMonitor(processes, molecules, self.model.total_steps,
+                                       title=os.path.basename(self.filename),
+                                       callback=self.release_threads)
+        self.gui.Close()
+
+    def launch(self, filename):
+        if self.model.use_server:
+            client = get_client()
+            job_id = client.submit(filename, threads=self.model.threads,
+                                   total_steps=self.model.total_steps,
+                                   timestep=self.model.md_conditions.get('timestep'),
+                                   affinity=self.model.affinity,
+                                   numa_node=self.model.numa_node,
+                                   env=self.model.slave_env)
+            return ServerProcess(client, job_id, progressCB=self._progress_cb)
+        pool = get_worker_pool()
+        extensions = self.model.slave_env
+        if self.model.detached:
+            env = dict(os.environ, OMMPROTOCOL_SLAVE='1', PYTHONIOENCODING='latin-1',
+                       **extensions)
+            self.record, child = launch_detached(
+                filename, env=env, prefix=self.model.prefix,
+                topology=self.model.md_input['topology'],
+                total_steps=self.model.total_steps,
+                stages=[dict(name=s['name'], steps=int(s['steps'])) for s in self.stages],
+                outputpath=self.model.md_output.get('outputpath'),
+                project_name=self.model.md_output.get('project_name'),
+                monitors=[[name, list(indices)] for (name, indices) in self.model.monitors],
+                forces=bool(self.model.forces_every))
+            return DetachedProcess(self.record, popen=child, progressCB=self._progress_cb)
+        if pool.size and not self.model.prefix:  # warm workers cannot be bound
+            process = pool.acquire(filename, env=dict(self.model.openmm_env, **extensions))
+            process.progress_callback = self._progress_cb
+            return process
+        env = dict(os.environ, OMMPROTOCOL_SLAVE='1', PYTHONIOENCODING='latin-1', **extensions)
+        return Popen(slave_command(filename, self.model.prefix), stdin=PIPE, stdout=PIPE,
+                     stderr=PIPE, progressCB=self._progress_cb,
+                     #universal_newlines=True,
+                     bufsize=1, env=env)
+
+    def attach(self, record, backfill=True):
+        """
+        Reattach to a detached run, possibly started in another session.
+        Frames already in its stream are loaded first, then it is
+        followed live as if it had been started from here.
+        """
+        self.record = record
+        self.filename = record['input']
+        self._run_input = record['input']
+        self._run_started = time.mktime(time.strptime(record['started'], '%Y-%m-%d %H:%M:%S'))
+        self._first_report = self._last_report = None
+        self.model.total_steps = record['total_steps']
+        molecule = chimera.openModels.open(record['topology'])[0]
+        offset = self.backfill(molecule, stream_files(record)) if backfill else 0
+        process = DetachedProcess(record, offset=offset, progressCB=self._progress_cb)
+        self.monitor(process, molecule, record['stages'], backfilled=True,
+                     monitors=record.get('monitors', []), forces=record.get('forces', False))
+        self.gui.Close()
+
+    def backfill(self, molecule, paths):
+        """
+        Load every position frame already in the stream files `paths`,
+        oldest first, as new coordsets. Returns the offset where the
+        last one must be resumed.
+        """
+        for path in paths:
+            end = 0
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as f:
+                for chunk in iter_chunks(f):
+                    end = f.tell()
+                    kind, steps, array = decode_chunk(chunk)
+                    if kind == 'positions':
+                        cs = molecule.newCoordSet(len(molecule.coordSets))
+                        cs.load(np.array(array) * 10.)
+                        self._last_steps = steps
+        if molecule.coordSets:
+            molecule.activeCoordSet = molecule.coordSets[max(molecule.coordSets)]
+        return end
+
+    def monitor(self, process, molecule, stages, backfilled=False, monitors=None,
+                forces=False):
+        """
+        Follow a running slave: progress, live frames in MD Movie,
+        monitors, captures, force hotspots if it streams `forces`, and
+        the control window. `monitors` are those of a run launched
+        elsewhere (see set_monitors).
+        """
+        self.subprocess = process
+        self.stages = stages
         self.task = Task("OMMProtocol for {}".format(self.filename), cancelCB=self._clear_cb,
                          statusFreq=((1,),1))
-        self.subprocess = Popen(['ommprotocol', self.filename], stdout=PIPE, stderr=PIPE,
-                                progressCB=self._progress_cb, #universal_newlines=True,
-                                bufsize=1, env=env)
+        self.channel = ControlChannel(self.subprocess)
         self.progress = SubprocessTask("OMMProtocol", self.subprocess,
                                        task=self.task, afterCB=self._after_cb)
         self.task.updateStatus("Running OMMProtocol")
-        self.queue = LifoQueue()
+        self.queue = Queue()
         thread = Thread(target=enqueue_output, args=(self.subprocess.stdout, self.queue))
         thread.daemon = True  # thread dies with the program
         thread.start()
         self.ensemble = _TrajProxy()
-        self.molecule = self.ensemble.molecule = self.gui.ui_chimera_models.getvalue()
+        self.molecule = self.ensemble.molecule = molecule
         self.ensemble.name = 'Trajectory for {}'.format(self.molecule.name)
-        self.ensemble.startFrame = self.ensemble.endFrame = 1
+        self.ensemble.startFrame = 1
+        self.ensemble.endFrame = len(self.molecule.coordSets) if backfilled else 1
         self.movie_dialog = MovieDialog(self.ensemble, externalEnsemble=True)
-        self.gui.Close()
+        self.set_monitors(monitors)
+        if forces and self.hotspots is None:
+            self.hotspots = ForceHotspots(self.molecule)
+        self.control_window = RunControlWindow(self,
+            title='Run control for {}'.format(self.molecule.name))
+
+    def show_detached(self):
+        DetachedJobsWindow(self)
+
+    def reserve_threads(self, threads):
+        """
+        Take the threads of a live run out of the session job budget,
+        so queued jobs do not oversubscribe the machine meanwhile
+        """
+        try:
+            get_scheduler().reserve(threads)
+        except ValueError as e:
+            raise chimera.UserError(str(e))
+        self._reserved += threads
+
+    def release_threads(self):
+        if self._reserved:
+            get_scheduler().release(self._reserved)
+            self._reserved = 0
+
+    def set_monitors(self, monitors=None):
+        """
+        Monitors and capture rules of the dialog or, for a run launched
+        elsewhere, just the (name, indices) `monitors` it was started with
+        """
+        rules = []
+        if monitors is None:
+            monitors, rules = self.model.monitors, self.model.capture_rules
+        self.monitors = MonitorRegistry()
+        for name, indices in monitors:
+            self.monitors.add(name, indices)
+        if self.monitors:
+            try:
+                self.monitor_plot = MonitorPlot(self.monitors,
+                    title='Monitors for {}'.format(self.molecule.name))
+            except ImportError:
+                chimera.statusline.show_message('Install matplotlib to plot monitors')
+        self.capture = FrameCapture(rules, window=self.model.capture_window)
+
+    def save_captures(self):
+        if not self.capture:
+            return
+        path = os.path.splitext(self.filename)[0] + '_captured.npz'
+        self.capture.save(path)
+        chimera.statusline.show_message('{} captured frames saved to {}'.format(
+                                        len(self.capture), path))
+        return path
 
     def _clear_cb(self, *args):
         self.task.finished()
+        if self.paused:  # or it would never see the signal that ends it
+            self.channel.resume()
+        self.release_threads()
         self.task, self.subprocess, self.queue, self.progress, self.molecule = [None] * 5
+        self.clear_hotspots()
         if self.movie_dialog is not None:
             self.movie_dialog.Close()
             self.movie_dialog = None
+        if self.monitor_plot is not None:
+            self.monitor_plot.destroy()
+            self.monitor_plot = None
+        if self.control_window is not None:
+            self.control_window.destroy()
+            self.control_window = None
+        self.channel = None
+
+    def clear_hotspots(self):
+        if self.hotspots is not None:
+            self.hotspots.restore()
+            self.hotspots = None
+
+    @property
+    def paused(self):
+        return self.channel is not None and self.channel.paused
+
+    def pause(self):
+        """
+        Suspend the slave where it is, keeping everything in memory
+        """
+        if self.channel is not None and self.channel.pause():
+            self._paused_at = time.time()
+            self.task.updateStatus("Paused")
+            return True
+
+    def resume(self):
+        if self.channel is not None and self.channel.resume():
+            self._unpause()
+            self.task.updateStatus("Running OMMProtocol")
+            return True
+
+    def _unpause(self):
+        # Time spent paused does not count for wall time and throughput
+        paused, self._paused_at = time.time() - self._paused_at, None
+        if self._run_started is not None:
+            self._run_started += paused
+        if self._first_report is not None:
+            self._first_report = (self._first_report[0] + paused, self._first_report[1])
+
+    def stop(self):
+        """
+        Interrupt the slave so it saves an emergency state and exits.
+        The stage and step reached, and that state, are recorded once
+        it has exited.
+        """
+        paused = self.paused
+        if self.channel is not None and self.channel.stop():
+            if paused:
+                self._unpause()
+            self._stopping = True
+            self.task.updateStatus("Stopping and saving state")
+            return True
 
     def _after_cb(self, aborted):
+        self.save_captures()
+        if self.record is not None:
+            self.record['last_steps'] = self._last_steps
+            save_record(self.record)
+            discard_stream(self.record)  # already read, and only useful while running
         if aborted:
+            self.log_run('cancelled')
             self._clear_cb()
             return
-        if self.subprocess.returncode:
+        if self.subprocess.returncode and not self._stopping:
             last = self.subprocess.stderr.readlines()[-1]
             msg = "OMMProtocol calculation failed! Reason: {}".format(last)
+            if self.recover(last):
+                return
+            self.log_run('failed')
             self._clear_cb()
             raise chimera.UserError(msg)
         self.task.finished()
-        chimera.statusline.show_message('Yay! MD Done!')
+        self.clear_hotspots()
+        if self.control_window is not None:
+            self.control_window.destroy()
+            self.control_window = None
+        self.channel = None
+        inputfile = self._run_input  # not the retry inputs, if recovered
+        self.log_run('stopped' if self._stopping else 'done')
+        self.release_threads()
+        cached = 0
+        if not self._stopping and self.model.memoize and inputfile:
+            try:
+                cached = memo.store(inputfile)
+            except Exception as e:
+                chimera.statusline.show_message('Stages not cached: {}'.format(e), color='red')
+                return
+        if self._stopping:
+            self._stopping = False
+            record = self.write_stop_record()
+            if record['state'] is None:
+                chimera.statusline.show_message(
+                    'MD stopped at step {steps} (stage {stage}) before its state could be '
+                    'saved.'.format(**record), color='red')
+            else:
+                chimera.statusline.show_message(
+                    'MD stopped at step {steps} (stage {stage}). State saved to '
+                    '{state}.'.format(**record))
+            return
+        chimera.statusline.show_message('Yay! MD Done!{}'.format(
+            ' Cached the final state of {} stage(s).'.format(cached) if cached else ''))
+
+    def log_run(self, state):
+        """
+        Store the finished live run in the run history
+        """
+        if self._run_input is None:
+            return
+        natoms = self.footprint['natoms'] if self.footprint else None
+        try:
+            get_history().record(self._run_input, self._run_started, self._last_steps, state,
+                                 self.subprocess.returncode, natoms=natoms,
+                                 measured=measured(self._first_report, self._last_report))
+        except Exception as e:
+            chimera.statusline.show_message('Run not recorded in the history: {}'.format(e))
+        self._run_input = None
+
+    def show_history(self):
+        natoms = None
+        try:
+            self.model.parse()
+            natoms = self.model.atom_counts()[0]
+        except Exception:  # rank all sizes
+            pass
+        HistoryWindow(get_history(), natoms=natoms)
+
+    def recover(self, reason):
+        """
+        Continue a failed run from its newest restart or checkpoint
+        file, if auto-recovery is enabled and retries are left. The
+        relaunch is delayed with an exponential backoff.
+        """
+        if not self.model.recover or self._retries >= self.model.recover_retries:
+            return False
+        self._progress_cb(self.subprocess)  # consume the last frames
+        plan = plan_recovery(self.filename, self._last_steps - self._step_offset)
+        if plan is None:
+            return False
+        state, stages, skipped, note = plan
+        self._retries += 1
+        base = os.path.splitext(self.filename)[0].split('_retry')[0]
+        filename = write_continuation(self.filename, '{}_retry{}.yaml'.format(
+                                      base, self._retries), state, stages)
+        delay = self.model.recover_backoff * 2 ** (self._retries - 1)
+        msg = 'OMMProtocol failed ({}). Retry {}/{} from {} in {} s'.format(
+            reason.strip(), self._retries, self.model.recover_retries,
+            os.path.basename(state), delay)
+        if note:
+            msg += ': ' + note
+        self.task.updateStatus(msg)
+        chimera.statusline.show_message(msg)
+        molecule, self.subprocess = self.molecule, None
+        self._step_offset += skipped
+        chimera.tkgui.app.after(int(delay * 1000), lambda:
+            self.relaunch(filename, molecule, stages))
+        return True
+
+    def relaunch(self, filename, molecule, stages):
+        self.task.finished()
+        if self.movie_dialog is not None:
+            self.movie_dialog.Close()
+        if self.control_window is not None:
+            self.control_window.destroy()
+        self.filename = filename
+        self.monitor(self.launch(filename), molecule, stages, backfilled=True)
+
+    def write_stop_record(self):
+        self._progress_cb(self.subprocess)  # consume the last frames
+        path = os.path.splitext(self.filename)[0] + '_stopped.yaml'
+        return write_stop_record(path, self.filename, self.stages,
+                                 self._last_steps - self._step_offset,
+                                 outputpath=self.model.md_output.get('outputpath'),
+                                 project_name=self.model.md_output.get('project_name'))
 
     def _progress_cb(self, process):
-        try:
-            chunk = self.queue.get_nowait()
-        except Empty:
+        # Every queued frame goes through the monitors and capture
+        # rules, but only the most recent one is displayed
+        frames = []
+        forces = None
+        while True:
+            try:
+                chunk = self.queue.get_nowait()
+            except Empty:
+                break
+            kind, steps, array = decode_chunk(chunk)
+            steps += self._step_offset
+            if kind == 'forces':
+                forces = array
+                continue
+            coordinates = np.array(array) * 10.
+            row = self.monitors.evaluate(coordinates, steps)
+            values = {} if row is None else dict(zip(self.monitors.names, row))
+            if self.capture.feed(steps, coordinates, values):
+                chimera.statusline.show_message('Event captured at step {}'.format(steps))
+            frames.append((steps, coordinates))
+
+        if forces is not None and self.hotspots is not None:
+            self.hotspots.update(forces)
+
+        if not frames or frames[-1][0] == self._last_steps:
             return self._last_steps / self.model.total_steps
 
-        steps, positions = pickle.loads(chunk)
-        if steps == self._last_steps:
-            self._last_steps / self.model.total_steps
-
-        self._last_steps = steps
+        self._last_steps, coordinates = frames[-1]
+        self._last_report = (time.time(), self._last_steps)
+        if self._first_report is None:
+            self._first_report = self._last_report
 
         # Update positions in MD Movie Dialog
-        coordinates = np.array(positions) * 10.
         coordsets_so_far = len(self.molecule.coordSets)
         cs = self.molecule.newCoordSet(coordsets_so_far)
         cs.load(coordinates)
         self.ensemble.endFrame = self.movie_dialog.endFrame = coordsets_so_far + 1
         self.movie_dialog.moreFramesUpdate('', [], self.movie_dialog.endFrame)
         self.movie_dialog.plusCallback()
+        if self.monitor_plot is not None:
+            self.monitor_plot.update()
+        if self.record is not None and time.time() - self._record_saved > 10:
+            self.record['last_steps'] = self._last_steps
+            save_record(self.record)
+            self._record_saved = time.time()
 
         return self._last_steps / self.model.total_steps
 
@@ -124,30 +701,101 @@ class Controller(object):
         if not path:
             return
         self.write(path)
-        self.gui.status('Written to {}'.format(path), color='blue', blankAfter=4)
+        if self.model.ligands and self.model.ligands['misses']:
+            # For the next runs; this one converts them itself
+            thread = Thread(target=cache_ligands, args=(list(self.model.md_input['forcefield']),))
+            thread.daemon = True
+            thread.start()
+        warning = None
+        if self.footprint is not None:
+            warning = check_space(self.footprint, self.model.md_output.get('outputpath'))
+        note = ''
+        if self.branches:
+            note = ' and {} branch input(s) next to it'.format(len(self.branches) - 1)
+        elif len(self.stages) < len(self.model.stages):
+            note = ' (starts after cached stage {})'.format(
+                self.model.stages[-len(self.stages) - 1]['name'])
+        if self.footprint is not None:
+            note += '; ' + summarize_footprint(self.footprint)
+        if self.model.ligands_message:
+            note += '. ' + self.model.ligands_message
+        warnings = self.model.warnings + ([warning] if warning else [])
+        if warnings:
+            self.gui.status('Written to {}{}. {}!'.format(path, note, '. '.join(warnings)),
+                            color='red')
+        else:
+            self.gui.status('Written to {}{}'.format(path, note), color='blue', blankAfter=4)
         return True
 
+    def estimate(self, stages=None):
+        """
+        Disk and memory footprint of the current settings, or None if
+        the topology cannot be read
+        """
+        try:
+            natoms, subset = self.model.atom_counts()
+        except Exception:  # the input is written without it
+            return None
+        if stages is None:
+            stages = self.model.stages
+        return footprint(natoms, stages, self.model.md_output, subset)
+
     def write(self, output):
         # Write input
         self.filename = output
-        with open(self.filename, 'w') as f:
-            f.write('# Yaml input for OpenMM MD\n\n')
-            f.write('# input\n')
-            yaml.dump(self.model.md_input, f, default_flow_style=False)
-            f.write('\n')
-            f.write('# output\n')
-            yaml.dump(self.model.md_output, f, default_flow_style=False)
-            if self.model.md_hardware:
-                f.write('\n# hardware\n')
-                yaml.dump(self.model.md_hardware, f, default_flow_style=False)
-            f.write('\n# conditions\n')
-            yaml.dump(self.model.md_conditions, f, default_flow_style=False)
-            f.write('\n# OpenMM system options\n')
-            yaml.dump(self.model.md_systemoptions, f, default_flow_style=False)
-            f.write('\n\nstages:\n')
-            for stage in self.model.stages:
-                yaml.dump([stage], f, indent=8, default_flow_style=False)
-                f.write('\n')
+        header = []
+        config, self.stages = self.model.config, self.model.stages
+        self.branches = None
+        tree = StageTree(self.stages)
+        if not tree.is_linear:
+            return self.write_branches(tree, output, config)
+        if self.model.memoize:
+            md_input, self.stages, keys, resumed = self.skip_cached_stages()
+            if resumed is not None:
+                header.append('Starts from the cached final state of stage {}'.format(resumed))
+                config = config.copy()
+                config.md_input, config.stages = md_input, self.stages
+        if self.model.cache_system:
+            header.append('Runs from MMSetup reuse the Systems cached as {}_*.xml'.format(
+                          system_cache_prefix(config.md_input)))
+        if self.model.prefix:
+            header.append('Launch with: {} ommprotocol {}'.format(
+                          ' '.join(self.model.prefix), os.path.basename(output)))
+        self.footprint = self.estimate(self.stages)
+        if self.footprint is not None:
+            header.extend(['Estimated footprint'] + format_footprint(self.footprint))
+        config.write(self.filename, header=header)
+        if self.model.memoize:
+            memo.register(self.filename, keys, self.stages,
+                          self.model.md_output.get('outputpath'),
+                          self.model.md_output.get('project_name'))
+
+    def write_branches(self, tree, output, config):
+        """
+        One input per segment of the stage tree: the shared stages go
+        to `output` and each branch to its own file next to it
+        """
+        self.footprint = self.estimate()
+        header = []
+        if self.footprint is not None:
+            header.extend(['Estimated footprint (all branches)'] + format_footprint(self.footprint))
+        self.branches = tree.write(output, *config.sections, header=header)
+
+    def skip_cached_stages(self):
+        """
+        Leading stages whose final state is already cached, for the
+        same inputs, are not run again: the run starts from the state
+        of the deepest one.
+        """
+        md_input, stages, keys, resumed = memo.skip_cached(
+            self.model.md_input, self.model.md_systemoptions,
+            self.model.md_conditions, self.model.stages)
+        if not stages:
+            raise ValueError('Every stage is already cached. Disable '
+                             '"Reuse Cached Stages" to run them again.')
+        if resumed is not None:
+            self.model.total_steps = sum(int(s['steps']) for s in stages)
+        return md_input, stages, keys, resumed
 
 
 class _TrajProxy:
@@ -164,49 +812,244 @@ class Model(object):
     def __init__(self, gui, *args, **kwargs):
         self.gui = gui
         self.total_steps = None
-        self.md_input = {'topology': None,
-                         'positions': None,
-                         'forcefield': None,
-                         'charmm_parameters': None,
-                         'velocities': None,
-                         'box_vectors': None,
-                         'checkpoint': None}
-
-        self.md_output = {'project_name': None,
-                          'restart': None,
-                          'trajectory_every': None,
-                          'outputpath': None,
-                          'report_every': None,
-                          'trajectory_every': None,
-                          'trajectory_new_every': None,
-                          'restart_every': None,
-                          'trajectory_atom_subset': None,
-                          'report': True,
-                          'trajectory': None,
-                          # 'attempt_rescue': False,
-                          # 'verbose': False
-                          }
-
-        self.md_hardware = {'platform':None,
-                            'precision': None}
-
-        self.md_conditions = {'timestep': None,
-                              'integrator': None,
-                              'barostat': False,
-                              'temperature': None,
-                              'friction': None,
-                              'pressure': None,
-                              'barostat_interval': None}
-
-        self.md_systemoptions = {'nonbondedMethod': None,
-                                 'nonbondedCutoff': None,
-                                 'ewaldErrorTolerance': None,
-                                 'constraints': None,
-                                 'rigidWater': False}
+        self.prefix = []
+        self.config = Configuration()
+        self.ligands_message = None
+        self.warnings = []
+        self.ligands = None
+        self._exported = None
+
+    @property
+    def md_input(self):
+        return self.config.md_input
+
+    @property
+    def md_output(self):
+        return self.config.md_output
+
+    @property
+    def md_hardware(self):
+        return self.config.md_hardware
+
+    @property
+    def md_conditions(self):
+        return self.config.md_conditions
+
+    @property
+    def md_systemoptions(self):
+        return self.config.md_systemoptions
 
     @property
     def stages(self):
-        return self.gui.stages
+        return self.config.stages
+
+    @property
+    def monitors(self):
+        """
+        Monitors defined in the GUI, as (name, atom indices) pairs.
+        Indices refer to the atom order of the selected molecule,
+        which is the order of the streamed coordinates.
+        """
+        if not self.gui.monitors:
+            return []
+        model = self.gui.ui_chimera_models.getvalue()
+        if model is None:
+            raise ValueError('Monitors are only available for Chimera models')
+        index = dict((atom, i) for (i, atom) in enumerate(model.atoms))
+        monitors = []
+        for name, atoms in self.gui.monitors:
+            try:
+                monitors.append((name, [index[a] for a in atoms]))
+            except KeyError:
+                raise ValueError('Monitor {} contains atoms from '
+                                 'another model'.format(name))
+        return monitors
+
+    @property
+    def capture_rules(self):
+        rules = []
+        if self.gui.var_capture_rmsd.get() > 0:
+            rules.append(RMSDJumpRule(self.gui.var_capture_rmsd.get()))
+        names = [name for (name, atoms) in self.gui.monitors]
+        for kind, name, value in self.gui.capture_rules:
+            if name not in names:
+                continue
+            if kind == 'contact':
+                rules.append(ContactBreakRule(name, value))
+            else:
+                rules.append(CrossingRule(name, value))
+        return rules
+
+    @property
+    def capture_window(self):
+        return self.gui.var_capture_window.get()
+
+    @property
+    def threads(self):
+        """
+        CPU threads for the run. 0 in the dialog means all the CPUs it
+        is bound to (see affinity and numa_node), or all of them.
+        """
+        threads = self.gui.var_advopt_threads.get()
+        if threads > 0:
+            return threads
+        return len(self.cpus or available_cpus())
+
+    @threads.setter
+    def threads(self, value):
+        self.gui.var_advopt_threads.set(value)
+
+    @property
+    def openmm_env(self):
+        """
+        Variables OpenMM reads on import that this run needs
+        """
+        return {'OPENMM_CPU_THREADS': str(self.threads)}
+
+    @property
+    def cpus(self):
+        """
+        CPUs the run is bound to (see affinity and numa_node), or None
+        """
+        if self.affinity:
+            return parse_cpulist(self.affinity)
+        if self.numa_node is not None:
+            return node_cpus(self.numa_node)
+
+    @property
+    def affinity(self):
+        """
+        CPU list the run is bound to, such as ``0-3,8``
+        """
+        return self.gui.var_advopt_affinity.get().strip() or None
+
+    @affinity.setter
+    def affinity(self, value):
+        self.gui.var_advopt_affinity.set(value or '')
+
+    @property
+    def numa_node(self):
+        value = self.gui.var_advopt_numa.get().strip()
+        if value:
+            return int(value)
+
+    @numa_node.setter
+    def numa_node(self, value):
+        self.gui.var_advopt_numa.set('' if value is None else value)
+
+    @property
+    def warm_workers(self):
+        return self.gui.var_advopt_workers.get()
+
+    @warm_workers.setter
+    def warm_workers(self, value):
+        self.gui.var_advopt_workers.set(value)
+
+    @property
+    def detached(self):
+        """
+        Whether Run launches the slave detached from Chimera, so it
+        survives the session and can be reattached later
+        """
+        return self.gui.var_run_detached.get()
+
+    @detached.setter
+    def detached(self, value):
+        self.gui.var_run_detached.set(value)
+
+    @property
+    def replicas(self):
+        """
+        Number of independent replicas launched by Run
+        """
+        return max(1, self.gui.var_run_replicas.get())
+
+    @replicas.setter
+    def replicas(self, value):
+        self.gui.var_run_replicas.set(value)
+
+    @property
+    def use_server(self):
+        """
+        Whether runs are submitted to the per-machine job server, which
+        schedules the cores fairly across all Chimera sessions
+        """
+        return self.gui.var_run_server.get()
+
+    @use_server.setter
+    def use_server(self, value):
+        self.gui.var_run_server.set(value)
+
+    @property
+    def recover(self):
+        """
+        Whether failed live runs are continued automatically from
+        their newest restart/checkpoint file
+        """
+        return self.gui.var_output_recover.get()
+
+    @recover.setter
+    def recover(self, value):
+        self.gui.var_output_recover.set(value)
+
+    @property
+    def memoize(self):
+        """
+        Whether the final states of completed stages are cached and
+        new runs skip the leading stages found in the cache
+        """
+        return self.gui.var_output_memoize.get()
+
+    @memoize.setter
+    def memoize(self, value):
+        self.gui.var_output_memoize.set(value)
+
+    @property
+    def recover_retries(self):
+        return self.gui.var_output_recover_retries.get()
+
+    @property
+    def recover_backoff(self):
+        """
+        Seconds before the first retry, doubled on every new retry
+        """
+        return self.gui.var_output_recover_backoff.get()
+
+    @property
+    def forces_every(self):
+        """
+        Steps between live force frames (0 disables them). Only used
+        when running from Chimera, so it is not written to the input.
+        """
+        return self.gui.var_forces_every.get()
+
+    @property
+    def slave_env(self):
+        """
+        Environment enabling the slave extensions (see slave.py)
+        """
+        env = self.system_env
+        if self.forces_every:
+            env['MMSETUP_FORCES_EVERY'] = str(self.forces_every)
+        return env
+
+    @property
+    def system_env(self):
+        """
+        Environment making slaves reuse serialized Systems cached for
+        the same topology, force fields and system options
+        """
+        if not self.cache_system:
+            return {}
+        return {'MMSETUP_SYSTEM': system_cache_prefix(self.md_input)}
+
+    @property
+    def cache_system(self):
+        return self.gui.var_advopt_syscache.get()
+
+    @cache_system.setter
+    def cache_system(self, value):
+        self.gui.var_advopt_syscache.set(value)
 
     @property
     def project_name(self):
@@ -222,10 +1065,13 @@ class Model(object):
             sanitized_path = '{0[0]}{1}{0[1]}'.format(os.path.splitext(model.name), '_fixed')
             if os.path.isfile(sanitized_path):
                 return sanitized_path
-            else:
-                output = getattr(model, 'openedAs', (model.name + '.pdb',))[0]
-                chimera.pdbWrite([model], chimera.Xform(), output)
-                return output
+            # Exported next to the output once per structure; positions
+            # reuses it while parsing
+            if self._exported is None or self._exported[0] is not model:
+                directory = os.path.abspath(os.path.expanduser(self.outputpath or '.'))
+                self._exported = model, export_pdb(model, directory,
+                                                   self.project_name or 'input')
+            return self._exported[1]
 
     @topology.setter
     def topology(self, value):
@@ -361,6 +1207,32 @@ class Model(object):
     def constraints(self, value):
         self.gui.var_advopt_constr.set(value)
 
+    def apply_benchmark(self, best):
+        """
+        Select the winner of a platform benchmark in the dialog
+        """
+        self.platform = best['platform']
+        precision = best['properties'].get('Precision')
+        if precision:
+            self.precision = precision
+        threads = best['properties'].get('Threads')
+        if threads:
+            self.threads = int(threads)
+
+    @property
+    def hydrogenMass(self):
+        """
+        Hydrogen mass for hydrogen mass repartitioning (amu), which
+        allows 4 fs timesteps with HBonds constraints, or None
+        """
+        value = self.gui.var_advopt_hmass.get().strip()
+        if value:
+            return float(value)
+
+    @hydrogenMass.setter
+    def hydrogenMass(self, value):
+        self.gui.var_advopt_hmass.set('' if value is None else value)
+
     @property
     def platform(self):
         value = self.gui.var_advopt_hardware.get()
@@ -483,88 +1355,58 @@ class Model(object):
         self.gui.self.var_traj_atoms.set(value)
 
     def parse(self):
-        self.reset_variables()
-        self.retrieve_settings()
+        self.config = self.retrieve_settings()
+        self.resolve_ligands()
         if self.md_hardware.get('platform'):
             precision = self.md_hardware.get('precision')
             if precision:
                 self.md_hardware['platform_properties'] = {'Precision': precision }
+        if self.md_hardware.get('platform') == 'CPU':
+            # No Precision here
+            self.md_hardware['platform_properties'] = {'Threads': str(self.threads)}
+        self.prefix = launch_prefix(self.affinity, self.numa_node)
         self.retrieve_stages()
-        if not self.stages:
-            raise ValueError('Add at least one stage')
+        self.warnings = self.config.validate()
+
+    def resolve_ligands(self):
+        """
+        Use the cached force field fragments of the GAFF ligands
+        added as external force fields. The others are converted by
+        OMMProtocol, and cached by the Controller once written.
+        """
+        forcefields, self.ligands = resolve_ligands(self.md_input.get('forcefield') or [])
+        self.ligands_message = format_report(self.ligands)
+        if self.ligands_message:
+            self.config.set('forcefield', forcefields)
+            self.gui.status(self.ligands_message, color='blue', blankAfter=4)
+        return self.ligands
+
+    def atom_counts(self):
+        """
+        Atoms in the system and in the trajectory subset (None when
+        there is no subset or it cannot be evaluated)
+        """
+        _, topology, _ = load_topology(self.md_input)
+        subset = self.md_output.get('trajectory_atom_subset')
+        return topology.getNumAtoms(), subset_size(topology, subset) if subset else None
 
     def retrieve_settings(self):
-        dictionaries=[self.md_input, self.md_output, self.md_hardware,
-                      self.md_conditions, self.md_systemoptions]
-        for dictionary in dictionaries:
-            for key, value in dictionary.items():
-                # Some combobox just returns boolean as a string so we fix that
-                value_to_store = getattr(self, key)
-                if value_to_store == 'True':
-                    value_to_store = True
-                elif value_to_store == 'False':
-                    value_to_store = False
-                if isinstance(value_to_store, bool):
-                    dictionary[key] = value_to_store
-                elif value_to_store == 'None':
-                    del dictionary[key]
-                elif value_to_store:
-                    dictionary[key] = value_to_store
-                else:
-                    del dictionary[key]
+        """
+        Configuration with the current values of the dialog
+        """
+        config = Configuration()
+        self._exported = None
+        for section, key, kind, default in FIELDS:
+            if hasattr(type(self), key):  # bound to the dialog
+                config.set(key, getattr(self, key))
+        self._exported = None
+        return config
 
     def retrieve_stages(self):
-        steps = 0
-        for dictionary in self.stages:
-            steps += int(dictionary['steps'])
-            for key, value in dictionary.items():
-                if value == 'True':
-                    value = True
-                    dictionary[key] = value
-                elif value == 'False':
-                    value = False
-                    dictionary[key] = value
-                elif value in [None,'None']:
-                    del dictionary[key]
-        self.total_steps = steps
-
-    def reset_variables(self):
-        self.md_input = {'topology': None,
-                         'positions': None,
-                         'forcefield': None,
-                         'charmm_parameters': None,
-                         'velocities': None,
-                         'box_vectors': None,
-                         'checkpoint': None}
-
-        self.md_output = {'project_name': None,
-                          'restart': None,
-                          'trajectory_every': None,
-                          'outputpath': None,
-                          'report_every': None,
-                          'trajectory_every': None,
-                          'trajectory_new_every': None,
-                          'restart_every': None,
-                          'trajectory_atom_subset': None,
-                          'report': True,
-                          'trajectory': None,
-                          #'attempt_rescue': False,
-                          #'verbose': False
-                          }
-
-        self.md_hardware = {'platform': None,
-                            'precision': None}
-
-        self.md_conditions = {'timestep': None,
-                              'integrator': None,
-                              'barostat': False,
-                              'temperature': None,
-                              'friction': None,
-                              'pressure': None,
-                              'barostat_interval': None}
-
-        self.md_systemoptions = {'nonbondedMethod': None,
-                                 'nonbondedCutoff': None,
-                                 'ewaldErrorTolerance': None,
-                                 'constraints': None,
-                                 'rigidWater': False}
+        # Some widgets just return booleans as strings, so we fix that
+        self.config.stages = []
+        for stage in self.gui.stages:
+            stage = dict((key, coerce(bool, value) if value in ('True', 'False') else value)
+                         for (key, value) in stage.items() if value not in (None, 'None'))
+            self.config.stages.append(stage)
+        self.total_steps = self.config.total_steps
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+import time
+import uuid
+import errno
+import shutil
+import signal
+from subprocess import Popen
+import Tkinter as tk
+import yaml
+# Own
+from utils import user_data_dir
+from slave import slave_command
+
+# stdin is opened read-write so the slave never blocks nor sees EOF
+# on the control FIFO while nobody is attached. The shell catches
+# SIGINT, meant for the slave only, to still record the exit code.
+# The slave writes the frame stream itself (MMSETUP_STREAM), so any
+# other output goes to the log. The remaining arguments are the
+# slave command (see slave.py)
+_WRAPPER = ('trap : INT; c="$0" e="$1" x="$2"; shift 2; '
+            '"$@" 0<>"$c" >"$e" 2>&1; '
+            'echo $? > "$x.tmp" && mv "$x.tmp" "$x"')
+
+# Frames kept in each of the two stream files of a detached run
+STREAM_FRAMES = 100
+
+
+def jobs_dir():
+    return user_data_dir('jobs')
+
+
+def launch_detached(inputfile, env=None, prefix=(), **info):
+    """
+    Run `inputfile` in its own session, so it survives Chimera.
+
+    The frame stream and the output go to files, stdin is a named
+    pipe used to answer the slave when it is stopped, and the exit
+    code is written to a file on completion. Only the last frames of
+    the stream are kept (see STREAM_FRAMES). Everything needed to find
+    the run again is saved in a job record, which is returned.
+
+    Parameters
+    ----------
+    inputfile : str
+        YAML input to run
+    env : dict, optional
+        Environment for the slave
+    prefix : list of str, optional
+        Command prefix (taskset, numactl...) for ommprotocol
+    info
+        Extra fields stored in the record (topology, total_steps...)
+    """
+    job_id = '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:8])
+    workdir = os.path.join(jobs_dir(), job_id)
+    os.makedirs(workdir)
+    record = dict(info,
+                  id=job_id,
+                  input=os.path.abspath(inputfile),
+                  stream=os.path.join(workdir, 'stream'),
+                  stderr=os.path.join(workdir, 'stderr.log'),
+                  control=os.path.join(workdir, 'control'),
+                  exitcode=os.path.join(workdir, 'exitcode'),
+                  started=time.strftime('%Y-%m-%d %H:%M:%S'),
+                  last_steps=0)
+    os.mkfifo(record['control'])
+    env = dict(os.environ if env is None else env, MMSETUP_STREAM=record['stream'],
+               MMSETUP_STREAM_FRAMES=str(STREAM_FRAMES))
+    process = Popen(['sh', '-c', _WRAPPER, record['control'], record['stderr'],
+                     record['exitcode']] + slave_command(record['input'], prefix),
+                    env=env, close_fds=True, preexec_fn=os.setsid)
+    record['pid'] = process.pid
+    save_record(record)
+    return record, process
+
+
+def record_path(job_id):
+    return os.path.join(jobs_dir(), job_id + '.yaml')
+
+
+def save_record(record):
+    path = record_path(record['id'])
+    with open(path + '.tmp', 'w') as f:
+        yaml.safe_dump(record, f, default_flow_style=False)
+    os.rename(path + '.tmp', path)
+
+
+def load_record(job_id):
+    with open(record_path(job_id)) as f:
+        return yaml.safe_load(f)
+
+
+def remove_record(record):
+    """
+    Forget a run: its record and its working directory
+    """
+    shutil.rmtree(os.path.dirname(record['stream']), ignore_errors=True)
+    os.remove(record_path(record['id']))
+
+
+def stream_files(record):
+    """
+    Files of the frame stream of a run, oldest first
+    """
+    return [record['stream'] + '.1', record['stream']]
+
+
+def discard_stream(record):
+    """
+    Delete the frame stream of a run that has exited. It is only
+    worth keeping while the run can still be reattached to.
+    """
+    for path in stream_files(record):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def list_records(running_only=False):
+    records = []
+    for name in sorted(os.listdir(jobs_dir())):
+        if name.endswith('.yaml'):
+            record = load_record(name[:-5])
+            if not running_only or is_running(record):
+                records.append(record)
+    return records
+
+
+def exit_code(record):
+    try:
+        with open(record['exitcode']) as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def is_running(record):
+    if exit_code(record) is not None:
+        return False
+    try:
+        os.kill(record['pid'], 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class TailReader(object):
+
+    """
+    File-like reader that waits for new lines at the end of a file
+    until the process writing it has finished. Like `tail -F`, it
+    goes on with the new file once the writer has moved it away.
+    """
+
+    def __init__(self, path, process, offset=0, interval=0.1):
+        self.path = path
+        self.process = process
+        self.interval = interval
+        while not os.path.exists(path) and process.poll() is None:
+            time.sleep(interval)
+        self._file = open(path, 'rb')
+        self._file.seek(offset)
+
+    def _rotated(self):
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+        except OSError:  # moved, but not replaced yet
+            return False
+
+    def readline(self):
+        while True:
+            line = self._file.readline()
+            if line.endswith(b'\n'):
+                return line
+            if line:  # partial line, wait for the rest
+                self._file.seek(-len(line), os.SEEK_CUR)
+            if self._rotated():
+                # No more writes to the old file: finish it, then switch
+                line = self._file.readline()
+                if line:
+                    return line
+                self._file.close()
+                self._file = open(self.path, 'rb')
+                continue
+            if self.process.poll() is not None:
+                return self._file.readline()
+            time.sleep(self.interval)
+
+    def close(self):
+        self._file.close()
+
+
+class DetachedProcess(object):
+
+    """
+    Popen-like handle for a detached run, usable by SubprocessTask and
+    the rest of the Controller machinery. `stdout` tails the frame
+    stream from `offset` and `stdin` writes to the control FIFO.
+    """
+
+    def __init__(self, record, popen=None, offset=0, progressCB=None):
+        self.record = record
+        self.pid = record['pid']
+        self.progressCB = progressCB
+        self.returncode = None
+        self._popen = popen
+        # O_RDWR never blocks, even if the slave has not opened it yet
+        self.stdin = os.fdopen(os.open(record['control'], os.O_RDWR), 'wb')
+        self.stdout = TailReader(record['stream'], self, offset=offset)
+        self._stderr = None
+
+    @property
+    def stderr(self):
+        if self._stderr is None:
+            self._stderr = open(self.record['stderr'], 'rb')
+        return self._stderr
+
+    def poll(self):
+        if self.returncode is None:
+            if self._popen is not None:
+                self._popen.poll()  # reap our own child
+            code = exit_code(self.record)
+            if code is not None:
+                self.returncode = code
+            elif not is_running(self.record):
+                self.returncode = -signal.SIGKILL
+        return self.returncode
+
+    def wait(self):
+        while self.poll() is None:
+            time.sleep(0.5)
+        return self.returncode
+
+    def send_signal(self, sig):
+        try:
+            os.killpg(self.pid, sig)
+        except OSError:
+            pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class DetachedJobsWindow(object):
+
+    """
+    Lists detached runs found on disk and reattaches to one of them.
+    """
+
+    def __init__(self, controller, title='MMSetup Detached Runs'):
+        self.controller = controller
+        self.window = tk.Toplevel()
+        self.window.title(title)
+        frame = tk.LabelFrame(self.window, text='Runs launched in detached mode')
+        frame.pack(expand=True, fill='both', padx=5, pady=5)
+        self.ui_listbox = tk.Listbox(frame, width=80, height=10, font='TkFixedFont')
+        self.ui_listbox.grid(row=0, column=0, columnspan=3, sticky='news')
+        tk.Button(frame, text='Reattach', command=self._attach).grid(row=1, column=0)
+        tk.Button(frame, text='Forget', command=self._forget).grid(row=1, column=1)
+        tk.Button(frame, text='Refresh', command=self._refresh).grid(row=1, column=2)
+        self._refresh()
+
+    def _refresh(self):
+        self.records = list_records()
+        self.ui_listbox.delete(0, 'end')
+        for record in self.records:
+            state = 'running' if is_running(record) else 'exit {}'.format(exit_code(record))
+            self.ui_listbox.insert('end', '{:<24} {:<10} {:>10} steps  {}'.format(
+                record['id'], state, record.get('last_steps', 0),
+                os.path.basename(record['input'])))
+
+    def _selected(self):
+        selection = self.ui_listbox.curselection()
+        if selection:
+            return self.records[int(selection[0])]
+
+    def _attach(self):
+        record = self._selected()
+        # Finished runs already followed have no stream left to show
+        if record is not None and (is_running(record) or os.path.isfile(record['stream'])):
+            self.window.destroy()
+            self.controller.attach(record)
+
+    def _forget(self):
+        record = self._selected()
+        if record is not None and not is_running(record):
+            remove_record(record)
+            self._refresh()
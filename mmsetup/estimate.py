@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+
+# Approximate on-disk size of one atom in one frame, in bytes
+BYTES_PER_ATOM_FRAME = {'DCD': 12,   # 3 float32 coordinates
+                        'PDB': 81}   # one ATOM record per atom
+# Per-frame overhead (DCD record markers and box, PDB MODEL/ENDMDL)
+BYTES_PER_FRAME = {'DCD': 80,
+                   'PDB': 20}
+BYTES_PER_FILE = {'DCD': 276,
+                  'PDB': 0}
+# Binary checkpoint (positions and velocities in double precision)
+# and serialized XML state, per atom and fixed part
+CHECKPOINT_BYTES = (56, 4096)
+STATE_XML_BYTES = (160, 8192)
+# ommprotocol's default report_every, the interval of streamed frames
+REPORT_EVERY = 1000
+# Coordinates kept in Chimera for every streamed frame (double xyz)
+# plus the decoded float array before it is copied
+LIVE_BYTES_PER_ATOM_FRAME = 24
+LIVE_BYTES_TRANSIENT = 2 * 12
+
+
+def human_size(nbytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(nbytes) < 1024:
+            return '{:.1f} {}'.format(nbytes, unit)
+        nbytes /= 1024
+    return '{:.1f} TB'.format(nbytes)
+
+
+def stage_trajectory(stage, md_output):
+    """
+    Trajectory format and interval in effect for `stage`, falling
+    back to the global output settings.
+    """
+    fmt = stage.get('trajectory', md_output.get('trajectory'))
+    every = stage.get('trajectory_every', md_output.get('trajectory_every'))
+    if fmt in (None, 'None', False) or not every:
+        return None, 0
+    return str(fmt).upper(), int(every)
+
+
+def trajectory_bytes(natoms, frames, fmt):
+    fmt = str(fmt).upper()
+    return frames * (natoms * BYTES_PER_ATOM_FRAME.get(fmt, 12) + BYTES_PER_FRAME.get(fmt, 0))
+
+
+def trajectory_usage(natoms, stages, md_output):
+    """
+    Projected trajectory disk usage of every stage. `natoms` is the
+    number of atoms written, after `trajectory_atom_subset`.
+
+    Returns
+    -------
+    usage : list of dict
+        name, format, frames, files and bytes for each stage
+    """
+    usage = []
+    new_every = int(md_output.get('trajectory_new_every') or 0)
+    for stage in stages:
+        fmt, every = stage_trajectory(stage, md_output)
+        steps = int(stage['steps'])
+        frames = steps // every if every else 0
+        files = 0
+        if frames:
+            files = -(-steps // new_every) if new_every else 1
+        size = trajectory_bytes(natoms, frames, fmt) if fmt else 0
+        usage.append({'name': stage['name'], 'format': fmt, 'frames': frames, 'files': files,
+                      'bytes': size + files * BYTES_PER_FILE.get(fmt, 0)})
+    return usage
+
+
+def footprint(natoms, stages, md_output, subset_atoms=None):
+    """
+    Disk and memory needed by a protocol.
+
+    Parameters
+    ----------
+    natoms : int
+        Atoms in the system
+    stages : list of dict
+    md_output : dict
+    subset_atoms : int, optional
+        Atoms selected by `trajectory_atom_subset`, if known
+
+    Returns
+    -------
+    estimate : dict
+        trajectory (per stage usage), trajectory_bytes, checkpoints
+        (written), checkpoint_files (kept), checkpoint_bytes, disk_bytes,
+        live_frames and memory_bytes (live streaming in Chimera)
+    """
+    written = subset_atoms or natoms
+    usage = trajectory_usage(written, stages, md_output)
+    checkpoints = 0
+    for stage in stages:
+        every = int(stage.get('restart_every') or md_output.get('restart_every') or 0)
+        if every:
+            checkpoints += int(stage['steps']) // every
+    # Every periodic checkpoint is kept as its own <stem>.rs.<step> file;
+    # every stage also leaves its final state behind
+    checkpoint_files = checkpoints
+    checkpoint_bytes = (checkpoint_files * (CHECKPOINT_BYTES[0] * natoms + CHECKPOINT_BYTES[1])
+                        + len(stages) * (STATE_XML_BYTES[0] * natoms + STATE_XML_BYTES[1]))
+    live_frames = 0
+    for stage in stages:
+        # Frames are streamed by the progress reporter
+        if not stage.get('report', md_output.get('report', True)):
+            continue
+        every = stage.get('report_every') or md_output.get('report_every') or REPORT_EVERY
+        live_frames += int(stage['steps']) // int(every)
+    trajectory_total = sum(u['bytes'] for u in usage)
+    return {'natoms': natoms, 'written_atoms': written,
+            'trajectory': usage, 'trajectory_bytes': trajectory_total,
+            'checkpoints': checkpoints, 'checkpoint_files': checkpoint_files,
+            'checkpoint_bytes': checkpoint_bytes,
+            'disk_bytes': trajectory_total + checkpoint_bytes,
+            'live_frames': live_frames,
+            'memory_bytes': natoms * (live_frames * LIVE_BYTES_PER_ATOM_FRAME
+                                      + LIVE_BYTES_TRANSIENT)}
+
+
+def free_space(path):
+    """
+    Bytes available to this user in the filesystem holding `path`
+    (or its closest existing parent), or None if unknown.
+    """
+    path = os.path.abspath(path or '.')
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    try:
+        stat = os.statvfs(path)
+    except (AttributeError, OSError):
+        return None
+    return stat.f_bavail * stat.f_frsize
+
+
+def check_space(estimate, path):
+    """
+    Warning message if the run will not fit in the filesystem at `path`.
+    """
+    free = free_space(path)
+    if free is not None and estimate['disk_bytes'] > free:
+        return 'Output needs {} but only {} are free in {}'.format(
+            human_size(estimate['disk_bytes']), human_size(free), os.path.abspath(path or '.'))
+
+
+def summarize_footprint(estimate):
+    """
+    One line summary, for status bars
+    """
+    return 'needs {} on disk and {} to stream live'.format(
+        human_size(estimate['disk_bytes']), human_size(estimate['memory_bytes']))
+
+
+def format_footprint(estimate):
+    """
+    Short human readable summary, one item per line.
+    """
+    lines = ['Atoms: {} ({} written to trajectories)'.format(estimate['natoms'],
+                                                            estimate['written_atoms'])]
+    for stage in estimate['trajectory']:
+        if stage['frames']:
+            lines.append('Trajectory {}: {} frames of {} in {} file(s), {}'.format(
+                stage['name'], stage['frames'], stage['format'], stage['files'],
+                human_size(stage['bytes'])))
+    lines.append('Checkpoints: {} written, {} files kept, {} with final states'.format(
+                 estimate['checkpoints'], estimate['checkpoint_files'],
+                 human_size(estimate['checkpoint_bytes'])))
+    lines.append('Disk total: {}'.format(human_size(estimate['disk_bytes'])))
+    lines.append('Live streaming: {} frames, {} in Chimera'.format(
+                 estimate['live_frames'], human_size(estimate['memory_bytes'])))
+    return lines
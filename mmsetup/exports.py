@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+import hashlib
+import numpy as np
+import chimera
+
+
+def molecule_hash(molecule):
+    """
+    Content hash of a Chimera molecule: its atoms, bonds, active
+    coordset and the coordinates in it.
+    """
+    sha = hashlib.sha1()
+    atoms = molecule.atoms
+    index = dict((atom, i) for (i, atom) in enumerate(atoms))
+    for atom in atoms:
+        sha.update('{} {} {} {}\n'.format(atom.name, atom.element.name, atom.residue.type,
+                                          atom.residue.id).encode('utf-8'))
+    for bond in molecule.bonds:
+        sha.update('{} {}\n'.format(*sorted(index[a] for a in bond.atoms)).encode('utf-8'))
+    cs = molecule.activeCoordSet
+    sha.update('coordset {}\n'.format(cs.id if cs is not None else None).encode('utf-8'))
+    if cs is not None:
+        sha.update(np.round(np.asarray(cs.xyzArray(), dtype='f8'), 3).tobytes())
+    return sha.hexdigest()
+
+
+def export_pdb(molecule, directory, name='input', key=None):
+    """
+    PDB file of `molecule` in `directory`, named after `name` and its
+    content hash, so the same structure is not written again.
+
+    Returns
+    -------
+    path : str
+    """
+    key = key or molecule_hash(molecule)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, '{}_{}.pdb'.format(name, key[:12]))
+    if not os.path.isfile(path):
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        chimera.pdbWrite([molecule], chimera.Xform(), tmp)
+        os.rename(tmp, path)
+    return path
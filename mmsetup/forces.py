@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import numpy as np
+# Chimera stuff
+import chimera
+
+
+class ForceHotspots(object):
+
+    """
+    Color residues by the magnitude of the forces acting on their atoms.
+
+    Atoms are permuted once so that every residue occupies a contiguous
+    block; each force frame is then reduced per residue with a single
+    `np.add.reduceat` call. The per-residue mean force (kJ/mol/nm) is
+    stored in the `attribute` residue attribute, so it can also be used
+    from Render by Attribute, and mapped to a blue-white-red palette.
+    The original colors are put back with `restore`.
+    """
+
+    def __init__(self, molecule, attribute='mmsetupForce', bins=32):
+        self.molecule = molecule
+        self.attribute = attribute
+        atoms = molecule.atoms
+        residues = []
+        residue_index = {}
+        owner = np.empty(len(atoms), dtype=int)
+        for i, atom in enumerate(atoms):
+            r = atom.residue
+            if r not in residue_index:
+                residue_index[r] = len(residues)
+                residues.append(r)
+            owner[i] = residue_index[r]
+        self.residues = residues
+        self.atoms = [r.atoms for r in residues]
+        self.order = np.argsort(owner, kind='mergesort')
+        self.counts = np.bincount(owner, minlength=len(residues))
+        self.starts = np.concatenate(([0], np.cumsum(self.counts)[:-1]))
+        self.palette = self._palette(bins)
+        self.values = None
+        self.original = [(r.ribbonColor, [a.color for a in atoms])
+                         for (r, atoms) in zip(self.residues, self.atoms)]
+
+    @staticmethod
+    def _palette(bins):
+        colors = []
+        for x in np.linspace(0., 1., bins):
+            if x < 0.5:
+                rgb = (2 * x, 2 * x, 1.)
+            else:
+                rgb = (1., 2 * (1 - x), 2 * (1 - x))
+            colors.append(chimera.MaterialColor(*(rgb + (1.,))))
+        return colors
+
+    def reduce(self, forces):
+        """
+        Mean force magnitude per residue for an (N, 3) force array.
+        """
+        forces = np.asarray(forces, dtype='float32')
+        magnitude = np.sqrt(np.einsum('ij,ij->i', forces, forces))
+        return np.add.reduceat(magnitude[self.order], self.starts) / self.counts
+
+    def update(self, forces, vmax=None):
+        self.values = values = self.reduce(forces)
+        if vmax is None:
+            vmax = values.max() or 1.
+        n = len(self.palette) - 1
+        bins = np.clip((values / vmax * n).astype(int), 0, n)
+        for residue, atoms, value, b in zip(self.residues, self.atoms, values, bins):
+            setattr(residue, self.attribute, float(value))
+            color = self.palette[b]
+            residue.ribbonColor = color
+            for atom in atoms:
+                atom.color = color
+        return values
+
+    def restore(self):
+        """
+        Put back the colors residues and atoms had before the first update
+        """
+        if self.molecule.__destroyed__:
+            return
+        for residue, atoms, (ribbon, colors) in zip(self.residues, self.atoms, self.original):
+            residue.ribbonColor = ribbon
+            for atom, color in zip(atoms, colors):
+                atom.color = color
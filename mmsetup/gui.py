@@ -12,6 +12,7 @@ import ttk
 import chimera
 from chimera import UserError
 import chimera.tkgui
+import chimera.selection
 from chimera.widgets import MoleculeScrolledListBox
 # OpenMM package
 from simtk.openmm.app import PDBFile
@@ -48,7 +49,7 @@ class MMSetupDialog(TangramBaseDialog):
     claim exclusive usage, use ModalDialog.
     """
 
-    buttons = ('Save Input', 'Run', 'Close')
+    buttons = ('Save Input', 'Pre-flight', 'Benchmark', 'Queue', 'Sweep', 'Run', 'Batch', 'Attach', 'History', 'Close')
     default = None
     help = "https://github.com/insilichem/tangram_mmsetup"
     VERSION = '0.0.1'
@@ -66,12 +67,15 @@ class MMSetupDialog(TangramBaseDialog):
                         'stage_reporters', 'advopt_hardware', 'advopt_rigwat',
                         'advopt_precision', 'input_coords', 'input_vel', 'input_box',
                         'checkpoint', 'output_restart', 'positions', 'traj_atoms',
-                        'barostat', 'stage_name', 'stage_constrother',
+                        'barostat', 'stage_name', 'stage_constrother', 'stage_parent',
                         'path', 'path_crd', 'path_extinput_top',
                         'path_extinput_crd', 'verbose',
-                        'forcefield_external', 'output_projectname')
+                        'forcefield_external', 'output_projectname', 'capture_kind',
+                        'advopt_affinity', 'advopt_numa', 'advopt_hmass')
 
-        self.boolean = ('stage_barostat', 'advopt_barostat', 'stage_minimiz')
+        self.boolean = ('stage_barostat', 'advopt_barostat', 'stage_minimiz',
+                        'run_detached', 'output_recover',
+                        'run_server', 'output_memoize', 'advopt_syscache')
 
         self.reporters = ('Time', 'Steps', 'Speed', 'Progress',
                           'Potencial Energy', 'Kinetic Energy',
@@ -80,13 +84,16 @@ class MMSetupDialog(TangramBaseDialog):
         self.floats = ('tstep', 'stage_pressure',
                        'stage_temp', 'stage_minimiz_tolerance',
                        'advopt_temp', 'advopt_pressure',
-                       'advopt_friction', 'advopt_edwalderr', 'advopt_cutoff')
+                       'advopt_friction', 'advopt_edwalderr', 'advopt_cutoff',
+                       'capture_rmsd', 'capture_value', 'output_recover_backoff')
 
         self.integer = ('output_traj_interval', 'output_stdout_interval',
                         'traj_new_every', 'restart_every',
                         'stage_steps', 'stage_reportevery',
                         'stage_pressure_steps', 'stage_minimiz_maxsteps',
-                        'advopt_pressure_steps')
+                        'advopt_pressure_steps', 'capture_window', 'forces_every',
+                        'advopt_threads', 'advopt_workers', 'output_recover_retries',
+                        'run_replicas')
 
         for e in self.entries:
             setattr(self, 'var_' + e, tk.StringVar())
@@ -118,8 +125,23 @@ class MMSetupDialog(TangramBaseDialog):
         self.var_advopt_constr.set(None)
         self.var_advopt_hardware.set('Auto')
         self.var_advopt_precision.set('mixed')
+        self.var_advopt_threads.set(0)
+        self.var_advopt_workers.set(1)
         self.var_advopt_rigwat.set('True')
+        self.var_advopt_syscache.set(False)
         self.var_verbose.set('True')
+        self.var_capture_rmsd.set(0)
+        self.var_capture_kind.set('contact')
+        self.var_capture_value.set(4.0)
+        self.var_capture_window.set(5)
+        self.var_forces_every.set(0)
+        self.var_run_detached.set(False)
+        self.var_run_server.set(False)
+        self.var_run_replicas.set(1)
+        self.var_output_recover.set(False)
+        self.var_output_memoize.set(False)
+        self.var_output_recover_retries.set(3)
+        self.var_output_recover_backoff.set(30)
         self.set_stage_variables()
 
         # Misc
@@ -130,6 +152,8 @@ class MMSetupDialog(TangramBaseDialog):
         self.stages = []
         self.sanitize = []
         self.additional_force = []
+        self.monitors = []
+        self.capture_rules = []
         self.stages_strings = (
             'ui_stage_barostat_steps', 'ui_stage_pressure',
             'ui_stage_temp', 'ui_stage_minimiz_maxsteps',
@@ -209,6 +233,8 @@ class MMSetupDialog(TangramBaseDialog):
             self.canvas, textvariable=self.var_output_stdout_interval, width=8)
         self.ui_output_options = tk.Button(self.canvas, text='Advanced options',
             command=lambda: self.Open_window('ui_output_opt', self._fill_ui_output_opt_window))
+        self.ui_output_monitors = tk.Button(self.canvas, text='Monitors',
+            command=lambda: self.Open_window('ui_monitors_window', self._fill_ui_monitors_window))
         self.ui_output_restart_Entry = tk.Entry(
             self.canvas, textvariable=self.var_output_restart)
         self.ui_output_restart_browse = tk.Button(self.canvas, text='...',
@@ -222,7 +248,7 @@ class MMSetupDialog(TangramBaseDialog):
                         self.ui_output_trjinterval_Entry, 'frames')],
                        ['Progress:', (self.ui_output_reporters_realtime, 'every',
                         self.ui_output_stdout_interval_Entry, 'frames')],
-                       ['', self.ui_output_options]]
+                       ['', (self.ui_output_options, self.ui_output_monitors)]]
 
         self.auto_grid(self.ui_output_frame, output_grid, label_sep='')
 
@@ -393,15 +419,131 @@ class MMSetupDialog(TangramBaseDialog):
             self.ui_output_opt_frame, textvariable=self.var_traj_atoms)
         self.ui_output_opt_restart_every_Entry = tk.Entry(
             self.ui_output_opt_frame, textvariable=self.var_restart_every)
-
+        self.ui_output_opt_forces_every_Entry = tk.Entry(
+            self.ui_output_opt_frame, textvariable=self.var_forces_every)
+        self.ui_output_opt_detached_check = ttk.Checkbutton(
+            self.ui_output_opt_frame, text='Survives Chimera (reattach later)',
+            variable=self.var_run_detached, onvalue=True, offvalue=False)
+        self.ui_output_opt_server_check = ttk.Checkbutton(
+            self.ui_output_opt_frame, text='Shared by all sessions on this machine',
+            variable=self.var_run_server, onvalue=True, offvalue=False)
+        self.ui_output_opt_replicas_Entry = tk.Entry(
+            self.ui_output_opt_frame, textvariable=self.var_run_replicas)
+        self.ui_output_opt_recover_retries_Entry = tk.Entry(
+            self.ui_output_opt_frame, textvariable=self.var_output_recover_retries,
+            width=4, state='disabled')
+        self.ui_output_opt_recover_backoff_Entry = tk.Entry(
+            self.ui_output_opt_frame, textvariable=self.var_output_recover_backoff,
+            width=4, state='disabled')
+        self.ui_output_opt_recover_check = ttk.Checkbutton(
+            self.ui_output_opt_frame, text='Enabled',
+            variable=self.var_output_recover, onvalue=True, offvalue=False,
+            command=lambda: self._check_settings(
+                self.var_output_recover, True,
+                self.ui_output_opt_recover_retries_Entry,
+                self.ui_output_opt_recover_backoff_Entry))
+        self.ui_output_opt_memoize_check = ttk.Checkbutton(
+            self.ui_output_opt_frame, text='Start from the deepest cached stage',
+            variable=self.var_output_memoize, onvalue=True, offvalue=False)
 
 
         # Grid them
         output_opt_grid = [['Trajectory\nNew Every', self.ui_output_opt_traj_new_every_Entry],
                            ['Trajectory\nAtom Subset', self.ui_output_opt_traj_atom_subset_Entry],
-                           ['Restart Every', self.ui_output_opt_restart_every_Entry]]
+                           ['Restart Every', self.ui_output_opt_restart_every_Entry],
+                           ['Live Forces Every\n(0 = off)', self.ui_output_opt_forces_every_Entry],
+                           ['Run Detached', self.ui_output_opt_detached_check],
+                           ['Use Job Server', self.ui_output_opt_server_check],
+                           ['Live Replicas', self.ui_output_opt_replicas_Entry],
+                           ['Auto-recover\non failure', (self.ui_output_opt_recover_check,
+                            'retries', self.ui_output_opt_recover_retries_Entry,
+                            'backoff (s)', self.ui_output_opt_recover_backoff_Entry)],
+                           ['Reuse Cached\nStages', self.ui_output_opt_memoize_check]]
         self.auto_grid(self.ui_output_opt_frame_label, output_opt_grid)
 
+    def _fill_ui_monitors_window(self):
+        """
+        Define distances, angles and dihedrals to be
+        monitored while the simulation runs
+        """
+        # Create window
+        self.ui_monitors_window = tk.Toplevel()
+        self.Center(self.ui_monitors_window)
+        self.ui_monitors_window.title("Monitors")
+
+        # Create lframe
+        self.ui_monitors_lframe = tk.LabelFrame(
+            self.ui_monitors_window, text='Select 2, 3 or 4 atoms and click +')
+        self.ui_monitors_lframe.pack(expand=True, fill='both')
+
+        # Create Widgets
+        self.ui_monitors_listbox = tk.Listbox(self.ui_monitors_window, width=40)
+        for name, atoms in self.monitors:
+            self.ui_monitors_listbox.insert('end', name)
+        self.ui_monitors_add = tk.Button(
+            self.ui_monitors_window, text='+', command=self._add_monitor)
+        self.ui_monitors_remove = tk.Button(
+            self.ui_monitors_window, text='-',
+            command=lambda: self._remove_stage('ui_monitors_listbox', self.monitors))
+        monitors_grid = [[self.ui_monitors_listbox,
+                          (self.ui_monitors_add, self.ui_monitors_remove)]]
+        self.auto_grid(self.ui_monitors_lframe, monitors_grid)
+
+        # Capture rules
+        self.ui_capture_lframe = tk.LabelFrame(
+            self.ui_monitors_window, text='Capture full-resolution frames when')
+        self.ui_capture_lframe.pack(expand=True, fill='both')
+        self.ui_capture_rmsd_Entry = tk.Entry(
+            self.ui_monitors_window, textvariable=self.var_capture_rmsd, width=8)
+        self.ui_capture_kind_combo = ttk.Combobox(
+            self.ui_monitors_window, textvariable=self.var_capture_kind,
+            values=('contact', 'crossing'), width=10)
+        self.ui_capture_value_Entry = tk.Entry(
+            self.ui_monitors_window, textvariable=self.var_capture_value, width=8)
+        self.ui_capture_add = tk.Button(
+            self.ui_monitors_window, text='+', command=self._add_capture_rule)
+        self.ui_capture_listbox = tk.Listbox(
+            self.ui_monitors_window, width=40, height=4)
+        for rule in self.capture_rules:
+            self.ui_capture_listbox.insert('end', '{} {} {}'.format(*rule))
+        self.ui_capture_remove = tk.Button(
+            self.ui_monitors_window, text='-',
+            command=lambda: self._remove_stage('ui_capture_listbox', self.capture_rules))
+        self.ui_capture_window_Entry = tk.Entry(
+            self.ui_monitors_window, textvariable=self.var_capture_window, width=8)
+        capture_grid = [['RMSD jump (A)', self.ui_capture_rmsd_Entry],
+                        ['Selected monitor', (self.ui_capture_kind_combo,
+                         self.ui_capture_value_Entry, self.ui_capture_add)],
+                        ['Rules', (self.ui_capture_listbox, self.ui_capture_remove)],
+                        ['Window (frames)', self.ui_capture_window_Entry]]
+        self.auto_grid(self.ui_capture_lframe, capture_grid)
+
+    def _add_monitor(self):
+        """
+        Create a monitor with the currently selected atoms,
+        in the order they were picked
+        """
+        atoms = chimera.selection.currentAtoms(ordered=True)
+        if len(atoms) not in (2, 3, 4):
+            raise UserError('Select 2 (distance), 3 (angle) or 4 (dihedral) atoms')
+        name = '-'.join('{}{}@{}'.format(a.residue.type, a.residue.id.position, a.name)
+                        for a in atoms)
+        self.ui_monitors_listbox.insert('end', name)
+        self.monitors.append((name, atoms))
+
+    def _add_capture_rule(self):
+        """
+        Capture frames when the selected monitor crosses a value
+        (or, for contacts, grows beyond it)
+        """
+        selection = self.ui_monitors_listbox.curselection()
+        if not selection:
+            raise UserError('Select a monitor first')
+        name = self.monitors[int(selection[0])][0]
+        rule = (self.var_capture_kind.get(), name, self.var_capture_value.get())
+        self.ui_capture_listbox.insert('end', '{} {} {}'.format(*rule))
+        self.capture_rules.append(rule)
+
     def _fill_ui_stages_window(self):
         """
         Create widgets on TopLevel Window to set different
@@ -429,6 +571,9 @@ class MMSetupDialog(TangramBaseDialog):
 
         self.ui_stage_name_Entry = tk.Entry(
             self.ui_tab_1, textvariable=self.var_stage_name)
+        self.ui_stage_parent_combo = ttk.Combobox(
+            self.ui_tab_1, textvariable=self.var_stage_parent)
+        self.ui_stage_parent_combo.config(values=self.stage_parents())
         self.ui_stage_close = tk.Button(
             self.ui_tab_1, text='Close', command=self._close_ui_stages_window)
         self.ui_stage_save_Button = tk.Button(
@@ -436,6 +581,7 @@ class MMSetupDialog(TangramBaseDialog):
             command=self._save_ui_stages_window)
 
         stage_grid = [['Stage Name', self.ui_stage_name_Entry],
+                      ['Fork From\n(empty = previous)', self.ui_stage_parent_combo],
                       ['', self.ui_stage_close, self.ui_stage_save_Button]]
         self.auto_grid(self.ui_stage_name_lframe, stage_grid)
 
@@ -526,6 +672,12 @@ class MMSetupDialog(TangramBaseDialog):
         self.auto_grid(self.ui_stage_mdset_lframe, self.stage_md)
         self.ui_stages_window.mainloop()
 
+    def stage_parents(self):
+        """
+        Choices of the Fork From combo: the stages defined so far
+        """
+        return [''] + [stage['name'] for stage in self.stages]
+
     def _save_ui_stages_window(self):
         """
         Save stage on the main listbox while closing the window
@@ -535,7 +687,10 @@ class MMSetupDialog(TangramBaseDialog):
             self.ui_stage_name_Entry.configure(background='red')
         else:
             self.ui_stage_name_Entry.configure(background='white')
-            self.ui_stages_listbox.insert('end', self.var_stage_name.get())
+            label = self.var_stage_name.get()
+            if self.var_stage_parent.get():
+                label += ' <- {}'.format(self.var_stage_parent.get())
+            self.ui_stages_listbox.insert('end', label)
             self.ui_stages_window.withdraw()
 
             self.create_stage_dict()
@@ -564,6 +719,7 @@ class MMSetupDialog(TangramBaseDialog):
 
             stage_dict = {
                 'name': self.var_stage_name.get(),
+                'parent': self.var_stage_parent.get() or None,
                 'temperature': self.var_stage_temp.get(),
                 'pressure': self.var_stage_pressure.get(),
                 'barostat_interval': self.var_stage_pressure_steps.get(),
@@ -659,13 +815,20 @@ class MMSetupDialog(TangramBaseDialog):
             self.ui_tab_2, textvariable=self.var_advopt_rigwat)
         self.ui_advopt_rigwat_combo.config(
             values=('True', 'False'))
+        self.ui_advopt_hmass_Entry = tk.Entry(
+            self.ui_tab_2, textvariable=self.var_advopt_hmass)
+        self.ui_advopt_syscache_check = ttk.Checkbutton(
+            self.ui_tab_2, text='Cache and reuse the serialized System',
+            variable=self.var_advopt_syscache, onvalue=True, offvalue=False)
 
         advopt_grid = [['Non Bonded Method', self.ui_advopt_nbm_combo],
                        ['Ewald Tolerance',
                         self.ui_advopt_ewalderr_Entry],
                        ['Non Bonded Cutoff (nm)', self.ui_advopt_cutoff_Entry],
                        ['Constraints', self.ui_advopt_constr_combo],
-                       ['Rigid Water', self.ui_advopt_rigwat_combo]]
+                       ['Rigid Water', self.ui_advopt_rigwat_combo],
+                       ['Hydrogen Mass (amu)\n(empty = no HMR)', self.ui_advopt_hmass_Entry],
+                       ['System Cache', self.ui_advopt_syscache_check]]
         self.auto_grid(self.ui_advopt_system_lframe, advopt_grid)
         # Events
         self.ui_advopt_nbm_combo.bind(
@@ -684,11 +847,23 @@ class MMSetupDialog(TangramBaseDialog):
             self.ui_tab_3, textvariable=self.var_advopt_precision)
         self.ui_advopt_precision_combo.config(
             values=('single', 'mixed', 'double'))
+        self.ui_advopt_threads_Entry = tk.Entry(
+            self.ui_tab_3, textvariable=self.var_advopt_threads)
+        self.ui_advopt_workers_Entry = tk.Entry(
+            self.ui_tab_3, textvariable=self.var_advopt_workers)
+        self.ui_advopt_affinity_Entry = tk.Entry(
+            self.ui_tab_3, textvariable=self.var_advopt_affinity)
+        self.ui_advopt_numa_Entry = tk.Entry(
+            self.ui_tab_3, textvariable=self.var_advopt_numa)
 
         advopt_grid_hardware = [['', ''],
                                 ['Platform',
                                  self.ui_advopt_platform_combo],
-                                ['Precision', self.ui_advopt_precision_combo]]
+                                ['Precision', self.ui_advopt_precision_combo],
+                                ['CPU Threads\n(0 = all cores)', self.ui_advopt_threads_Entry],
+                                ['CPU Affinity\n(e.g. 0-3,8)', self.ui_advopt_affinity_Entry],
+                                ['NUMA Node', self.ui_advopt_numa_Entry],
+                                ['Warm Workers', self.ui_advopt_workers_Entry]]
         self.auto_grid(
             self.ui_advopt_hardware_lframe, advopt_grid_hardware)
 
@@ -865,10 +1040,11 @@ class MMSetupDialog(TangramBaseDialog):
         fill_function: fillin function for window
         """
         try:
-            var_window = window
+            var_window = getattr(self, window)  # windows are given by name
             var_window.state()
-            if window == self.ui_stages_window:
+            if var_window == self.ui_stages_window:
                 self.set_stage_variables()
+                self.ui_stage_parent_combo.config(values=self.stage_parents())
                 self.ui_stage_minimiz_tolerance_Entry.configure(state='disabled')
                 self.ui_stage_minimiz_maxsteps_Entry.configure(state = 'disabled')
                 self.ui_stage_barostat_steps_Entry.configure(state='disabled')
@@ -901,6 +1077,7 @@ class MMSetupDialog(TangramBaseDialog):
         super(MMSetupDialog, self).Close()
 
     def set_stage_variables(self):
+        self.var_stage_parent.set('')
         self.var_stage_temp.set(300)
         self.var_stage_minimiz.set(False)
         self.var_stage_minimiz_maxsteps.set(10000)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+import time
+import socket
+import hashlib
+import sqlite3
+from contextlib import closing
+import Tkinter as tk
+import yaml
+# Own
+from utils import user_data_dir
+
+COLUMNS = (('started', 'TEXT'),
+           ('finished', 'TEXT'),
+           ('hostname', 'TEXT'),
+           ('input', 'TEXT'),
+           ('input_hash', 'TEXT'),
+           ('project_name', 'TEXT'),
+           ('outputpath', 'TEXT'),
+           ('natoms', 'INTEGER'),
+           ('platform', 'TEXT'),
+           ('precision', 'TEXT'),
+           ('threads', 'INTEGER'),
+           ('nonbonded_method', 'TEXT'),
+           ('cutoff', 'REAL'),
+           ('timestep', 'REAL'),
+           ('total_steps', 'INTEGER'),
+           ('steps', 'INTEGER'),
+           ('walltime', 'REAL'),
+           ('ns_per_day', 'REAL'),
+           ('state', 'TEXT'),
+           ('returncode', 'INTEGER'))
+
+INDICES = (('input_hash',),
+           ('natoms',),
+           ('platform', 'precision'),
+           ('ns_per_day',),
+           ('started',))
+
+# A configuration, for ranking purposes
+CONFIGURATION = ('platform', 'precision', 'threads', 'nonbonded_method', 'cutoff', 'timestep')
+
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def throughput(steps, timestep, seconds):
+    """
+    Simulated ns per day of wall time, or None if unknown
+    """
+    if steps and timestep and seconds > 0:
+        return steps * float(timestep) * 1e-6 / (seconds / 86400.)
+
+
+def measured(first, last):
+    """
+    Steps run and seconds elapsed between two progress reports, given
+    as (time, steps), so system setup and the final writes are left
+    out. None if they do not span any time.
+    """
+    if first is None or last is None or last[0] <= first[0]:
+        return None
+    return last[1] - first[1], last[0] - first[0]
+
+
+def input_fields(inputfile):
+    """
+    Run settings relevant for performance, read from a YAML input.
+    """
+    with open(inputfile) as f:
+        cfg = yaml.safe_load(f) or {}
+    properties = cfg.get('platform_properties') or {}
+    threads = properties.get('Threads')
+    return {'input': os.path.abspath(inputfile),
+            'input_hash': file_hash(inputfile),
+            'project_name': cfg.get('project_name'),
+            'outputpath': cfg.get('outputpath'),
+            'platform': cfg.get('platform'),
+            'precision': properties.get('Precision') or cfg.get('precision'),
+            'threads': int(threads) if threads else None,
+            'nonbonded_method': cfg.get('nonbondedMethod'),
+            'cutoff': cfg.get('nonbondedCutoff'),
+            'timestep': cfg.get('timestep'),
+            'total_steps': sum(int(s['steps']) for s in cfg.get('stages') or ())}
+
+
+class RunHistory(object):
+
+    """
+    SQLite database of past runs and their measured performance.
+    A connection is opened per call, so it can be used from the
+    threads that watch running jobs.
+
+    Parameters
+    ----------
+    path : str, optional
+        Database file. Defaults to ``history.sqlite`` in the MMSetup
+        user directory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(user_data_dir(), 'history.sqlite')
+        with closing(self._connect()) as db, db:
+            db.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, {})'.format(
+                       ', '.join('{} {}'.format(*column) for column in COLUMNS)))
+            for columns in INDICES:
+                db.execute('CREATE INDEX IF NOT EXISTS runs_{} ON runs ({})'.format(
+                           '_'.join(columns), ', '.join(columns)))
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def add(self, **fields):
+        """
+        Store a run. Unknown fields are ignored.
+
+        Returns
+        -------
+        id : int
+        """
+        names = [name for (name, _) in COLUMNS if name in fields]
+        with closing(self._connect()) as db, db:
+            cursor = db.execute('INSERT INTO runs ({}) VALUES ({})'.format(
+                                ', '.join(names), ', '.join('?' * len(names))),
+                                [fields[name] for name in names])
+            return cursor.lastrowid
+
+    def record(self, inputfile, started, steps, state, returncode=None,
+               natoms=None, timestep=None, measured=None):
+        """
+        Store a finished run of `inputfile`, reading its settings.
+        Throughput comes from the `measured` (steps, seconds) if given,
+        or else from the whole wall time.
+        """
+        fields = input_fields(inputfile)
+        walltime = time.time() - started
+        timestep = timestep or fields['timestep']
+        run_steps, seconds = measured or (steps, walltime)
+        ns_per_day = throughput(run_steps, timestep, seconds)
+        fields.update(started=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)),
+                      finished=time.strftime('%Y-%m-%d %H:%M:%S'),
+                      hostname=socket.gethostname(), natoms=natoms, steps=steps,
+                      walltime=walltime, ns_per_day=ns_per_day, state=state,
+                      returncode=returncode)
+        return self.add(**fields)
+
+    def record_job(self, job, natoms=None):
+        """
+        Done callback for jobs.Job
+        """
+        try:
+            self.record(job.inputfile, job.started or job.submitted, job.steps, job.state,
+                        job.returncode, natoms=natoms, timestep=job.timestep,
+                        measured=job.measured)
+        except Exception:  # the history is best effort; the job itself is fine
+            pass
+
+    def query(self, limit=100, **filters):
+        """
+        Most recent runs matching all `filters` (column=value).
+        """
+        names = [name for (name, _) in COLUMNS if name in filters]
+        where = ' AND '.join('{} = ?'.format(name) for name in names) or '1'
+        with closing(self._connect()) as db:
+            return [dict(row) for row in db.execute(
+                'SELECT * FROM runs WHERE {} ORDER BY started DESC LIMIT ?'.format(where),
+                [filters[name] for name in names] + [limit])]
+
+    def rank(self, natoms=None, tolerance=0.2, hostname=None, limit=20):
+        """
+        Configurations ranked by mean throughput of successful runs.
+
+        Parameters
+        ----------
+        natoms : int, optional
+            Only consider systems within `tolerance` (relative) of this size
+        hostname : str, optional
+            Only consider runs on this machine
+
+        Returns
+        -------
+        ranking : list of dict
+            CONFIGURATION fields plus runs, mean_ns_per_day and best_ns_per_day
+        """
+        where, args = ["state = 'done'", 'ns_per_day IS NOT NULL'], []
+        if natoms:
+            where.append('natoms BETWEEN ? AND ?')
+            args += [int(natoms * (1 - tolerance)), int(natoms * (1 + tolerance))]
+        if hostname:
+            where.append('hostname = ?')
+            args.append(hostname)
+        group = ', '.join(CONFIGURATION)
+        with closing(self._connect()) as db:
+            return [dict(row) for row in db.execute(
+                'SELECT {0}, COUNT(*) AS runs, AVG(ns_per_day) AS mean_ns_per_day, '
+                'MAX(ns_per_day) AS best_ns_per_day FROM runs WHERE {1} GROUP BY {0} '
+                'ORDER BY mean_ns_per_day DESC LIMIT ?'.format(group, ' AND '.join(where)),
+                args + [limit])]
+
+
+_history = None
+def get_history():
+    global _history
+    if _history is None:
+        _history = RunHistory()
+    return _history
+
+
+class HistoryWindow(object):
+
+    """
+    Ranks the configurations found in the run history by throughput.
+    """
+
+    def __init__(self, history, natoms=None, title='MMSetup Run History'):
+        self.history = history
+        self.natoms = natoms
+        self.window = tk.Toplevel()
+        self.window.title(title)
+        self.var_similar = tk.BooleanVar()
+        self.var_similar.set(bool(natoms))
+        self.var_this_host = tk.BooleanVar()
+        self.var_this_host.set(True)
+
+        frame = tk.LabelFrame(self.window, text='Configurations by throughput')
+        frame.pack(expand=True, fill='both', padx=5, pady=5)
+        self.ui_listbox = tk.Listbox(frame, width=90, height=12, font='TkFixedFont')
+        self.ui_listbox.grid(row=0, column=0, columnspan=3, sticky='news')
+        tk.Checkbutton(frame, text='Similar size ({} atoms)'.format(natoms or '?'),
+                       variable=self.var_similar, command=self._refresh,
+                       state='normal' if natoms else 'disabled').grid(row=1, column=0, sticky='w')
+        tk.Checkbutton(frame, text='This machine only', variable=self.var_this_host,
+                       command=self._refresh).grid(row=1, column=1, sticky='w')
+        tk.Button(frame, text='Refresh', command=self._refresh).grid(row=1, column=2)
+        self._refresh()
+
+    def _refresh(self):
+        ranking = self.history.rank(natoms=self.natoms if self.var_similar.get() else None,
+                                    hostname=socket.gethostname() if self.var_this_host.get() else None)
+        self.ui_listbox.delete(0, 'end')
+        self.ui_listbox.insert('end', '{:>9} {:>9} {:>4}  {:<8} {:<7} {:>4} {:<18} {:>6} {:>5}'.format(
+            'ns/day', 'best', 'runs', 'platform', 'prec.', 'thr.', 'nonbonded', 'cutoff', 'dt'))
+        for row in ranking:
+            self.ui_listbox.insert('end',
+                '{mean_ns_per_day:>9.2f} {best_ns_per_day:>9.2f} {runs:>4}  {platform!s:<8.8} '
+                '{precision!s:<7.7} {threads!s:>4} {nonbonded_method!s:<18.18} {cutoff!s:>6} '
+                '{timestep!s:>5}'.format(**row))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import yaml
+
+# createSystem arguments OMMProtocol only forwards from extra_system_options
+EXTRA_SYSTEM_OPTIONS = ('hydrogenMass',)
+
+
+def ommprotocol_systemoptions(md_systemoptions):
+    """
+    Copy of `md_systemoptions` with the keys OMMProtocol does not read
+    at the top level nested under ``extra_system_options``.
+    """
+    options = dict(md_systemoptions)
+    extra = dict(options.pop('extra_system_options', None) or {})
+    for key in EXTRA_SYSTEM_OPTIONS:
+        if key in options:
+            extra[key] = options.pop(key)
+    if extra:
+        options['extra_system_options'] = extra
+    return options
+
+
+def write_input(path, md_input, md_output, md_hardware, md_conditions,
+                md_systemoptions, stages, header=()):
+    with open(path, 'w') as f:
+        f.write('# Yaml input for OpenMM MD\n')
+        for line in header:
+            f.write('# {}\n'.format(line))
+        f.write('\n')
+        f.write('# input\n')
+        yaml.dump(md_input, f, default_flow_style=False)
+        f.write('\n')
+        f.write('# output\n')
+        yaml.dump(md_output, f, default_flow_style=False)
+        if md_hardware:
+            f.write('\n# hardware\n')
+            yaml.dump(md_hardware, f, default_flow_style=False)
+        f.write('\n# conditions\n')
+        yaml.dump(md_conditions, f, default_flow_style=False)
+        f.write('\n# OpenMM system options\n')
+        yaml.dump(ommprotocol_systemoptions(md_systemoptions), f, default_flow_style=False)
+        f.write('\n\nstages:\n')
+        for stage in stages:
+            # parent is only meaningful to stagetree.StageTree
+            stage = dict((k, v) for (k, v) in stage.items() if k != 'parent')
+            yaml.dump([stage], f, indent=8, default_flow_style=False)
+            f.write('\n')
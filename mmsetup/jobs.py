@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+import time
+import itertools
+import multiprocessing
+from collections import deque
+from subprocess import Popen, PIPE
+from threading import Thread, RLock
+import Tkinter as tk
+# Own
+from control import ControlChannel
+from stream import iter_chunks, decode_chunk
+from slave import slave_command
+from workers import WorkerPool
+from affinity import available_cpus, format_cpulist, launch_prefix
+from history import throughput, measured
+
+
+class Job(object):
+
+    """
+    One OMMProtocol run managed by a JobScheduler.
+
+    Parameters
+    ----------
+    inputfile : str
+        Path to the YAML input
+    threads : int
+        CPU threads reserved for this job while it runs
+    total_steps : int, optional
+        Total MD steps, used to report progress
+    timestep : float, optional
+        Integration timestep in fs, used to report throughput
+    prefix : list of str, optional
+        Command prefix (taskset, numactl...) the job is launched with
+    cwd : str, optional
+        Working directory of the job
+    cpuset : list of int, optional
+        CPUs the job may run on. The scheduler binds it to as many of
+        them as threads it reserves, disjoint from those of the other
+        running jobs, and keeps it queued until they are free.
+    """
+
+    _ids = itertools.count(1)
+    STATES = ('queued', 'running', 'done', 'failed', 'cancelled')
+
+    def __init__(self, inputfile, threads=1, total_steps=None, timestep=None,
+                 name=None, env=None, prefix=None, cwd=None, cpuset=None):
+        self.id = next(self._ids)
+        self.inputfile = inputfile
+        self.threads = max(1, int(threads))
+        self.total_steps = total_steps
+        self.timestep = timestep
+        self.name = name or os.path.basename(inputfile)
+        self.env = env or {}
+        self.prefix = list(prefix or ())
+        self.cwd = cwd
+        self.cpuset = list(cpuset or ())
+        self.cpus = ()
+        self.state = 'queued'
+        self.process = None
+        self.steps = 0
+        self.returncode = None
+        self.error = None
+        self.stderr = ()
+        self.callbacks = []
+        self.chunk_callbacks = []
+        self.submitted = time.time()
+        self.started = self.finished = None
+        self.first_report = self.last_report = None
+        self.channel = None
+
+    def __repr__(self):
+        return '<Job {0.id} {0.name} [{0.state}]>'.format(self)
+
+    @property
+    def progress(self):
+        if self.state == 'done':
+            return 1.
+        if self.total_steps:
+            return min(1., self.steps / self.total_steps)
+        return 0.
+
+    @property
+    def walltime(self):
+        if self.started is None:
+            return 0.
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def measured(self):
+        """
+        Steps and seconds between the first and last progress reports
+        """
+        return measured(self.first_report, self.last_report)
+
+    @property
+    def ns_per_day(self):
+        steps, seconds = self.measured or (self.steps, self.walltime)
+        return throughput(steps, self.timestep, seconds)
+
+    def add_done_callback(self, callback):
+        """
+        Call `callback(job)` once the job is done, failed or cancelled.
+        Callbacks run in the scheduler thread that watched the job.
+        """
+        self.callbacks.append(callback)
+
+    def _notify(self):
+        for callback in self.callbacks:
+            callback(self)
+
+    def add_chunk_callback(self, callback):
+        """
+        Call `callback(job, chunk)` with every raw frame the job streams.
+        """
+        self.chunk_callbacks.append(callback)
+
+    def remove_chunk_callback(self, callback):
+        if callback in self.chunk_callbacks:
+            self.chunk_callbacks.remove(callback)
+
+    def stop(self):
+        """
+        Make the job save an emergency state and exit (see
+        control.ControlChannel).
+        """
+        if self.state != 'running' or self.process is None:
+            return False
+        return self._channel().stop()
+
+    def pause(self):
+        if self.state != 'running' or self.process is None:
+            return False
+        return self._channel().pause()
+
+    def resume(self):
+        if self.state != 'running' or self.process is None:
+            return False
+        return self._channel().resume()
+
+    def _channel(self):
+        if self.channel is None or self.channel.process is not self.process:
+            self.channel = ControlChannel(self.process)
+        return self.channel
+
+    def command(self):
+        return slave_command(self.inputfile, self.prefix)
+
+    def environment(self):
+        env = os.environ.copy()
+        env['OMMPROTOCOL_SLAVE'] = '1'
+        env['PYTHONIOENCODING'] = 'latin-1'
+        env['OPENMM_CPU_THREADS'] = str(self.threads)
+        env.update(self.env)
+        return env
+
+
+class JobScheduler(object):
+
+    """
+    Runs queued jobs as soon as enough CPU slots are free.
+
+    Parameters
+    ----------
+    max_threads : int, optional
+        Total thread budget shared by all running jobs. Defaults to
+        the number of CPUs in this machine.
+    pool : WorkerPool, optional
+        If given, jobs are started on warm workers from this pool
+    pin : bool, optional
+        Bind each job without its own prefix to as many CPUs as threads
+        it reserves, disjoint from those of the other running jobs
+    """
+
+    def __init__(self, max_threads=None, pool=None, pin=False):
+        self.max_threads = max_threads or multiprocessing.cpu_count()
+        self.reserved = 0
+        self.pool = pool
+        self.pin = pin
+        self.jobs = []
+        self.queue = deque()
+        self._lock = RLock()
+
+    @property
+    def running(self):
+        return [job for job in self.jobs if job.state == 'running']
+
+    @property
+    def used_threads(self):
+        return self.reserved + sum(job.threads for job in self.running)
+
+    @property
+    def free_threads(self):
+        return self.max_threads - self.used_threads
+
+    def submit(self, job):
+        if job.threads > self.max_threads:
+            raise ValueError('Job needs {} threads but the budget is {}'.format(
+                             job.threads, self.max_threads))
+        if job.cpuset and job.threads > len(job.cpuset):
+            raise ValueError('Job needs {} threads but may only run on {} CPUs'.format(
+                             job.threads, len(job.cpuset)))
+        with self._lock:
+            self.jobs.append(job)
+            self.queue.append(job)
+        self.dispatch()
+        return job
+
+    def cancel(self, job):
+        with self._lock:
+            if job.state == 'queued':
+                self.queue.remove(job)
+                job.state = 'cancelled'
+                job._notify()
+            elif job.state == 'running':
+                job.resume()  # a paused job would not see SIGTERM
+                job.state = 'cancelled'
+                job.process.terminate()
+
+    def set_max_threads(self, max_threads):
+        """
+        Change the thread budget. It is never lowered below the threads
+        of a queued job, which could not start otherwise. Returns the
+        budget set.
+        """
+        with self._lock:
+            needed = max([1] + [job.threads for job in self.queue])
+            self.max_threads = max(needed, int(max_threads))
+        self.dispatch()
+        return self.max_threads
+
+    def reserve(self, threads):
+        """
+        Take `threads` out of the budget for a run started outside the
+        scheduler, like a live run, until they are released. Raises
+        ValueError if they are not free now.
+        """
+        with self._lock:
+            if threads > self.free_threads:
+                raise ValueError('{} threads needed but only {} of {} are free; queue the '
+                                 'run instead'.format(threads, max(0, self.free_threads),
+                                                      self.max_threads))
+            self.reserved += threads
+
+    def release(self, threads):
+        with self._lock:
+            self.reserved = max(0, self.reserved - threads)
+        self.dispatch()
+
+    def dispatch(self):
+        """
+        Start queued jobs, in order, while they fit in the free slots.
+        """
+        with self._lock:
+            while self.queue and self._fits(self.queue[0]):
+                self._start(self.queue.popleft())
+
+    def _free_cpus(self, job):
+        busy = set(cpu for other in self.running for cpu in other.cpus)
+        return [cpu for cpu in job.cpuset or available_cpus() if cpu not in busy]
+
+    def _fits(self, job):
+        if job.threads > self.free_threads:
+            return False
+        return not job.cpuset or len(self._free_cpus(job)) >= job.threads
+
+    def _pin(self, job):
+        free = self._free_cpus(job)
+        if len(free) >= job.threads:
+            prefix = launch_prefix(affinity=format_cpulist(free[:job.threads]))
+            if prefix:  # after numactl, if any
+                job.cpus, job.prefix = free[:job.threads], job.prefix + prefix
+
+    def _start(self, job):
+        if job.cpuset or (self.pin and not job.prefix):
+            self._pin(job)
+        job.state = 'running'
+        job.started = time.time()
+        try:
+            # Warm workers are already running, so they cannot be bound
+            if self.pool is not None and self.pool.size and not (job.prefix or job.cwd):
+                job.process = self.pool.acquire(job.inputfile, env=job.environment())
+            else:
+                job.process = Popen(job.command(), stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                                    bufsize=1, env=job.environment(), cwd=job.cwd)
+        except OSError as e:
+            job.state, job.error, job.finished = 'failed', str(e), time.time()
+            job._notify()
+            return
+        thread = Thread(target=self._watch, args=(job,))
+        thread.daemon = True
+        thread.start()
+
+    def _watch(self, job):
+        # Keep stderr flowing, but only its last lines matter
+        job.stderr = deque(maxlen=20)
+        stderr_thread = Thread(target=job.stderr.extend,
+                               args=(iter(job.process.stderr.readline, b''),))
+        stderr_thread.daemon = True
+        stderr_thread.start()
+        for chunk in iter_chunks(job.process.stdout):
+            kind, steps, _ = decode_chunk(chunk)
+            job.steps = steps
+            job.last_report = (time.time(), steps)
+            if job.first_report is None:
+                job.first_report = job.last_report
+            for callback in list(job.chunk_callbacks):
+                callback(job, chunk)
+        job.returncode = job.process.wait()
+        stderr_thread.join()
+        stderr = job.stderr
+        job.finished = time.time()
+        with self._lock:
+            if job.state != 'cancelled':
+                if job.returncode:
+                    job.state = 'failed'
+                    job.error = (stderr[-1].strip() if stderr
+                                 else 'exit code {}'.format(job.returncode))
+                else:
+                    job.state = 'done'
+        job._notify()
+        self.dispatch()
+
+
+_scheduler = None
+def get_scheduler():
+    """
+    Scheduler shared by all MMSetup dialogs in this session. Its
+    warm workers are those of the dialogs (see core.get_worker_pool).
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = JobScheduler(pool=WorkerPool(size=0))
+    return _scheduler
+
+
+class JobsWindow(object):
+
+    """
+    Lists the jobs of a JobScheduler and refreshes their progress.
+    """
+
+    def __init__(self, scheduler, title='MMSetup Jobs', refresh=1000):
+        self.scheduler = scheduler
+        self.refresh = refresh
+        self.window = tk.Toplevel()
+        self.window.title(title)
+        self.var_max_threads = tk.IntVar()
+        self.var_max_threads.set(scheduler.max_threads)
+        self.var_pin = tk.BooleanVar()
+        self.var_pin.set(scheduler.pin)
+
+        frame = tk.LabelFrame(self.window, text='Jobs')
+        frame.pack(expand=True, fill='both', padx=5, pady=5)
+        self.ui_jobs_listbox = tk.Listbox(frame, width=70, height=10, font='TkFixedFont')
+        self.ui_jobs_listbox.grid(row=0, column=0, columnspan=4, sticky='news')
+        tk.Label(frame, text='Thread budget').grid(row=1, column=0, sticky='w')
+        tk.Entry(frame, textvariable=self.var_max_threads, width=6).grid(row=1, column=1)
+        tk.Button(frame, text='Set', command=lambda: self.var_max_threads.set(
+            scheduler.set_max_threads(self.var_max_threads.get()))).grid(row=1, column=2)
+        tk.Button(frame, text='Cancel job', command=self._cancel).grid(row=1, column=3)
+        tk.Checkbutton(frame, text='Pin jobs to disjoint CPUs', variable=self.var_pin,
+                       command=lambda: setattr(scheduler, 'pin', self.var_pin.get())
+                       ).grid(row=2, column=0, columnspan=4, sticky='w')
+        self._update()
+
+    def exists(self):
+        try:
+            return bool(self.window.winfo_exists())
+        except tk.TclError:
+            return False
+
+    def _cancel(self):
+        selection = self.ui_jobs_listbox.curselection()
+        if selection:
+            self.scheduler.cancel(self.scheduler.jobs[int(selection[0])])
+
+    def _update(self):
+        try:
+            selection = self.ui_jobs_listbox.curselection()
+            self.ui_jobs_listbox.delete(0, 'end')
+            for job in self.scheduler.jobs:
+                self.ui_jobs_listbox.insert('end',
+                    '{:>3} {:<30.30} {:<9} {:>3}T {:>5.1%} {:>8.0f}s'.format(
+                        job.id, job.name, job.state, job.threads, job.progress, job.walltime))
+            for i in selection:
+                self.ui_jobs_listbox.selection_set(i)
+            self.window.after(self.refresh, self._update)
+        except tk.TclError:  # window closed
+            pass
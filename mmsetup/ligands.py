@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Persistent cache of small-molecule parameters.
+
+Ligands are given as force fields by their ``<name>.frcmod`` file,
+which OMMProtocol pairs with the ``<name>.gaff.mol2`` next to it (atom
+types and charges) and converts to an OpenMM force field fragment
+(ffxml) on every run. Here that fragment is stored under a key made of
+the canonical ligand structure, its charge model and its frcmod
+parameters, so later runs and sweeps of the same ligand use the stored
+fragment right away. Fragments are made with ParmEd, on top of the
+GAFF parameters of the local AmberTools, as OpenMolTools does.
+"""
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+import hashlib
+from distutils.spawn import find_executable
+# Own
+from utils import user_data_dir
+
+MOL2_EXTENSION = '.gaff.mol2'
+FRCMOD_EXTENSION = '.frcmod'
+
+
+def _stem(path):
+    name = os.path.basename(path)
+    for ext in (MOL2_EXTENSION, FRCMOD_EXTENSION, '.mol2'):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return os.path.splitext(name)[0]
+
+
+def read_mol2(path):
+    """
+    Atoms, bonds and charge model of a Tripos mol2 file.
+
+    Returns
+    -------
+    atoms : list of (name, type, charge)
+    bonds : list of (name, name, order)
+    charge_model : str
+    """
+    sections, current = {}, None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('@<TRIPOS>'):
+                current = sections.setdefault(line[9:], [])
+            elif current is not None:
+                current.append(line)
+    molecule = sections.get('MOLECULE', [])
+    charge_model = molecule[3] if len(molecule) > 3 else 'NO_CHARGES'
+    atoms, serials = [], {}
+    for line in sections.get('ATOM', []):
+        fields = line.split()
+        serials[fields[0]] = fields[1]
+        atoms.append((fields[1], fields[5], float(fields[8]) if len(fields) > 8 else 0.))
+    bonds = []
+    for line in sections.get('BOND', []):
+        fields = line.split()
+        bonds.append((serials[fields[1]], serials[fields[2]], fields[3]))
+    return atoms, bonds, charge_model
+
+
+def canonical_frcmod(path):
+    # Parameter lines only: the title and comments do not matter
+    with open(path) as f:
+        lines = f.read().splitlines()[1:]
+    return '\n'.join(' '.join(line.split()) for line in lines if line.strip())
+
+
+def ligand_key(mol2, frcmods=()):
+    """
+    Hash of the canonical structure of a ligand (atom names, types,
+    charges and bonds, but not its coordinates), its charge model and
+    its frcmod parameters.
+    """
+    atoms, bonds, charge_model = read_mol2(mol2)
+    sha = hashlib.sha1('charges={}\n'.format(charge_model).encode('utf-8'))
+    for name, kind, charge in sorted(atoms):
+        sha.update('{} {} {:.4f}\n'.format(name, kind, charge).encode('utf-8'))
+    for a, b, order in sorted((min(a, b), max(a, b), order) for (a, b, order) in bonds):
+        sha.update('{}-{} {}\n'.format(a, b, order).encode('utf-8'))
+    for frcmod in sorted(frcmods, key=canonical_frcmod):
+        sha.update(canonical_frcmod(frcmod).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def find_gaff_dat():
+    """
+    GAFF parameter file of the AmberTools in AMBERHOME or, else, of
+    the one providing ``tleap``, or None.
+    """
+    homes = [os.environ.get('AMBERHOME')]
+    tleap = find_executable('tleap')
+    if tleap:
+        homes.append(os.path.dirname(os.path.dirname(os.path.realpath(tleap))))
+    for home in homes:
+        if home:
+            path = os.path.join(home, 'dat', 'leap', 'parm', 'gaff.dat')
+            if os.path.isfile(path):
+                return path
+
+
+def convert(mol2, frcmods, output):
+    """
+    Write the ffxml fragment of a ligand with ParmEd
+    """
+    import parmed
+    from parmed.amber import AmberParameterSet
+    from parmed.openmm import OpenMMParameterSet
+    gaff = find_gaff_dat()
+    if gaff is None:
+        raise IOError('gaff.dat not found; set AMBERHOME')
+    residue = parmed.load_file(mol2)
+    params = OpenMMParameterSet.from_parameterset(AmberParameterSet(gaff, *frcmods))
+    params.residues[residue.name] = residue
+    tmp = '{}.{}.tmp'.format(output, os.getpid())
+    params.write(tmp)
+    os.rename(tmp, output)
+    return output
+
+
+def ligand_files(forcefields):
+    """
+    Ligands among `forcefields`: every ``.frcmod`` with its sibling
+    ``.gaff.mol2``, as OMMProtocol pairs them.
+
+    Returns
+    -------
+    ligands : list of (name, mol2, frcmod, path)
+        `path` is where its cached fragment is (or would be) stored
+    """
+    ligands = []
+    for frcmod in forcefields:
+        if not frcmod.endswith(FRCMOD_EXTENSION):
+            continue
+        mol2 = frcmod[:-len(FRCMOD_EXTENSION)] + MOL2_EXTENSION
+        if not os.path.isfile(mol2):
+            continue  # OMMProtocol will complain about it
+        path = os.path.join(user_data_dir('ligands'), ligand_key(mol2, [frcmod]) + '.xml')
+        ligands.append((_stem(frcmod), mol2, frcmod, path))
+    return ligands
+
+
+def resolve_ligands(forcefields):
+    """
+    Replace every ligand in `forcefields` (see `ligand_files`) whose
+    fragment is cached by that fragment. The others are left for
+    OMMProtocol to convert, and can be cached with `cache_ligands`.
+
+    Returns
+    -------
+    forcefields : list of str
+    report : dict
+        Names of the ligands found in the cache (hits) and not found
+        (misses)
+    """
+    report = {'hits': [], 'misses': []}
+    replaced = {}
+    for name, mol2, frcmod, path in ligand_files(forcefields):
+        if not os.path.isfile(path):
+            report['misses'].append(name)
+            continue
+        report['hits'].append(name)
+        replaced[frcmod] = path
+        replaced[mol2] = None
+    resolved = []
+    for forcefield in forcefields:
+        path = replaced.get(forcefield, forcefield)
+        if path is not None and path not in resolved:
+            resolved.append(path)
+    return resolved, report
+
+
+def cache_ligands(forcefields):
+    """
+    Convert and cache the fragments of the ligands in `forcefields`
+    not cached yet. Nothing is done without ParmEd or GAFF.
+
+    Returns
+    -------
+    cached : list of str
+        Names of the ligands cached now
+    """
+    try:
+        import parmed
+    except ImportError:
+        return []
+    if find_gaff_dat() is None:
+        return []
+    cached = []
+    for name, mol2, frcmod, path in ligand_files(forcefields):
+        if os.path.isfile(path):
+            continue
+        try:
+            convert(mol2, [frcmod], path)
+        except Exception:  # OMMProtocol converts it at run time anyway
+            continue
+        cached.append(name)
+    return cached
+
+
+def format_report(report):
+    parts = []
+    for key, label in (('hits', 'cached'), ('misses', 'not cached')):
+        if report[key]:
+            parts.append('{} {} ({})'.format(len(report[key]), label, ', '.join(report[key])))
+    if parts:
+        return 'Ligand parameters: ' + '; '.join(parts)
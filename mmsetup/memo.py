@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+import shutil
+import hashlib
+import yaml
+# Own
+from utils import user_data_dir
+from history import file_hash
+from recovery import STARTING_FILES, output_dir, find_stage_file
+
+# Files that define the starting system
+INPUT_FILES = ('topology', 'positions', 'charmm_parameters', 'velocities',
+               'box_vectors', 'checkpoint')
+# Serialized state OMMProtocol writes when a stage ends
+FINAL_STATE = '.state'
+
+
+def cache_dir(*subdirs):
+    return user_data_dir('stages', *subdirs)
+
+
+def _canonical(value):
+    return yaml.safe_dump(value, default_flow_style=True, width=float('inf'))
+
+
+def input_key(md_input, md_systemoptions, md_conditions):
+    """
+    Hash of everything the first stage starts from: the content of
+    the input files, the force fields, system options and conditions.
+    """
+    sha = hashlib.sha1()
+    for key in INPUT_FILES:
+        path = md_input.get(key)
+        if path:
+            sha.update('{}={}\n'.format(key, file_hash(path) if os.path.isfile(path)
+                                        else path).encode('utf-8'))
+    for path in md_input.get('forcefield') or ():
+        sha.update('forcefield={}\n'.format(file_hash(path) if os.path.isfile(path)
+                                            else path).encode('utf-8'))
+    sha.update(_canonical(dict(md_systemoptions)).encode('utf-8'))
+    sha.update(_canonical(dict(md_conditions)).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def stage_keys(md_input, md_systemoptions, md_conditions, stages):
+    """
+    Chained content hash of every stage: each key covers the stage
+    itself and everything upstream of it.
+    """
+    keys = []
+    key = input_key(md_input, md_systemoptions, md_conditions)
+    for stage in stages:
+        key = hashlib.sha1((key + _canonical(dict(stage))).encode('utf-8')).hexdigest()
+        keys.append(key)
+    return keys
+
+
+def lookup(key):
+    path = os.path.join(cache_dir(), key + FINAL_STATE)
+    if os.path.isfile(path):
+        return path
+
+
+def plan(keys):
+    """
+    Deepest stage with a cached final state.
+
+    Returns
+    -------
+    index, path : int, str
+        Index of that stage and its cached state, or (None, None)
+    """
+    for index in reversed(range(len(keys))):
+        path = lookup(keys[index])
+        if path is not None:
+            return index, path
+    return None, None
+
+
+def skip_cached(md_input, md_systemoptions, md_conditions, stages):
+    """
+    Drop the leading stages whose result is cached and start from the
+    final state of the deepest one instead.
+
+    Returns
+    -------
+    md_input : dict
+        Copy of `md_input`, with the cached state as checkpoint if any
+        (and without the files it replaces)
+    stages : list of dict
+        Stages left to run
+    keys : list of str
+        Cache keys of the stages left to run
+    resumed : str or None
+        Name of the cached stage the run starts from
+    """
+    keys = stage_keys(md_input, md_systemoptions, md_conditions, stages)
+    index, path = plan(keys)
+    if index is None:
+        return dict(md_input), list(stages), keys, None
+    md_input = dict(md_input, checkpoint=path)
+    for key in STARTING_FILES:
+        md_input.pop(key, None)
+    return md_input, stages[index + 1:], keys[index + 1:], stages[index]['name']
+
+
+def _pending_path(inputfile):
+    name = hashlib.sha1(os.path.abspath(inputfile).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir('pending'), name + '.yaml')
+
+
+def register(inputfile, keys, stages, outputpath, project_name):
+    """
+    Remember which cache keys the stages run by `inputfile` have, so
+    their final states can be stored once the run finishes. `stages`
+    are all the stages of the input, in order.
+    """
+    with open(_pending_path(inputfile), 'w') as f:
+        yaml.safe_dump({'input': os.path.abspath(inputfile),
+                        'stages': [{'name': s['name'], 'key': k} for (s, k) in zip(stages, keys)],
+                        'outputpath': output_dir(inputfile, outputpath),
+                        'project_name': project_name}, f, default_flow_style=False)
+
+
+def find_stage_state(outputpath, project_name, stages, index):
+    """
+    Final state written by stage `index` of `stages` in the directory
+    `outputpath` (see recovery.output_dir), or None.
+    """
+    return find_stage_file(outputpath, project_name, stages, index, FINAL_STATE)
+
+
+def store(inputfile):
+    """
+    Copy the final states of the stages run by `inputfile` to the
+    cache. Returns the number of stages stored.
+    """
+    pending = _pending_path(inputfile)
+    if not os.path.isfile(pending):
+        return 0
+    with open(pending) as f:
+        info = yaml.safe_load(f)
+    stored = 0
+    for index, stage in enumerate(info['stages']):
+        if lookup(stage['key']):
+            continue
+        state = find_stage_state(info['outputpath'], info['project_name'], info['stages'], index)
+        if state is None:
+            continue
+        target = os.path.join(cache_dir(), stage['key'] + FINAL_STATE)
+        shutil.copy2(state, target + '.tmp')
+        os.rename(target + '.tmp', target)
+        stored += 1
+    os.remove(pending)
+    return stored
+
+
+def store_job(job):
+    """
+    Done callback for jobs.Job
+    """
+    if job.state == 'done':
+        try:
+            store(job.inputfile)
+        except Exception:  # nothing cached; the job itself is fine
+            pass
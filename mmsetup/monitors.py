@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import Tkinter as tk
+import numpy as np
+
+
+class MonitorRegistry(object):
+
+    """
+    Geometric monitors (distances, angles and dihedrals) evaluated
+    on every frame received from the slave.
+
+    Each monitor is a tuple of 2, 3 or 4 atom indices, referring to
+    positions in the streamed coordinates. Monitors are compiled into
+    one index array per kind, so a frame is measured with a handful of
+    NumPy calls regardless of how many monitors are defined.
+    """
+
+    KINDS = {2: 'distance', 3: 'angle', 4: 'dihedral'}
+    # Rows preallocated for the time series; doubled when full
+    CAPACITY = 1024
+
+    def __init__(self):
+        self.names = []
+        self.indices = []
+        self._compiled = None
+        self.clear()
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, indices):
+        indices = tuple(int(i) for i in indices)
+        if len(indices) not in self.KINDS:
+            raise ValueError('Monitors need 2, 3 or 4 atoms, got {}'.format(len(indices)))
+        if name in self.names:
+            raise ValueError('Monitor {} already exists'.format(name))
+        self.names.append(name)
+        self.indices.append(indices)
+        self._compiled = None
+        self.clear()
+
+    def remove(self, name):
+        i = self.names.index(name)
+        del self.names[i]
+        del self.indices[i]
+        self._compiled = None
+        self.clear()
+
+    def clear(self):
+        self._size = 0
+        self._steps = np.empty(self.CAPACITY, dtype=int)
+        self._values = np.empty((self.CAPACITY, len(self.names)))
+
+    @property
+    def steps(self):
+        return self._steps[:self._size]
+
+    def _grow(self):
+        capacity = 2 * len(self._steps)
+        steps = np.empty(capacity, dtype=int)
+        values = np.empty((capacity, len(self.names)))
+        steps[:self._size] = self.steps
+        values[:self._size] = self._values[:self._size]
+        self._steps, self._values = steps, values
+
+    def compile(self):
+        """
+        Group monitors by kind into (M, k) index arrays. The column
+        order of the evaluated rows follows the registration order.
+        """
+        compiled = []
+        order = []
+        for n, kind in sorted(self.KINDS.items()):
+            columns = [i for (i, idx) in enumerate(self.indices) if len(idx) == n]
+            if columns:
+                array = np.array([self.indices[i] for i in columns], dtype=int)
+                compiled.append((kind, array))
+                order.extend(columns)
+        self._compiled = compiled, np.argsort(order)
+        return self._compiled
+
+    def measure(self, coordinates):
+        """
+        Evaluate all monitors on a single (N, 3) array of coordinates.
+        Distances are returned in the units of `coordinates`, angles
+        and dihedrals in degrees.
+        """
+        if self._compiled is None:
+            self.compile()
+        compiled, order = self._compiled
+        xyz = np.asarray(coordinates, dtype=float)
+        values = [getattr(self, '_' + kind)(xyz, idx) for (kind, idx) in compiled]
+        if not values:
+            return np.empty(0)
+        return np.concatenate(values)[order]
+
+    def evaluate(self, coordinates, steps):
+        """
+        Measure a frame and append the result to the time series.
+        """
+        if not self.names:
+            return
+        row = self.measure(coordinates)
+        if self._size == len(self._steps):
+            self._grow()
+        self._steps[self._size] = steps
+        self._values[self._size] = row
+        self._size += 1
+        return row
+
+    def series(self, name=None):
+        """
+        Return the recorded steps and values. If `name` is given, only
+        that monitor's column is returned. Both are views of the
+        preallocated buffers, valid until the next frame.
+        """
+        steps, values = self.steps, self._values[:self._size]
+        if name is not None:
+            values = values[:, self.names.index(name)]
+        return steps, values
+
+    # Vectorized geometry
+    @staticmethod
+    def _distance(xyz, idx):
+        d = xyz[idx[:, 1]] - xyz[idx[:, 0]]
+        return np.sqrt(np.einsum('ij,ij->i', d, d))
+
+    @staticmethod
+    def _angle(xyz, idx):
+        v1 = xyz[idx[:, 0]] - xyz[idx[:, 1]]
+        v2 = xyz[idx[:, 2]] - xyz[idx[:, 1]]
+        dot = np.einsum('ij,ij->i', v1, v2)
+        norms = np.sqrt(np.einsum('ij,ij->i', v1, v1) * np.einsum('ij,ij->i', v2, v2))
+        return np.degrees(np.arccos(np.clip(dot / norms, -1., 1.)))
+
+    @staticmethod
+    def _dihedral(xyz, idx):
+        b0 = xyz[idx[:, 0]] - xyz[idx[:, 1]]
+        b1 = xyz[idx[:, 2]] - xyz[idx[:, 1]]
+        b2 = xyz[idx[:, 3]] - xyz[idx[:, 2]]
+        b1 /= np.sqrt(np.einsum('ij,ij->i', b1, b1))[:, None]
+        v = b0 - np.einsum('ij,ij->i', b0, b1)[:, None] * b1
+        w = b2 - np.einsum('ij,ij->i', b2, b1)[:, None] * b1
+        x = np.einsum('ij,ij->i', v, w)
+        y = np.einsum('ij,ij->i', np.cross(b1, v), w)
+        return np.degrees(np.arctan2(y, x))
+
+
+class MonitorPlot(object):
+
+    """
+    Live plot of a MonitorRegistry time series in its own window.
+    Requires matplotlib; the window is not created if it is missing.
+    """
+
+    def __init__(self, registry, title='MMSetup Monitors'):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        self.registry = registry
+        self.window = tk.Toplevel()
+        self.window.title(title)
+        self.figure = Figure(figsize=(6, 4))
+        self.axes = {}
+        kinds = sorted(set(len(idx) for idx in registry.indices))
+        for row, n in enumerate(kinds, 1):
+            ax = self.figure.add_subplot(len(kinds), 1, row)
+            ax.set_ylabel(self.units(n))
+            self.axes[n] = ax
+        self.axes[kinds[-1]].set_xlabel('Steps')
+        self.lines = []
+        for name, idx in zip(registry.names, registry.indices):
+            line, = self.axes[len(idx)].plot([], [], label=name)
+            self.lines.append(line)
+        for ax in self.axes.values():
+            ax.legend(loc='upper left', fontsize='small')
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self.window)
+        self.canvas.get_tk_widget().pack(expand=True, fill='both')
+
+    @staticmethod
+    def units(n):
+        return 'Distance (A)' if n == 2 else 'Degrees'
+
+    def update(self):
+        steps, values = self.registry.series()
+        if not len(steps):
+            return
+        for column, line in enumerate(self.lines):
+            line.set_data(steps, values[:, column])
+        for ax in self.axes.values():
+            ax.relim()
+            ax.autoscale_view()
+        self.canvas.draw_idle()
+
+    def destroy(self):
+        try:
+            self.window.destroy()
+        except tk.TclError:
+            pass
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+from threading import Thread
+import Tkinter as tk
+# Own
+from system import build_system, add_barostat, subset_size
+from benchmark import time_platform
+from estimate import footprint, format_footprint, check_space, human_size
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return '{}d {}h'.format(days, hours)
+    if hours:
+        return '{}h {:02d}m'.format(hours, minutes)
+    return '{}m {:02d}s'.format(minutes, seconds)
+
+
+def uses_barostat(stage, md_conditions):
+    # Stages inherit the global conditions unless they override them
+    return bool(stage.get('barostat', md_conditions.get('barostat')))
+
+
+def preflight(md_input, md_output, md_hardware, md_conditions, md_systemoptions,
+              stages, steps=500):
+    """
+    Build the system and time a few MD steps, without and with barostat,
+    to project the wall time and trajectory size of every stage.
+    Minimizations are not timed.
+
+    Returns
+    -------
+    report : dict
+        natoms, ns_per_day (per stage kind), footprint (see
+        estimate.footprint) and stages, a list of dicts with name,
+        kind, ns, seconds and trajectory usage
+    """
+    system, topology, positions = build_system(md_input, md_systemoptions)
+    platform = md_hardware.get('platform')
+    properties = md_hardware.get('platform_properties')
+    speeds = {'NVT': time_platform(system, positions, md_conditions, platform,
+                                   properties, steps=steps)}
+    if any(uses_barostat(stage, md_conditions) for stage in stages):
+        if system.usesPeriodicBoundaryConditions():
+            add_barostat(system, md_conditions)
+            speeds['NPT'] = time_platform(system, positions, md_conditions, platform,
+                                          properties, steps=steps)
+    natoms = topology.getNumAtoms()
+    timestep = float(md_conditions.get('timestep', 1))
+    subset = md_output.get('trajectory_atom_subset')
+    estimate = footprint(natoms, stages, md_output,
+                         subset_size(topology, subset) if subset else None)
+    report = {'natoms': natoms, 'ns_per_day': speeds, 'footprint': estimate, 'stages': [],
+              'warning': check_space(estimate, md_output.get('outputpath'))}
+    for stage, trajectory in zip(stages, estimate['trajectory']):
+        kind = 'NPT' if uses_barostat(stage, md_conditions) and 'NPT' in speeds else 'NVT'
+        ns = int(stage['steps']) * timestep * 1e-6
+        report['stages'].append({'name': stage['name'], 'kind': kind, 'ns': ns,
+                                 'seconds': ns / speeds[kind] * 86400.,
+                                 'trajectory': trajectory})
+    return report
+
+
+def format_report(report):
+    lines = ['{} atoms'.format(report['natoms'])]
+    for kind, speed in sorted(report['ns_per_day'].items()):
+        lines.append('{}: {:.2f} ns/day'.format(kind, speed))
+    lines.append('')
+    lines.append('{:<16} {:<4} {:>9} {:>10} {:>10}'.format('Stage', '', 'ns', 'Wall time', 'Traj.'))
+    total_seconds = total_bytes = 0
+    for stage in report['stages']:
+        size = stage['trajectory']['bytes']
+        lines.append('{:<16.16} {:<4} {:>9.3f} {:>10} {:>10}'.format(
+            stage['name'], stage['kind'], stage['ns'],
+            format_duration(stage['seconds']), human_size(size) if size else '-'))
+        total_seconds += stage['seconds']
+        total_bytes += size
+    lines.append('{:<16} {:<4} {:>9} {:>10} {:>10}'.format(
+        'Total', '', '', format_duration(total_seconds), human_size(total_bytes)))
+    if 'footprint' in report:
+        lines.append('')
+        lines.extend(format_footprint(report['footprint']))
+    if report.get('warning'):
+        lines.extend(['', 'WARNING: ' + report['warning']])
+    return '\n'.join(lines)
+
+
+class PreflightWindow(object):
+
+    """
+    Runs `preflight` for the current settings in the background
+    and shows its report.
+    """
+
+    def __init__(self, model, title='MMSetup Pre-flight', steps=500):
+        self.window = tk.Toplevel()
+        self.window.title(title)
+        self.ui_text = tk.Text(self.window, width=60, height=24, font='TkFixedFont')
+        self.ui_text.pack(expand=True, fill='both', padx=5, pady=5)
+        self._show('Building the system and timing {} steps...'.format(steps))
+        self.result = None
+        args = (model.md_input, model.md_output, model.md_hardware,
+                model.md_conditions, model.md_systemoptions, model.stages)
+        self.thread = Thread(target=self._run, args=args, kwargs={'steps': steps})
+        self.thread.daemon = True
+        self.thread.start()
+        self.window.after(500, self._poll)
+
+    def _run(self, *args, **kwargs):
+        try:
+            self.result = format_report(preflight(*args, **kwargs))
+        except Exception as e:
+            self.result = 'Pre-flight failed: {}'.format(e)
+
+    def _poll(self):
+        try:
+            if self.thread.is_alive():
+                self.window.after(500, self._poll)
+            else:
+                self._show(self.result)
+        except tk.TclError:  # window closed
+            pass
+
+    def _show(self, text):
+        self.ui_text.configure(state='normal')
+        self.ui_text.delete('1.0', 'end')
+        self.ui_text.insert('end', text)
+        self.ui_text.configure(state='disabled')
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+import re
+import glob
+import time
+import shutil
+from copy import deepcopy
+import yaml
+
+# A stage writes ``<stem>.state`` when it ends and, every restart_every
+# steps, ``<stem>.rs.<step>`` restart files (see restart_step)
+# Written by OMMProtocol when interrupted (Ctrl+C or SIGINT)
+EMERGENCY_SUFFIX = '_emergency.state'
+# Input keys a checkpoint replaces; OMMProtocol would load them after it
+STARTING_FILES = ('positions', 'velocities', 'box', 'box_vectors')
+
+
+def output_dir(inputfile, outputpath=None):
+    """
+    Directory an input writes to: OMMProtocol takes `outputpath`
+    relative to the directory of the input file.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(inputfile)),
+                        os.path.expanduser(outputpath or '.'))
+
+
+def stage_stem(outputpath, project_name, stages, index):
+    """
+    Path of the files written by stage `index`, without extension:
+    ``<project>_<NN>_<stage>``, NN being its 1-based position in the
+    input, zero-padded as OMMProtocol does.
+    """
+    return os.path.join(outputpath, '{}_{:0{}d}_{}'.format(
+        project_name or '*', index + 1, len(str(len(stages))), stages[index]['name']))
+
+
+def find_stage_file(outputpath, project_name, stages, index, suffix):
+    """
+    Newest file written by stage `index` that ends in `suffix`
+    (``.state``, ``_emergency.state``...), numbered copies made to
+    avoid overwrites (``<stem>.1.state``) included, or None.
+    """
+    stem = stage_stem(outputpath, project_name, stages, index)
+    base, ext = os.path.splitext(stem + suffix)
+    candidates = glob.glob(base + ext) + glob.glob('{}.[0-9]*{}'.format(base, ext))
+    candidates = [path for path in candidates if os.path.isfile(path)]
+    if candidates:
+        return max(candidates, key=os.path.getmtime)
+
+
+def stage_at(stages, steps):
+    """
+    Locate the stage running at global step `steps`.
+
+    Returns
+    -------
+    index : int
+        Position of the stage in `stages`
+    done : int
+        Steps already completed within that stage
+    """
+    if not stages:
+        raise ValueError('No stages to locate step {} in'.format(steps))
+    start = 0
+    for index, stage in enumerate(stages):
+        length = int(stage['steps'])
+        if steps < start + length:
+            return index, steps - start
+        start += length
+    return len(stages) - 1, int(stages[-1]['steps'])
+
+
+def write_stop_record(path, inputfile, stages, steps, outputpath=None, project_name=None):
+    """
+    Record where a gracefully stopped run ended, so it can be resumed
+    later from the emergency state the slave saved on SIGINT. `state`
+    is None if the slave exited before saving one.
+    """
+    index, done = stage_at(stages, steps)
+    state = find_stage_file(output_dir(inputfile, outputpath), project_name, stages, index,
+                            EMERGENCY_SUFFIX)
+    record = {'input': os.path.abspath(inputfile),
+              'stage': stages[index]['name'],
+              'stage_index': index,
+              'stage_steps_done': done,
+              'state': state,
+              'steps': steps,
+              'outputpath': outputpath,
+              'project_name': project_name,
+              'stopped_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+    with open(path, 'w') as f:
+        f.write('# MMSetup stop record\n')
+        yaml.dump(record, f, default_flow_style=False)
+    return record
+
+
+def read_stop_record(path):
+    with open(path) as f:
+        return yaml.safe_load(f)
+
+
+def restart_step(path):
+    """
+    Step of its stage at which the restart file ``<stem>.rs.<step>`` was
+    written, or None for any other file. OMMProtocol keeps every one.
+    """
+    match = re.search(r'\.rs\.(\d+)$', path)
+    if match is not None:
+        return int(match.group(1))
+
+
+def find_latest_state(outputpath, project_name=None):
+    """
+    Newest restart or state file written in the directory `outputpath`
+    (see output_dir).
+    """
+    pattern = '{}_*'.format(project_name) if project_name else '*'
+    candidates = [path for path in glob.glob(os.path.join(outputpath, pattern))
+                  if (path.endswith('.state') or restart_step(path) is not None)
+                  and os.path.isfile(path)]
+    if candidates:
+        return max(candidates, key=os.path.getmtime)
+
+
+def stage_of_state(path, stages, project_name=None):
+    """
+    Index of the stage that wrote the state file `path`, read from its
+    name (``<project>_<NN>_<stage>...``), or None.
+    """
+    name = os.path.basename(path)
+    if project_name:
+        if not name.startswith(project_name + '_'):
+            return None
+        name = name[len(project_name) + 1:]
+    match = re.match(r'(\d+)_', name) if project_name else re.search(r'_(\d+)_', name)
+    if match is None:
+        return None
+    index = int(match.group(1)) - 1
+    if 0 <= index < len(stages) and name[match.end():].startswith(stages[index]['name']):
+        return index
+
+
+def is_emergency_state(path):
+    # Numbered copies (``_emergency.1.state``) included
+    return re.search(r'_emergency(\.\d+)?\.state$', path) is not None
+
+
+def is_final_state(path):
+    # Written when a stage ends, not while it runs or when it fails
+    return path.endswith('.state') and not is_emergency_state(path)
+
+
+def continuation_stages(stages, index, done):
+    """
+    Stages left to run after `done` steps of stage `index` were
+    completed. The partial stage is shortened and not minimized again.
+    """
+    remaining = deepcopy(stages[index:])
+    if done:
+        first = remaining[0]
+        first['steps'] = int(first['steps']) - done
+        first['minimization'] = False
+        if first['steps'] <= 0:
+            remaining.pop(0)
+    return remaining
+
+
+def plan_recovery(inputfile, steps):
+    """
+    Work out how to continue a failed run of `inputfile` that reached
+    global step `steps`.
+
+    Returns
+    -------
+    state : str
+        Restart/checkpoint file to start from
+    stages : list of dict
+        Remaining stages
+    skipped : int
+        Global steps already covered by `state`
+    note : str or None
+        Why steps already run will be run again, if they will
+    """
+    with open(inputfile) as f:
+        cfg = yaml.safe_load(f)
+    stages = cfg['stages']
+    project = cfg.get('project_name')
+    state = find_latest_state(output_dir(inputfile, cfg.get('outputpath')), project)
+    if state is None:
+        return None
+    reached, done = stage_at(stages, steps)
+    written = stage_of_state(state, stages, project)
+    if written is None:  # not from this input
+        return None
+    if is_final_state(state):
+        # Final state of a finished stage
+        index, done = written + 1, 0
+    elif is_emergency_state(state):
+        index, done = written, (done if written == reached else 0)
+    else:
+        index, done = written, restart_step(state)
+    remaining = continuation_stages(stages, index, done)
+    if not remaining:
+        return None
+    skipped = sum(int(s['steps']) for s in stages[:index]) + done
+    note = None
+    if steps > skipped and not cfg.get('restart_every'):
+        note = ('no periodic checkpoint was written (restart_every is not set), '
+                'so {} steps run again'.format(steps - skipped))
+    return state, remaining, skipped, note
+
+
+def write_continuation(inputfile, output, state, stages):
+    """
+    Copy of `inputfile` that starts from `state` and runs `stages`.
+    OMMProtocol picks the loader of a checkpoint by its extension, so
+    ``<stem>.rs.<step>`` restarts are copied next to `output` as `.rs`.
+    """
+    with open(inputfile) as f:
+        cfg = yaml.safe_load(f)
+    for key in STARTING_FILES:
+        cfg.pop(key, None)
+    checkpoint = state
+    if restart_step(state) is not None:
+        checkpoint = os.path.splitext(output)[0] + '.rs'
+        shutil.copyfile(state, checkpoint)
+    cfg['checkpoint'] = os.path.abspath(checkpoint)
+    cfg['stages'] = stages
+    with open(output, 'w') as f:
+        f.write('# Yaml input for OpenMM MD\n')
+        f.write('# Continuation of {} from {}\n\n'.format(inputfile, state))
+        yaml.safe_dump(cfg, f, default_flow_style=False)
+    return output
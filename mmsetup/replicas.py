@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+from collections import deque
+from subprocess import Popen, PIPE
+from threading import Thread
+from Queue import Queue, Empty
+import numpy as np
+import chimera
+import chimera.tkgui
+from chimera.tasks import Task
+from Movie.gui import MovieDialog
+# Own
+from stream import iter_chunks, decode_chunk
+from slave import slave_command
+
+
+def write_replicas(model, filename, replicas, threads=None):
+    """
+    Write one input per replica next to `filename`, identical to the
+    current settings but for the project name, so outputs do not
+    collide, and the CPU `threads` of each one, if given. OMMProtocol
+    has no seed option: OpenMM draws new random velocities and
+    thermostat noise for every run, so replicas diverge but cannot be
+    reproduced.
+
+    Returns
+    -------
+    inputs : list of str
+    """
+    base = os.path.splitext(filename)[0]
+    project = model.md_output.get('project_name', 'sys')
+    inputs = []
+    options = {}
+    properties = model.md_hardware.get('platform_properties') or {}
+    if threads and 'Threads' in properties:
+        options['platform_properties'] = dict(properties, Threads=str(threads))
+    for i in range(replicas):
+        config = model.config.copy(project_name='{}_rep{}'.format(project, i), **options)
+        inputs.append(config.write('{}_rep{}.yaml'.format(base, i), header=[
+            'Replica {} of {}'.format(i, replicas)]))
+    return inputs
+
+
+class ReplicaMonitor(object):
+
+    """
+    Follows several replicas of a protocol from a single ingestion loop.
+
+    Every replica streams into one shared queue, tagged with its index.
+    At each tick (one shared redraw cadence) the queue is drained, only
+    the newest position frame of each replica is kept and decoded into
+    a shared, preallocated buffer, and one coordset per replica is
+    added to its own model. The first replica drives an MD Movie dialog;
+    the others just show their newest frame.
+
+    Parameters
+    ----------
+    processes : list of Popen
+        Running OMMProtocol slaves, one per replica
+    molecules : list of chimera.Molecule
+        Model for each replica, all with the same atoms
+    total_steps : int
+    interval : int
+        Milliseconds between ticks
+    callback : callable, optional
+        Called once every replica has exited
+    """
+
+    def __init__(self, processes, molecules, total_steps, interval=500, title='Replicas',
+                 callback=None):
+        self.processes = processes
+        self.callback = callback
+        self.molecules = molecules
+        self.total_steps = total_steps
+        self.interval = interval
+        self.steps = [0] * len(processes)
+        self.buffer = np.zeros((len(molecules), molecules[0].numAtoms, 3), dtype=float)
+        self.queue = Queue()
+        self.stderr = [deque(maxlen=20) for p in processes]
+        for i, process in enumerate(processes):
+            for target, args in ((self._read, (i, process.stdout)),
+                                 (self.stderr[i].extend, (iter(process.stderr.readline, b''),))):
+                thread = Thread(target=target, args=args)
+                thread.daemon = True
+                thread.start()
+        self.task = Task('OMMProtocol {} ({} replicas)'.format(title, len(processes)),
+                         cancelCB=self.stop, statusFreq=((1,), 1))
+        self.ensemble = _Ensemble(molecules[0])
+        self.movie_dialog = MovieDialog(self.ensemble, externalEnsemble=True)
+        self.running = True
+        chimera.tkgui.app.after(self.interval, self.tick)
+
+    def _read(self, index, out):
+        for chunk in iter_chunks(out):
+            self.queue.put((index, chunk))
+
+    def tick(self):
+        if not self.running:  # stopped
+            return
+        latest = {}
+        while True:
+            try:
+                index, chunk = self.queue.get_nowait()
+            except Empty:
+                break
+            latest.setdefault(index, []).append(chunk)
+        for index, chunks in latest.items():
+            # Newest position frame only; older ones are never decoded
+            for chunk in reversed(chunks):
+                kind, steps, array = decode_chunk(chunk)
+                if kind == 'positions':
+                    np.multiply(array, 10., out=self.buffer[index])
+                    self._show(index, steps)
+                    break
+        self.task.updateStatus(' | '.join('R{}: {:.0%}'.format(i, s / self.total_steps)
+                                          for (i, s) in enumerate(self.steps)))
+        codes = [p.poll() for p in self.processes]
+        if None not in codes and self.queue.empty():
+            return self.finish(codes)
+        chimera.tkgui.app.after(self.interval, self.tick)
+
+    def _show(self, index, steps):
+        self.steps[index] = steps
+        molecule = self.molecules[index]
+        cs = molecule.newCoordSet(len(molecule.coordSets))
+        cs.load(self.buffer[index])
+        if index == 0:
+            self.ensemble.endFrame = self.movie_dialog.endFrame = len(molecule.coordSets)
+            self.movie_dialog.moreFramesUpdate('', [], self.movie_dialog.endFrame)
+            self.movie_dialog.plusCallback()
+        else:
+            molecule.activeCoordSet = cs
+
+    def stop(self, *args):
+        """
+        Terminate every replica still running
+        """
+        if not self.running:
+            return
+        for process in self.processes:
+            if process.poll() is None:
+                try:
+                    process.terminate()
+                except OSError:  # exited meanwhile
+                    pass
+        self.finish([p.wait() for p in self.processes], stopped=True)
+
+    def finish(self, codes, stopped=False):
+        self.running = False
+        self.task.finished()
+        if self.callback is not None:
+            self.callback()
+        failed = [i for (i, code) in enumerate(codes) if code]
+        if stopped:
+            chimera.statusline.show_message('Replicas stopped')
+        elif failed:
+            lines = b''.join(self.stderr[failed[0]]).decode('latin-1').strip().splitlines()
+            chimera.statusline.show_message('Replicas {} failed. Replica {}: {}'.format(
+                ', '.join(str(i) for i in failed), failed[0], lines[-1] if lines else
+                'exit code {}'.format(codes[failed[0]])), color='red')
+        else:
+            chimera.statusline.show_message('All {} replicas done'.format(len(codes)))
+
+
+class _Ensemble(object):
+
+    # Minimal MD Movie ensemble over the coordsets of a molecule
+
+    def __init__(self, molecule):
+        self.molecule = molecule
+        self.name = 'Replica 0 of {}'.format(molecule.name)
+        self.startFrame = self.endFrame = 1
+
+    def __len__(self):
+        return len(self.molecule.coordSets)
+
+    def __getitem__(self, key):
+        return None
+
+
+def launch_replicas(inputs, prefix=(), env=None):
+    env = dict(os.environ, OMMPROTOCOL_SLAVE='1', PYTHONIOENCODING='latin-1', **(env or {}))
+    return [Popen(slave_command(path, prefix), stdin=PIPE, stdout=PIPE,
+                  stderr=PIPE, bufsize=1, env=env) for path in inputs]
+
+
+def clone_models(molecule, topology, count):
+    """
+    `molecule` plus `count - 1` copies opened from `topology`, or
+    `count` copies if there is no `molecule`.
+    """
+    clones = [] if molecule is None else [molecule]
+    while len(clones) < count:
+        clone = chimera.openModels.open(topology)[0]
+        clone.name = '{} replica {}'.format(clone.name, len(clones))
+        clones.append(clone)
+    return clones
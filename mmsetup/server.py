@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Per-machine MMSetup job server.
+
+Owns the launch, queueing and CPU accounting of OMMProtocol runs for
+every Chimera session that connects to it, so several sessions share
+the machine fairly instead of oversubscribing it. Sessions talk to it
+through a Unix-domain socket with `JobServerClient`.
+
+Usage: python server.py [max_threads]
+"""
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+import sys
+import time
+import signal
+import getpass
+import socket
+import subprocess
+from io import BytesIO
+from collections import Counter, OrderedDict
+from threading import Thread, Lock, Condition
+from multiprocessing.connection import Listener, Client
+# Own
+from jobs import Job, JobScheduler
+from history import get_history
+from memo import store_job
+from utils import user_data_dir
+from affinity import launch_prefix
+
+# Environment variables a client may set for its jobs. Anything else
+# (PATH, LD_PRELOAD, PYTHONPATH...) would change what the server runs.
+CLIENT_ENV = ('OPENMM_CPU_THREADS', 'CUDA_VISIBLE_DEVICES', 'MMSETUP_FORCES_EVERY',
+              'MMSETUP_SYSTEM')
+
+
+def server_address():
+    """
+    Socket path of this user's server. MMSETUP_SERVER only moves it
+    elsewhere: the server runs jobs as its owner, so it is not meant to
+    be shared with other users.
+    """
+    return os.environ.get('MMSETUP_SERVER') or os.path.join(user_data_dir('server'), 'socket')
+
+
+def server_authkey(address=None):
+    path = (address or server_address()) + '.key'
+    if not os.path.isfile(path):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(32))
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def session_id():
+    return '{}@{}:{}'.format(getpass.getuser(), socket.gethostname(), os.getpid())
+
+
+class FairScheduler(JobScheduler):
+
+    """
+    JobScheduler that, whenever threads are freed, starts the oldest
+    queued job of the session currently using the fewest threads (and,
+    among those, the one served least so far), instead of the oldest
+    job overall.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(FairScheduler, self).__init__(*args, **kwargs)
+        self.served = Counter()
+
+    def _next(self):
+        usage = Counter()
+        for job in self.running:
+            usage[job.session] += job.threads
+        heads = OrderedDict()
+        for job in self.queue:
+            heads.setdefault(job.session, job)
+        fitting = [job for job in heads.values() if job.threads <= self.free_threads]
+        if fitting:
+            return min(fitting, key=lambda job: (usage[job.session], self.served[job.session],
+                                                 job.submitted))
+
+    def dispatch(self):
+        with self._lock:
+            job = self._next()
+            while job is not None:
+                self.queue.remove(job)
+                self.served[job.session] += job.threads
+                self._start(job)
+                job = self._next()
+
+
+class JobServer(object):
+
+    """
+    Accepts requests from JobServerClient instances, one thread per
+    connection. Requests are dicts with a `cmd` key:
+
+        submit     input, threads, session, affinity, numa_node, env
+                   (CLIENT_ENV keys only), record, memoize... -> job id
+        list       -> list of job summaries
+        cancel     id
+        stop       id, saving an emergency state (see Job.stop)
+        pause      id
+        resume     id
+        subscribe  id -> the connection then receives ('chunk', data)
+                   for every frame and a final ('exit', code, stderr)
+        threads    max_threads
+        shutdown
+    """
+
+    def __init__(self, address=None, authkey=None, max_threads=None):
+        self.address = address or server_address()
+        self.authkey = authkey or server_authkey(self.address)
+        self.scheduler = FairScheduler(max_threads=max_threads)
+        self.jobs = {}
+        self.running = False
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)  # stale, see ensure_server
+        self.listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    conn = self.listener.accept()
+                except Exception as e:  # failed handshake
+                    if self.running:
+                        print('Rejected connection:', e, file=sys.stderr)
+                    continue
+                thread = Thread(target=self._handle, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.listener.close()
+
+    def _handle(self, conn):
+        try:
+            while True:
+                request = conn.recv()
+                cmd = request.get('cmd')
+                if cmd == 'subscribe':
+                    return self._subscribe(conn, self.jobs[request['id']])
+                conn.send(getattr(self, 'do_' + cmd)(**request))
+                if cmd == 'shutdown':
+                    return self._wake()
+        except (EOFError, IOError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def do_submit(self, input, threads=1, session=None, total_steps=None, timestep=None,
+                  name=None, env=None, affinity=None, numa_node=None, record=False,
+                  natoms=None, memoize=False, **kwargs):
+        # Commands are built here, never taken from the client
+        env = dict((key, str(value)) for (key, value) in (env or {}).items()
+                   if key in CLIENT_ENV)
+        prefix = launch_prefix(affinity=affinity,
+                               numa_node=None if numa_node is None else int(numa_node))
+        job = Job(input, threads=min(int(threads), self.scheduler.max_threads),
+                  total_steps=total_steps, timestep=timestep, name=name, env=env,
+                  prefix=prefix)
+        job.session = session
+        if record:  # live runs are recorded by the session that follows them
+            job.add_done_callback(lambda job: get_history().record_job(job, natoms=natoms))
+        if memoize:
+            job.add_done_callback(store_job)
+        self.jobs[job.id] = job
+        self.scheduler.submit(job)
+        return job.id
+
+    def do_list(self, **kwargs):
+        return [{'id': job.id, 'name': job.name, 'session': job.session, 'state': job.state,
+                 'threads': job.threads, 'progress': job.progress, 'walltime': job.walltime,
+                 'steps': job.steps, 'error': job.error} for job in self.scheduler.jobs]
+
+    def do_cancel(self, id, **kwargs):
+        self.scheduler.cancel(self.jobs[id])
+        return True
+
+    def do_stop(self, id, **kwargs):
+        return self.jobs[id].stop()
+
+    def do_pause(self, id, **kwargs):
+        return self.jobs[id].pause()
+
+    def do_resume(self, id, **kwargs):
+        return self.jobs[id].resume()
+
+    def do_threads(self, max_threads, **kwargs):
+        self.scheduler.set_max_threads(max_threads)
+        return self.scheduler.max_threads
+
+    def do_shutdown(self, **kwargs):
+        self.running = False
+        for job in list(self.scheduler.jobs):
+            if job.state in ('queued', 'running'):
+                self.scheduler.cancel(job)
+        return True
+
+    def _wake(self):
+        # Unblock accept() so serve_forever sees it must stop
+        try:
+            Client(self.address, family='AF_UNIX', authkey=self.authkey).close()
+        except Exception:
+            pass
+
+    def _subscribe(self, conn, job):
+        lock = Lock()
+        finished = Condition(lock)
+        ending, done = [], []
+
+        def send(message):
+            with lock:
+                try:
+                    conn.send(message)
+                except (IOError, OSError, ValueError):
+                    job.remove_chunk_callback(on_chunk)
+
+        def on_chunk(job, chunk):
+            send(('chunk', chunk))
+
+        def on_done(job):
+            with lock:
+                if ending:
+                    return
+                ending.append(True)
+            job.remove_chunk_callback(on_chunk)
+            send(('exit', job.returncode if job.state != 'cancelled' else -15,
+                  list(job.stderr)))
+            with finished:
+                done.append(True)
+                finished.notify()
+
+        job.add_chunk_callback(on_chunk)
+        job.add_done_callback(on_done)
+        if job.state in ('done', 'failed', 'cancelled'):
+            on_done(job)
+        with finished:  # the connection is closed once the job ends
+            while not done:
+                finished.wait()
+        conn.close()
+
+
+class JobServerClient(object):
+
+    """
+    Connection from a session to the job server.
+    """
+
+    def __init__(self, address=None, authkey=None, session=None):
+        self.address = address or server_address()
+        self.authkey = authkey or server_authkey(self.address)
+        self.session = session or session_id()
+        self._conn = None
+        self._lock = Lock()
+
+    def connect(self):
+        return Client(self.address, family='AF_UNIX', authkey=self.authkey)
+
+    def request(self, cmd, **kwargs):
+        with self._lock:
+            if self._conn is None:
+                self._conn = self.connect()
+            try:
+                self._conn.send(dict(kwargs, cmd=cmd))
+                return self._conn.recv()
+            except (EOFError, IOError, OSError):
+                self._conn = None
+                raise
+
+    def submit(self, inputfile, threads=1, **kwargs):
+        return self.request('submit', input=os.path.abspath(inputfile), threads=threads,
+                            session=self.session, **kwargs)
+
+    def list(self):
+        return self.request('list')
+
+    def cancel(self, job_id):
+        return self.request('cancel', id=job_id)
+
+    def stop(self, job_id):
+        return self.request('stop', id=job_id)
+
+    def pause(self, job_id):
+        return self.request('pause', id=job_id)
+
+    def resume(self, job_id):
+        return self.request('resume', id=job_id)
+
+    def set_max_threads(self, max_threads):
+        return self.request('threads', max_threads=max_threads)
+
+    def shutdown(self):
+        return self.request('shutdown')
+
+    def subscribe(self, job_id):
+        """
+        New connection that receives the frames of job `job_id`
+        """
+        conn = self.connect()
+        conn.send({'cmd': 'subscribe', 'id': job_id})
+        return conn
+
+
+def is_server_running(address=None):
+    try:
+        JobServerClient(address).connect().close()
+    except Exception:
+        return False
+    return True
+
+
+def ensure_server(address=None, python=sys.executable, timeout=10):
+    """
+    Start the job server in its own session if it is not running yet.
+    """
+    address = address or server_address()
+    if is_server_running(address):
+        return
+    env = dict(os.environ, MMSETUP_SERVER=address)
+    script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    subprocess.Popen([python, script],
+                     env=env, close_fds=True, preexec_fn=os.setsid,
+                     stdin=open(os.devnull), stdout=open(os.devnull, 'w'),
+                     stderr=open(os.path.join(os.path.dirname(address), 'server.log'), 'a'))
+    deadline = time.time() + timeout
+    while not is_server_running(address):
+        if time.time() > deadline:
+            raise RuntimeError('MMSetup job server did not start')
+        time.sleep(0.2)
+
+
+class ServerProcess(object):
+
+    """
+    Popen-like handle for a job running on the server, usable by
+    SubprocessTask and the rest of the Controller machinery. `stdout`
+    replays the subscribed frames with the usual chunk framing. There
+    is no `stdin`: SIGINT is forwarded as a stop request, and SIGSTOP
+    and SIGCONT as pause and resume requests.
+    """
+
+    def __init__(self, client, job_id, progressCB=None):
+        self.client = client
+        self.job_id = job_id
+        self.pid = None
+        self.progressCB = progressCB
+        self.returncode = None
+        self.stdin = None
+        self._stderr_lines = []
+        read, self._write = os.pipe()
+        self.stdout = os.fdopen(read, 'rb')
+        self._conn = client.subscribe(job_id)
+        thread = Thread(target=self._receive)
+        thread.daemon = True
+        thread.start()
+
+    def _receive(self):
+        code = None
+        with os.fdopen(self._write, 'wb') as out:
+            try:
+                while True:
+                    message = self._conn.recv()
+                    if message[0] == 'chunk':
+                        out.write(b'STARTOFCHUNK\n' + message[1] + b'ENDOFCHUNK\n')
+                        out.flush()
+                    elif message[0] == 'exit':
+                        code, self._stderr_lines = message[1], message[2]
+                        break
+            except (EOFError, IOError, OSError):
+                code = -1 if code is None else code
+        self._conn.close()
+        self.returncode = code
+
+    @property
+    def stderr(self):
+        return BytesIO(b''.join(self._stderr_lines) or b'Job server connection lost\n')
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            time.sleep(0.5)
+        return self.returncode
+
+    def terminate(self):
+        try:
+            self.client.cancel(self.job_id)
+        except Exception:
+            pass
+
+    kill = terminate
+
+    def send_signal(self, sig):
+        requests = {signal.SIGINT: self.client.stop, signal.SIGSTOP: self.client.pause,
+                    signal.SIGCONT: self.client.resume}
+        if sig in requests:
+            if not requests[sig](self.job_id):
+                raise OSError('Job {} is not running'.format(self.job_id))
+        else:
+            self.terminate()
+
+
+_client = None
+def get_client():
+    """
+    Job server client shared by all MMSetup dialogs in this session,
+    starting the server if needed
+    """
+    global _client
+    ensure_server()
+    if _client is None:
+        _client = JobServerClient()
+    return _client
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    max_threads = int(argv[0]) if argv else None
+    JobServer(max_threads=max_threads).serve_forever()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+OMMProtocol with the MMSetup extensions for live runs.
+
+Runs an input exactly like `ommprotocol input.yaml` would, after
+patching OMMProtocol with the extensions enabled in the environment:
+
+    MMSETUP_FORCES_EVERY=<steps>
+        Next to the position frames of OMMPROTOCOL_SLAVE, stream the
+        forces on every atom as ('forces', steps, float32 bytes) chunks.
+
+    MMSETUP_SYSTEM=<path prefix>
+        Reuse the serialized System stored under this prefix for the
+        same system options, or store the one created. The prefix
+        already identifies the topology, force fields and input files
+        (see system.system_cache_prefix).
+
+    MMSETUP_STREAM=<path>, MMSETUP_STREAM_FRAMES=<frames>
+        Write stdout to <path> instead, moving it to <path>.1 every
+        <frames> frames, so only the last ones are kept on disk.
+
+This script runs with the Python interpreter of ommprotocol, which is
+not necessarily the one Chimera uses, so it must not import Chimera.
+
+Usage: python slave.py input.yaml
+"""
+
+from __future__ import print_function, division
+import os
+import sys
+import pickle
+import hashlib
+from distutils.spawn import find_executable
+
+SLAVE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'slave.py')
+
+
+def slave_python():
+    """
+    Interpreter command used by the `ommprotocol` executable, read from
+    its shebang, so the slave can import everything ommprotocol needs.
+    """
+    path = find_executable('ommprotocol')
+    if path:
+        with open(path) as f:
+            first = f.readline()
+        if first.startswith('#!') and 'python' in first:
+            return first[2:].split()
+    return [sys.executable]
+
+
+def slave_command(inputfile, prefix=()):
+    """
+    Command that runs `inputfile` with the MMSetup extensions, after
+    an optional `prefix` (taskset, numactl...).
+    """
+    return list(prefix) + slave_python() + [SLAVE_SCRIPT, inputfile]
+
+
+class ForceReporter(object):
+
+    """
+    Write the forces on every atom (kJ/mol/nm) every `interval` steps,
+    framed like the chunks of ommprotocol's SerializedReporter so the
+    same reader gets both. `offset` is added to the step count of the
+    simulation so steps keep growing across stages.
+    """
+
+    def __init__(self, out, interval, offset=0):
+        self._out = out
+        self.interval = interval
+        self.offset = offset
+
+    def describeNextReport(self, simulation):
+        steps = self.interval - simulation.currentStep % self.interval
+        return steps, False, False, True, False
+
+    def report(self, simulation, state):
+        import numpy as np
+        from simtk import unit
+        forces = state.getForces(asNumpy=True).value_in_unit(
+            unit.kilojoule_per_mole / unit.nanometer)
+        forces = np.asarray(forces, dtype='<f4')
+        frame = ('forces', self.offset + simulation.currentStep, forces.tobytes())
+        self._out.write(b''.join([b'\nSTARTOFCHUNK\n', pickle.dumps(frame, 2),
+                                  b'\nENDOFCHUNK\n']))
+        self._out.flush()
+
+
+class RotatingStream(object):
+
+    """
+    Binary stdout replacement that writes to `path` and moves it to
+    `path`.1 once it holds `frames` chunks. Chunks are written in one
+    call each by the reporters, so they are never split across files.
+    """
+
+    def __init__(self, path, frames):
+        self.path = path
+        self.frames = max(1, int(frames))
+        self.count = 0
+        self._file = open(path, 'wb', 0)
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('latin-1', 'replace')
+        if data.startswith(b'\nSTARTOFCHUNK\n'):
+            if self.count >= self.frames:
+                self.rotate()
+            self.count += 1
+        self._file.write(data)
+
+    def rotate(self):
+        self._file.close()
+        os.rename(self.path, self.path + '.1')
+        self._file = open(self.path, 'wb', 0)
+        self.count = 0
+
+    def flush(self):
+        self._file.flush()
+
+
+def cached_system(prefix, options, create):
+    """
+    Deserialize the System stored for `prefix` and `options`, or build
+    it with `create()` and store it for the next run.
+    """
+    from simtk import openmm
+    key = '{}\n{!r}'.format(openmm.__version__, sorted(options.items()))
+    path = '{}_{}.xml'.format(prefix, hashlib.sha1(key.encode('utf-8')).hexdigest()[:12])
+    if os.path.isfile(path):
+        try:
+            with open(path) as f:
+                return openmm.XmlSerializer.deserialize(f.read())
+        except Exception as e:  # truncated or from another build; replace it
+            print('Could not reuse the cached System {}: {}'.format(path, e), file=sys.stderr)
+    system = create()
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            f.write(openmm.XmlSerializer.serialize(system))
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        print('Could not cache the System: {}'.format(e), file=sys.stderr)
+    return system
+
+
+def install():
+    """
+    Patch OMMProtocol's stages and systems with the extensions. The
+    environment is read each time they are used, so a slave can be
+    patched before the run it will serve is known.
+    """
+    from ommprotocol.io import SystemHandler
+    from ommprotocol.md import Stage
+    create_system = SystemHandler.create_system
+
+    def create_system_with_cache(self, **options):
+        prefix = os.environ.get('MMSETUP_SYSTEM')
+        if not prefix:
+            return create_system(self, **options)
+        system = cached_system(prefix, options, lambda: create_system(self, **options))
+        if self.has_box:  # the cached one has the box of the run that stored it
+            system.setDefaultPeriodicBoxVectors(*self.box)
+        return system
+
+    SystemHandler.create_system = create_system_with_cache
+
+    simulate = Stage.simulate
+    done = [0]  # steps of previous stages
+
+    def simulate_with_extensions(self, steps=None):
+        if steps is None:
+            steps = self.steps
+        every = int(os.environ.get('MMSETUP_FORCES_EVERY') or 0)
+        reporter = None
+        # Stage.run adds its reporters right before calling this, once the
+        # restraints and barostat are in the system and the simulation exists
+        if every > 0 and self.report and os.environ.get('OMMPROTOCOL_SLAVE'):
+            out = getattr(sys.stdout, 'buffer', sys.stdout)
+            reporter = ForceReporter(out, every, done[0] - self.simulation.currentStep)
+            self.simulation.reporters.append(reporter)
+        try:
+            return simulate(self, steps)
+        finally:
+            done[0] += steps
+            if reporter is not None:
+                self.simulation.reporters.remove(reporter)
+
+    Stage.simulate = simulate_with_extensions
+
+
+def entry_point():
+    import pkg_resources
+    return pkg_resources.load_entry_point('ommprotocol', 'console_scripts', 'ommprotocol')
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) != 1:
+        sys.exit('Usage: python slave.py input.yaml')
+    install()
+    if os.environ.get('MMSETUP_STREAM'):
+        sys.stdout = RotatingStream(os.environ['MMSETUP_STREAM'],
+                                    os.environ.get('MMSETUP_STREAM_FRAMES') or 100)
+    sys.argv = ['ommprotocol', argv[0]]
+    return entry_point()()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
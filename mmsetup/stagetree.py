@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+from collections import namedtuple
+# Own
+from inputs import write_input
+from jobs import Job
+from memo import FINAL_STATE, find_stage_state
+from recovery import STARTING_FILES, output_dir, stage_stem
+
+Segment = namedtuple('Segment', 'index stages parent')
+
+
+class StageTree(object):
+
+    """
+    Stages arranged as a tree. A stage follows the previous one in
+    the list, unless its ``parent`` key names an earlier stage: then it
+    forks from the final state of that stage. Several stages with the
+    same parent are alternative branches of the protocol.
+
+    The tree is split in segments, runs of stages without forks. Each
+    segment is one OMMProtocol input, which starts from the final
+    state of the last stage of its parent segment.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.parents = []
+        self.children = [[] for stage in stages]
+        names = {}
+        for i, stage in enumerate(stages):
+            name = stage['name']
+            if name in names:
+                raise ValueError('Stage names must be unique: {}'.format(name))
+            parent = stage.get('parent')
+            if parent:
+                if parent not in names:
+                    raise ValueError('Stage {} forks from {}, which is not an earlier '
+                                     'stage'.format(name, parent))
+                parent = names[parent]
+            else:
+                parent = i - 1 if i else None
+            names[name] = i
+            self.parents.append(parent)
+            if parent is not None:
+                self.children[parent].append(i)
+
+    @property
+    def is_linear(self):
+        return all(len(children) <= 1 for children in self.children)
+
+    @property
+    def leaves(self):
+        return [i for (i, children) in enumerate(self.children) if not children]
+
+    def branch(self, leaf):
+        """
+        Stages from the root down to stage `leaf`
+        """
+        path = []
+        while leaf is not None:
+            path.append(self.stages[leaf])
+            leaf = self.parents[leaf]
+        return path[::-1]
+
+    def segments(self):
+        """
+        Runs of stages without forks, parents first.
+
+        Returns
+        -------
+        segments : list of Segment
+            With the stages of each segment and the index of its
+            parent segment (None for the shared root)
+        """
+        if not self.stages:
+            return []
+        segments = []
+        pending = [(0, None)]
+        while pending:
+            first, parent = pending.pop(0)
+            stages = [first]
+            while len(self.children[stages[-1]]) == 1:
+                stages.append(self.children[stages[-1]][0])
+            index = len(segments)
+            segments.append(Segment(index, [self.stages[i] for i in stages], parent))
+            pending.extend((child, index) for child in self.children[stages[-1]])
+        return segments
+
+    def write(self, path, md_input, md_output, md_hardware, md_conditions,
+              md_systemoptions, header=()):
+        """
+        Write one input per segment. The root segment goes to `path`
+        and every other one to ``<path>_<first stage>.yaml``, with its
+        own project name and the final state of its parent segment as
+        checkpoint. All of them sit in the same directory, so they
+        share the relative `outputpath`.
+
+        Returns
+        -------
+        branches : list of dict
+            input, project_name, outputpath, stages, parent (index),
+            checkpoint, and the sections and header the input was
+            written with, of every segment, parents first
+        """
+        base = os.path.splitext(path)[0]
+        project = md_output.get('project_name') or 'sys'
+        outputpath = md_output.get('outputpath') or '.'
+        branches = []
+        for segment in self.segments():
+            first = segment.stages[0]['name']
+            # Named explicitly: ommprotocol would pick a random one
+            seg_input, seg_output = dict(md_input), dict(md_output, project_name=project)
+            if segment.parent is None:
+                filename = path
+            else:
+                filename = '{}_{}.yaml'.format(base, first)
+                seg_output['project_name'] = '{}_{}'.format(project, first)
+                parent = branches[segment.parent]
+                seg_input['checkpoint'] = stage_stem(
+                    outputpath, parent['project_name'], parent['stages'],
+                    len(parent['stages']) - 1) + FINAL_STATE
+                for key in STARTING_FILES:  # in the checkpoint
+                    seg_input.pop(key, None)
+            lines = list(header)
+            if segment.parent is not None:
+                lines.append('Branch of {}, forks after stage {}'.format(
+                             os.path.basename(path), branches[segment.parent]['stages'][-1]['name']))
+            sections = (seg_input, seg_output, md_hardware, md_conditions, md_systemoptions)
+            write_input(filename, *sections, stages=segment.stages, header=lines)
+            branches.append({'input': filename,
+                             'project_name': seg_output.get('project_name') or project,
+                             'outputpath': outputpath,
+                             'stages': segment.stages,
+                             'parent': segment.parent,
+                             'checkpoint': seg_input.get('checkpoint'),
+                             'sections': sections,
+                             'header': lines})
+        return branches
+
+
+def _rewire(branch, state):
+    # Point the input to the state the parent actually wrote
+    md_input = dict(branch['sections'][0], checkpoint=state)
+    branch['sections'] = (md_input,) + tuple(branch['sections'][1:])
+    write_input(branch['input'], *branch['sections'], stages=branch['stages'],
+                header=branch['header'])
+    branch['checkpoint'] = state
+
+
+def submit_tree(scheduler, branches, threads=1, timestep=None, env=None, prefix=None,
+                callback=None, report=None):
+    """
+    Submit the root segments of `branches` (see StageTree.write) to a
+    JobScheduler. Each other segment is submitted once its parent is
+    done, so all branches of a fork run in parallel after the shared
+    prefix has been run once.
+
+    Parameters
+    ----------
+    callback : callable, optional
+        Called with every job as it is submitted
+    report : callable, optional
+        Called with a message when a failed segment leaves branches
+        unrun
+
+    Returns
+    -------
+    jobs : list of Job
+        The jobs submitted right away
+    """
+    def submit(index):
+        branch = branches[index]
+        job = Job(branch['input'], threads=threads, timestep=timestep, env=env, prefix=prefix,
+                  total_steps=sum(int(s['steps']) for s in branch['stages']))
+        job.add_done_callback(lambda job: on_done(index, job))
+        scheduler.submit(job)
+        if callback is not None:
+            callback(job)
+        return job
+
+    def on_done(index, job):
+        children = [i for (i, b) in enumerate(branches) if b['parent'] == index]
+        if not children:
+            return
+        if job.state != 'done':
+            msg = '{} {}; its {} branch(es) will not run'.format(job.name, job.state,
+                                                                 len(children))
+            job.error = '{} ({})'.format(job.error, msg) if job.error else msg
+            if report is not None:
+                report(msg)
+            return
+        branch = branches[index]
+        # Numbered copy, if an earlier run left the expected name taken
+        state = find_stage_state(output_dir(branch['input'], branch['outputpath']),
+                                 branch['project_name'], branch['stages'],
+                                 len(branch['stages']) - 1)
+        for i in children:
+            expected = os.path.join(os.path.dirname(branches[i]['input']),
+                                    branches[i]['checkpoint'])
+            if state is not None and os.path.abspath(state) != os.path.abspath(expected):
+                _rewire(branches[i], state)
+            submit(i)
+
+    return [submit(i) for (i, branch) in enumerate(branches) if branch['parent'] is None]
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import pickle
+import numpy as np
+
+
+def iter_chunks(out):
+    """
+    Yield the raw chunks written by an OMMProtocol slave between
+    STARTOFCHUNK and ENDOFCHUNK lines, until `out` is exhausted.
+    """
+    while True:
+        line = out.readline()
+        if line == b'STARTOFCHUNK\n':
+            lines = []
+            for line in iter(out.readline, b'ENDOFCHUNK\n'):
+                lines.append(line)
+            yield b''.join(lines)
+        elif line == b'':
+            break
+
+
+def enqueue_output(out, queue):
+    for chunk in iter_chunks(out):
+        queue.put(chunk)
+
+
+def decode_chunk(chunk):
+    """
+    Unpickle a frame sent by the slave. Position frames are plain
+    (steps, positions) tuples; other frame types are prefixed with
+    their kind, like ('forces', steps, float32 bytes).
+
+    Returns
+    -------
+    kind, steps, array
+    """
+    frame = pickle.loads(chunk)
+    if len(frame) == 2:
+        return ('positions',) + tuple(frame)
+    kind, steps, array = frame
+    if kind == 'forces':
+        array = np.frombuffer(array, dtype='<f4').reshape(-1, 3)
+    return kind, steps, array
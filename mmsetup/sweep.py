@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+import re
+import itertools
+from collections import OrderedDict
+from threading import RLock
+import Tkinter as tk
+from tkFileDialog import askdirectory
+import yaml
+# Own
+from config import FIELD_SECTION, FIELD_TYPE, coerce
+from jobs import Job, get_scheduler
+from affinity import launch_prefix
+from history import get_history
+
+
+class Sweep(object):
+
+    """
+    Cross product of parameter values applied to a Configuration, or
+    to the one of a Model, which is parsed first.
+
+    Axes are named after the key they change:
+
+    - Any setting of config.FIELDS, like ``temperature`` or
+      ``nonbondedCutoff``.
+    - A stage field, as ``<stage name>.<field>``, like
+      ``production.steps``. Use ``*.<field>`` to change all stages.
+
+    A setting also changes the stages that override it, so sweeping
+    ``temperature`` reaches every stage. Values are kept as given,
+    zeros included.
+
+    Each combination is run `replicas` times, with only its project
+    name and output path changed.
+    """
+
+    def __init__(self, model, name='sweep', replicas=1):
+        self.model = model
+        self.name = name
+        self.replicas = max(1, int(replicas))
+        self.axes = OrderedDict()
+        self.manifest = None
+        self._lock = RLock()
+
+    def add_axis(self, key, values):
+        if not values:
+            raise ValueError('Axis {} has no values'.format(key))
+        self.axes[key] = list(values)
+
+    def __len__(self):
+        n = 1
+        for values in self.axes.values():
+            n *= len(values)
+        return n * self.replicas
+
+    @property
+    def config(self):
+        return getattr(self.model, 'config', self.model)
+
+    def expand(self):
+        """
+        Yield (label, parameters, config) for every run.
+        """
+        if hasattr(self.model, 'parse'):
+            self.model.parse()
+        keys = list(self.axes.keys())
+        for combination in itertools.product(*self.axes.values()):
+            config = self.config.copy()
+            parameters = OrderedDict(zip(keys, combination))
+            for key, value in parameters.items():
+                self._apply(config, key, value)
+            labels = ['{}{}'.format(k.split('.')[-1], v) for (k, v) in parameters.items()]
+            label = re.sub(r'[^\w.+-]', '-', '_'.join(labels) or 'run')
+            if self.replicas == 1:
+                yield label, parameters, config
+                continue
+            for replica in range(1, self.replicas + 1):
+                # write() renames each config, so each replica gets a fresh copy
+                yield '{}_r{}'.format(label, replica), parameters, config.copy()
+
+    @staticmethod
+    def _apply(config, key, value):
+        if '.' in key:
+            stage_name, field = key.split('.', 1)
+            matched = [s for s in config.stages if stage_name in ('*', s['name'])]
+            if not matched:
+                raise ValueError('No stage named {}'.format(stage_name))
+            for stage in matched:
+                stage[field] = value
+            return
+        if key not in FIELD_SECTION:
+            raise ValueError('Unknown sweep key {}'.format(key))
+        try:
+            value = coerce(FIELD_TYPE[key], value)
+        except (TypeError, ValueError):
+            raise ValueError('Wrong value for {}: {!r}'.format(key, value))
+        # set() would drop zeros and empty values
+        getattr(config, FIELD_SECTION[key])[key] = value
+        for stage in config.stages:
+            if key in stage:
+                stage[key] = value
+
+    def write(self, directory):
+        """
+        Write one input per run under `directory` and the sweep manifest.
+        Every run gets its own output path and project name.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        runs = []
+        for label, parameters, config in self.expand():
+            project = config.get('project_name', 'sys')
+            config.update(project_name='{}_{}'.format(project, label),
+                          outputpath=os.path.join(directory, label))
+            path = config.write(os.path.join(directory, '{}_{}.yaml'.format(self.name, label)))
+            runs.append({'label': label,
+                         'input': path,
+                         'parameters': dict(parameters),
+                         'outputpath': config.get('outputpath'),
+                         'total_steps': config.total_steps,
+                         'timestep': config.get('timestep'),
+                         'state': 'written'})
+        self.manifest = {'name': self.name,
+                         'path': os.path.join(directory, '{}_manifest.yaml'.format(self.name)),
+                         'axes': dict(self.axes),
+                         'replicas': self.replicas,
+                         'runs': runs}
+        self.write_manifest()
+        return [run['input'] for run in runs]
+
+    def write_manifest(self):
+        with self._lock:
+            with open(self.manifest['path'], 'w') as f:
+                f.write('# MMSetup sweep manifest\n')
+                yaml.safe_dump(self.manifest, f, default_flow_style=False)
+
+    def submit(self, scheduler=None, threads=1, env=None, prefix=None, cpus=None,
+               natoms=None):
+        """
+        Queue all written runs on the local job scheduler. The manifest
+        is updated with state, wall time and throughput as runs finish,
+        and the runs are recorded in the history as of `natoms` atoms.
+        If `cpus` are given, each run is bound to its own `threads` of
+        them while it runs.
+        """
+        scheduler = scheduler or get_scheduler()
+        jobs = []
+        for run in self.manifest['runs']:
+            job = Job(run['input'], threads=threads, total_steps=run['total_steps'],
+                      timestep=run['timestep'], name='{} {}'.format(self.name, run['label']),
+                      env=env, prefix=prefix, cpuset=cpus)
+            job.add_done_callback(lambda job, run=run: self._collect(job, run))
+            job.add_done_callback(lambda job: get_history().record_job(job, natoms=natoms))
+            run['state'] = 'queued'
+            jobs.append(scheduler.submit(job))
+        self.write_manifest()
+        return jobs
+
+    def _collect(self, job, run):
+        with self._lock:
+            run['state'] = job.state
+            run['walltime'] = round(job.walltime, 1)
+            if job.ns_per_day is not None:
+                run['ns_per_day'] = round(job.ns_per_day, 3)
+            if job.error:
+                run['error'] = str(job.error)
+            self.write_manifest()
+
+
+class SweepWindow(object):
+
+    """
+    Declare sweep axes for the current dialog settings, then write
+    and queue all the runs in one go.
+    """
+
+    def __init__(self, controller, title='MMSetup Sweep'):
+        self.controller = controller
+        self.window = tk.Toplevel()
+        self.window.title(title)
+        self.var_name = tk.StringVar()
+        self.var_key = tk.StringVar()
+        self.var_values = tk.StringVar()
+        self.var_replicas = tk.IntVar()
+        self.var_name.set('sweep')
+        self.var_replicas.set(1)
+        self.axes = []
+
+        frame = tk.LabelFrame(self.window, text='Axes (e.g. temperature = 290, 300, 310)')
+        frame.pack(expand=True, fill='both', padx=5, pady=5)
+        self.ui_axes_listbox = tk.Listbox(frame, width=50, height=6)
+        self.ui_axes_listbox.grid(row=0, column=0, columnspan=4, sticky='news')
+        tk.Entry(frame, textvariable=self.var_key, width=20).grid(row=1, column=0)
+        tk.Label(frame, text='=').grid(row=1, column=1)
+        tk.Entry(frame, textvariable=self.var_values, width=20).grid(row=1, column=2)
+        tk.Button(frame, text='+', command=self._add_axis).grid(row=1, column=3)
+        tk.Label(frame, text='Sweep name').grid(row=2, column=0, sticky='w')
+        tk.Entry(frame, textvariable=self.var_name, width=20).grid(row=2, column=2, sticky='w')
+        tk.Label(frame, text='Replicas').grid(row=3, column=0, sticky='w')
+        tk.Entry(frame, textvariable=self.var_replicas, width=5).grid(row=3, column=2, sticky='w')
+        tk.Button(frame, text='Write & Queue', command=self._run).grid(
+            row=4, column=0, columnspan=4, sticky='ew')
+
+    def _add_axis(self):
+        key = self.var_key.get().strip()
+        values = [yaml.safe_load(v) for v in self.var_values.get().split(',') if v.strip()]
+        if key and values:
+            self.axes.append((key, values))
+            self.ui_axes_listbox.insert('end', '{} = {}'.format(
+                key, ', '.join(str(v) for v in values)))
+
+    def _run(self):
+        directory = askdirectory(parent=self.window, title='Sweep output directory')
+        if not directory:
+            return
+        sweep = Sweep(self.controller.model, name=self.var_name.get() or 'sweep',
+                      replicas=self.var_replicas.get())
+        for key, values in self.axes:
+            sweep.add_axis(key, values)
+        sweep.write(directory)
+        try:
+            natoms = self.controller.model.atom_counts()[0]
+        except Exception:  # recorded without size
+            natoms = None
+        # Cached Systems are only shared if every run has the same files
+        env = {}
+        if not any(FIELD_SECTION.get(key) == 'md_input' for key in sweep.axes):
+            env = self.controller.model.system_env
+        # Every run gets its own share of the CPUs the dialog is bound to
+        model = self.controller.model
+        prefix = launch_prefix(numa_node=model.numa_node) if model.cpus else model.prefix
+        sweep.submit(threads=model.threads, env=env, prefix=prefix, cpus=model.cpus,
+                     natoms=natoms)
+        self.controller.show_jobs()
+        self.window.destroy()
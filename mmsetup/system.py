@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+import hashlib
+# OpenMM package
+from simtk import openmm, unit
+from simtk.openmm import app
+# Own
+from utils import user_data_dir
+from history import file_hash
+
+# Shorthands ommprotocol accepts in trajectory_atom_subset
+SELECTORS = {'protein_no_H': 'protein and element != H',
+             'calpha': 'name == CA'}
+
+
+def load_topology(md_input):
+    """
+    Load the topology and positions described by an md_input section.
+
+    Returns
+    -------
+    handler : object
+        Loaded topology file (PDBFile, AmberPrmtopFile, GromacsTopFile
+        or CharmmPsfFile)
+    topology : simtk.openmm.app.Topology
+    positions : list of Vec3
+    """
+    path = md_input['topology']
+    ext = os.path.splitext(path)[1].lower()
+    positions_path = md_input.get('positions') or path
+    if ext == '.top':
+        # The box comes from the coordinates; force field files are
+        # looked up in the directory given as force field, if any
+        gro = app.GromacsGroFile(positions_path)
+        include = [f for f in md_input.get('forcefield') or () if os.path.isdir(f)]
+        handler = app.GromacsTopFile(path, periodicBoxVectors=gro.getPeriodicBoxVectors(),
+                                     includeDir=include[0] if include else None)
+        return handler, handler.topology, gro.getPositions()
+    if ext in ('.pdb', '.ent'):
+        handler = app.PDBFile(path)
+    elif ext in ('.cif', '.pdbx'):
+        handler = app.PDBxFile(path)
+    elif ext in ('.prmtop', '.parm7'):
+        handler = app.AmberPrmtopFile(path)
+    elif ext == '.psf':
+        handler = app.CharmmPsfFile(path)
+    else:
+        raise ValueError('Unsupported topology format {}'.format(ext))
+
+    if positions_path == path:
+        positions = handler.positions
+    else:
+        pext = os.path.splitext(positions_path)[1].lower()
+        if pext in ('.inpcrd', '.rst7', '.crd') and ext != '.psf':
+            coords = app.AmberInpcrdFile(positions_path)
+        elif pext == '.crd':
+            coords = app.CharmmCrdFile(positions_path)
+        else:
+            coords = app.PDBFile(positions_path)
+        positions = coords.positions
+        box = getattr(coords, 'boxVectors', None)
+        if box is not None and ext == '.psf':
+            handler.setBox(box[0][0], box[1][1], box[2][2])
+    return handler, handler.topology, positions
+
+
+def system_options(md_systemoptions):
+    """
+    Translate an md_systemoptions section into createSystem arguments.
+    Keys nested under ``extra_system_options`` are read as well.
+    """
+    options = {}
+    md_systemoptions = dict(md_systemoptions)
+    md_systemoptions.update(md_systemoptions.pop('extra_system_options', None) or {})
+    for key, value in md_systemoptions.items():
+        if key == 'nonbondedMethod':
+            options[key] = getattr(app, value)
+        elif key == 'constraints':
+            options[key] = None if value in (None, 'None') else getattr(app, value)
+        elif key == 'nonbondedCutoff':
+            options[key] = float(value) * unit.nanometers
+        elif key == 'hydrogenMass':
+            options[key] = float(value) * unit.amu
+        else:
+            options[key] = value
+    return options
+
+
+def system_cache_prefix(md_input):
+    """
+    Where slaves cache the serialized Systems of this input (see
+    slave.py). The prefix hashes what ommprotocol builds the System
+    from, the topology and force field files; the slave completes it
+    with the system options and its OpenMM version. Positions and box
+    are left out, as the box is set on every System reused.
+    """
+    sha = hashlib.sha1()
+    files = [('topology', md_input['topology'])]
+    if md_input.get('charmm_parameters'):
+        files.append(('charmm_parameters', md_input['charmm_parameters']))
+    files.extend(('forcefield', path) for path in md_input.get('forcefield') or ())
+    for key, path in files:
+        sha.update('{}={}\n'.format(key, file_hash(path) if os.path.isfile(path)
+                                    else path).encode('utf-8'))
+    return os.path.join(user_data_dir('systems'), sha.hexdigest())
+
+
+def build_system(md_input, md_systemoptions):
+    """
+    Create the OpenMM System ommprotocol would run for this input.
+    Only XML force fields are used for PDB topologies.
+
+    Returns
+    -------
+    system, topology, positions
+    """
+    handler, topology, positions = load_topology(md_input)
+    options = system_options(md_systemoptions)
+    if isinstance(handler, app.CharmmPsfFile):
+        params = app.CharmmParameterSet(md_input['charmm_parameters'])
+        system = handler.createSystem(params, **options)
+    elif isinstance(handler, (app.AmberPrmtopFile, app.GromacsTopFile)):
+        system = handler.createSystem(**options)
+    else:
+        forcefield = app.ForceField(*[f for f in md_input['forcefield'] if f.endswith('.xml')])
+        system = forcefield.createSystem(topology, **options)
+    return system, topology, positions
+
+
+def build_integrator(md_conditions):
+    """
+    Integrator matching an md_conditions section (timestep in fs).
+    """
+    name = md_conditions.get('integrator', 'LangevinIntegrator')
+    timestep = float(md_conditions.get('timestep', 1)) * unit.femtoseconds
+    temperature = float(md_conditions.get('temperature', 300)) * unit.kelvin
+    friction = float(md_conditions.get('friction', 1)) / unit.picoseconds
+    if name in ('LangevinIntegrator', 'BrownianIntegrator'):
+        return getattr(openmm, name)(temperature, friction, timestep)
+    if name == 'VariableLangevinIntegrator':
+        return openmm.VariableLangevinIntegrator(temperature, friction, 0.001)
+    if name == 'VariableVerletIntegrator':
+        return openmm.VariableVerletIntegrator(0.001)
+    return openmm.VerletIntegrator(timestep)
+
+
+def add_barostat(system, md_conditions):
+    pressure = float(md_conditions.get('pressure', 1)) * unit.bar
+    temperature = float(md_conditions.get('temperature', 300)) * unit.kelvin
+    interval = int(md_conditions.get('barostat_interval', 25))
+    return system.addForce(openmm.MonteCarloBarostat(pressure, temperature, interval))
+
+
+def subset_size(topology, selection):
+    """
+    Atoms matched by `selection`, as ommprotocol reads it for
+    `trajectory_atom_subset` (a list of indices, one of SELECTORS or
+    an MDTraj query), or None if it cannot be evaluated here.
+    """
+    if isinstance(selection, (list, tuple)):
+        return len(selection)
+    try:
+        import mdtraj
+        selection = SELECTORS.get(selection, selection)
+        return len(mdtraj.Topology.from_openmm(topology).select(selection))
+    except Exception:
+        return None
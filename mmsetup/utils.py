@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+
+
+def user_data_dir(*subdirs):
+    """
+    Per-user MMSetup directory (``~/.mmsetup`` unless the MMSETUP_HOME
+    environment variable says otherwise), created on demand.
+    """
+    base = os.environ.get('MMSETUP_HOME') or os.path.join(os.path.expanduser('~'), '.mmsetup')
+    path = os.path.join(base, *subdirs)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Warm OMMProtocol worker.
+
+Imports OpenMM, ParmEd, MDTraj and OMMProtocol, preloads the force
+field files given in the command line and then blocks until a run
+request arrives as a single JSON line on stdin:
+
+    {"input": "/path/to/input.yaml", "env": {"OMMPROTOCOL_SLAVE": "1"}}
+
+The run then proceeds exactly as `python slave.py /path/to/input.yaml`
+would, MMSetup extensions included, with the same stdout/stderr and the
+rest of stdin left to answer its save prompt when it is stopped. Each
+worker serves a single run.
+
+This script runs with the Python interpreter of ommprotocol, which is
+not necessarily the one Chimera uses, so it must not import Chimera.
+
+Usage: python worker.py [forcefield.xml ...]
+"""
+
+from __future__ import print_function, division
+import os
+import sys
+import json
+from slave import install, entry_point
+
+
+def preload(forcefields=()):
+    """
+    Do the expensive imports and parse the requested force fields.
+    ForceField instances built from the same files are reused.
+    """
+    import simtk.openmm
+    import simtk.openmm.app as app
+    for module in ('parmed', 'mdtraj', 'ommprotocol', 'ommprotocol.io', 'ommprotocol.md'):
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+
+    original = app.ForceField
+    cache = {}
+
+    class CachedForceField(original):
+
+        def __new__(cls, *files):
+            if files in cache:
+                return cache[files]
+            return super(CachedForceField, cls).__new__(cls)
+
+        def __init__(self, *files):
+            if files in cache:
+                return
+            super(CachedForceField, self).__init__(*files)
+            cache[files] = self
+
+    if forcefields:
+        try:
+            CachedForceField(*forcefields)
+        except Exception as e:  # unknown files are loaded again at run time
+            print('Could not preload {}: {}'.format(forcefields, e), file=sys.stderr)
+
+    app.ForceField = app.forcefield.ForceField = CachedForceField
+    for module in list(sys.modules.values()):
+        if getattr(module, 'ForceField', None) is original:
+            module.ForceField = CachedForceField
+    return cache
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    preload(tuple(argv))
+    install()
+    run = entry_point()
+    line = sys.stdin.readline()
+    if not line.strip():  # pool closed before a request came
+        return 0
+    request = json.loads(line)
+    # Read at run time, like OMMPROTOCOL_SLAVE. Variables OpenMM reads
+    # on import were given when the pool spawned this worker.
+    os.environ.update(request.get('env', {}))
+    sys.argv = ['ommprotocol', request['input']]
+    return run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Get used to importing this in your Py27 projects!
+from __future__ import print_function, division
+# Python
+import os
+import json
+from collections import deque
+import subprocess
+# Own
+from slave import slave_python
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+
+# Read by OpenMM when it is imported or its platforms are loaded, so a
+# warm worker can only serve runs that want the same values. The rest
+# of the environment is applied when the run starts.
+IMPORT_ENV = ('OPENMM_CPU_THREADS', 'OPENMM_PLUGIN_DIR', 'OPENMM_DEFAULT_PLATFORM',
+              'CUDA_VISIBLE_DEVICES')
+
+
+class WorkerPool(object):
+
+    """
+    Keeps `size` warm OMMProtocol workers (see worker.py) idle, with
+    OpenMM already imported and force fields parsed, so a run starts
+    without the usual seconds of import and setup time.
+
+    Workers serve a single run each; a replacement is spawned as soon
+    as one is handed out. OpenMM reads some environment variables, like
+    OPENMM_CPU_THREADS, when it is imported (see IMPORT_ENV), so a run
+    is only handed to a warm worker spawned with the same values of
+    those; otherwise it gets a fresh worker started with its environment.
+
+    Parameters
+    ----------
+    size : int
+        Number of idle workers to keep. 0 disables the pool.
+    forcefields : list of str
+        Force field files to preload in every worker
+    env : dict, optional
+        Environment variables warm workers are spawned with
+    popen : callable
+        Popen-like factory used to spawn workers
+    popen_kwargs
+        Extra keyword arguments passed to `popen`
+    """
+
+    def __init__(self, size=1, forcefields=(), env=None, popen=subprocess.Popen,
+                 **popen_kwargs):
+        self.size = size
+        self.forcefields = tuple(forcefields)
+        self.env = dict(env or {})
+        self.popen = popen
+        self.popen_kwargs = popen_kwargs
+        self.idle = deque()
+
+    def command(self):
+        return slave_python() + [WORKER_SCRIPT] + list(self.forcefields)
+
+    def _spawn(self, env=None):
+        env = dict(os.environ, **(self.env if env is None else env))
+        env['OMMPROTOCOL_SLAVE'] = '1'
+        env['PYTHONIOENCODING'] = 'latin-1'
+        process = self.popen(self.command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, bufsize=1, env=env, **self.popen_kwargs)
+        process.environment = env
+        return process
+
+    def fill(self):
+        self.idle = deque(p for p in self.idle if p.poll() is None)
+        while len(self.idle) < self.size:
+            self.idle.append(self._spawn())
+
+    def set_forcefields(self, forcefields):
+        """
+        Change the preloaded force fields, recycling idle workers.
+        """
+        forcefields = tuple(forcefields)
+        if forcefields != self.forcefields:
+            self.forcefields = forcefields
+            self.close()
+            self.fill()
+
+    def set_env(self, env):
+        """
+        Change the environment of warm workers, recycling idle ones.
+        """
+        env = dict(env or {})
+        if env != self.env:
+            self.env = env
+            self.close()
+            self.fill()
+
+    def acquire(self, inputfile, env=None):
+        """
+        Hand `inputfile` to a warm worker (or a fresh one if none is
+        ready) and return its process, already running the input.
+        """
+        env = dict(env or {})
+        wanted = dict(os.environ, **self.env)
+        wanted.update(env)
+        process = None
+        for candidate in list(self.idle):
+            if candidate.poll() is not None:
+                self.idle.remove(candidate)
+            elif all(candidate.environment.get(k) == wanted.get(k) for k in IMPORT_ENV):
+                self.idle.remove(candidate)
+                process = candidate
+                break
+        if process is None:
+            process = self._spawn(dict(self.env, **env))
+        request = json.dumps({'input': os.path.abspath(inputfile), 'env': env or {}})
+        process.stdin.write((request + '\n').encode('latin-1'))
+        process.stdin.flush()
+        self.fill()
+        return process
+
+    def close(self):
+        while self.idle:
+            process = self.idle.popleft()
+            try:
+                process.stdin.close()  # workers exit on an empty request
+            except (IOError, OSError):
+                pass